@@ -0,0 +1,40 @@
+"""Token usage accounting
+
+Revision ID: 002
+Revises: 001
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '002'
+down_revision = '001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Токены запроса к LLM для каждой отмазки (NULL - ответ из кэша/пула)
+    op.add_column('excuses', sa.Column('prompt_tokens', sa.Integer(), nullable=True))
+    op.add_column('excuses', sa.Column('completion_tokens', sa.Integer(), nullable=True))
+
+    # Дневной расход токенов по пользователям
+    op.create_table(
+        'user_token_usage',
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('prompt_tokens', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('completion_tokens', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('user_id', 'day'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE')
+    )
+    op.create_index('ix_user_token_usage_day', 'user_token_usage', ['day'])
+
+
+def downgrade() -> None:
+    op.drop_table('user_token_usage')
+    op.drop_column('excuses', 'completion_tokens')
+    op.drop_column('excuses', 'prompt_tokens')
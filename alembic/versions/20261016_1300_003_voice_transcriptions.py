@@ -0,0 +1,32 @@
+"""Voice transcription cache
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-16 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Распознанные голосовые по file_unique_id Telegram
+    op.create_table(
+        'voice_transcriptions',
+        sa.Column('file_unique_id', sa.String(length=64), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('duration', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('file_unique_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('voice_transcriptions')
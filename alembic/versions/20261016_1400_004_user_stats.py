@@ -0,0 +1,134 @@
+"""Incrementally maintained per-user counters
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-16 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Счетчики пользователя для /stats: одна строка на пользователя
+    op.create_table(
+        'user_stats',
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('total_excuses', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_favorites', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('style_counts', postgresql.JSONB(), nullable=False, server_default=sa.text("'{}'::jsonb")),
+        sa.PrimaryKeyConstraint('user_id'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE')
+    )
+
+    # Сложение счетчиков стилей {"стиль": n}; нулевые ключи выбрасываются
+    op.execute("""
+        CREATE FUNCTION user_stats_add_counts(a jsonb, b jsonb) RETURNS jsonb
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT coalesce(jsonb_object_agg(key, total), '{}'::jsonb)
+            FROM (
+                SELECT key, SUM(value::bigint) AS total
+                FROM (
+                    SELECT * FROM jsonb_each_text(coalesce(a, '{}'::jsonb))
+                    UNION ALL
+                    SELECT * FROM jsonb_each_text(coalesce(b, '{}'::jsonb))
+                ) counts
+                GROUP BY key
+                HAVING SUM(value::bigint) <> 0
+            ) totals
+        $$
+    """)
+
+    # Триггеры уровня оператора: пакетный INSERT отмазок дает одно обновление
+    # на пользователя. Удаление только уменьшает существующие строки - при
+    # каскадном удалении пользователя его строка счетчиков уже удалена.
+    op.execute("""
+        CREATE FUNCTION user_stats_on_excuses() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_stats (user_id, total_excuses, total_favorites, style_counts)
+                SELECT user_id, SUM(cnt), 0, jsonb_object_agg(style, cnt)
+                FROM (SELECT user_id, style, COUNT(*) AS cnt FROM changed GROUP BY user_id, style) per_style
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    total_excuses = user_stats.total_excuses + EXCLUDED.total_excuses,
+                    style_counts = user_stats_add_counts(user_stats.style_counts, EXCLUDED.style_counts);
+            ELSE
+                UPDATE user_stats SET
+                    total_excuses = user_stats.total_excuses - delta.total,
+                    style_counts = user_stats_add_counts(user_stats.style_counts, delta.style_counts)
+                FROM (
+                    SELECT user_id, SUM(cnt) AS total, jsonb_object_agg(style, -cnt) AS style_counts
+                    FROM (SELECT user_id, style, COUNT(*) AS cnt FROM changed GROUP BY user_id, style) per_style
+                    GROUP BY user_id
+                ) delta
+                WHERE user_stats.user_id = delta.user_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """)
+    op.execute("""
+        CREATE FUNCTION user_stats_on_favorites() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO user_stats (user_id, total_favorites)
+                SELECT user_id, COUNT(*) FROM changed GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    total_favorites = user_stats.total_favorites + EXCLUDED.total_favorites;
+            ELSE
+                UPDATE user_stats SET total_favorites = user_stats.total_favorites - delta.total
+                FROM (SELECT user_id, COUNT(*) AS total FROM changed GROUP BY user_id) delta
+                WHERE user_stats.user_id = delta.user_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """)
+
+    # Без записей в таблицы, пока создаются триггеры и идет пересчет
+    op.execute("LOCK TABLE excuses, favorites IN SHARE MODE")
+
+    for table, function in (('excuses', 'user_stats_on_excuses'), ('favorites', 'user_stats_on_favorites')):
+        op.execute(f"""
+            CREATE TRIGGER {table}_user_stats_insert AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+        """)
+        op.execute(f"""
+            CREATE TRIGGER {table}_user_stats_delete AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+        """)
+
+    # Пересчет счетчиков по уже накопленной истории
+    op.execute("""
+        INSERT INTO user_stats (user_id, total_excuses, total_favorites, style_counts)
+        SELECT user_id, coalesce(e.total, 0), coalesce(f.total, 0), coalesce(e.style_counts, '{}'::jsonb)
+        FROM (
+            SELECT user_id, SUM(cnt) AS total, jsonb_object_agg(style, cnt) AS style_counts
+            FROM (SELECT user_id, style, COUNT(*) AS cnt FROM excuses GROUP BY user_id, style) per_style
+            GROUP BY user_id
+        ) e
+        FULL JOIN (SELECT user_id, COUNT(*) AS total FROM favorites GROUP BY user_id) f USING (user_id)
+    """)
+
+
+def downgrade() -> None:
+    for table in ('excuses', 'favorites'):
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_user_stats_insert ON {table}")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_user_stats_delete ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS user_stats_on_favorites()")
+    op.execute("DROP FUNCTION IF EXISTS user_stats_on_excuses()")
+    op.execute("DROP FUNCTION IF EXISTS user_stats_add_counts(jsonb, jsonb)")
+    op.drop_table('user_stats')
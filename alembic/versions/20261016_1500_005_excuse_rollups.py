@@ -0,0 +1,116 @@
+"""Hourly and daily excuse rollups for the admin panel
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-16 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+# Строк счетчиков /admin: запись идет в строку своего backend'а, чтобы
+# вставки в favorites и users из разных соединений не ждали одну блокировку
+ADMIN_COUNTER_SHARDS = 16
+
+
+def _rollup_columns():
+    return [
+        sa.Column('style', sa.String(length=50), nullable=False),
+        sa.Column('excuses', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('response_time_sum', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('response_time_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('token_excuses', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('prompt_tokens', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('completion_tokens', sa.BigInteger(), nullable=False, server_default='0'),
+    ]
+
+
+def upgrade() -> None:
+    # Сводки заполняет фоновая агрегация (app/rollups.py), история догружается
+    # ею же порциями по ROLLUP_CHUNK_HOURS - миграция не сканирует excuses
+    op.create_table(
+        'excuse_rollup_hourly',
+        sa.Column('hour', sa.DateTime(), nullable=False),
+        *_rollup_columns(),
+        sa.PrimaryKeyConstraint('hour', 'style')
+    )
+    op.create_table(
+        'excuse_rollup_daily',
+        sa.Column('day', sa.Date(), nullable=False),
+        *_rollup_columns(),
+        sa.PrimaryKeyConstraint('day', 'style')
+    )
+
+    # Топ пользователей читается из user_stats по индексу
+    op.create_index('ix_user_stats_total_excuses', 'user_stats', ['total_excuses'])
+
+    # Общие счетчики /admin - вместо count(*) по users и favorites.
+    # Значение - сумма по всем строкам (шардам).
+    op.create_table(
+        'admin_counters',
+        sa.Column('shard', sa.SmallInteger(), nullable=False),
+        sa.Column('total_users', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('total_favorites', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('shard'),
+        sa.CheckConstraint(f'shard >= 0 AND shard < {ADMIN_COUNTER_SHARDS}', name='ck_admin_counters_shard')
+    )
+
+    # Триггер уровня оператора: один UPDATE строки своего шарда на оператор.
+    # Операторы без изменений (ON CONFLICT DO NOTHING) строку не блокируют.
+    op.execute(f"""
+        CREATE FUNCTION admin_counters_add() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            delta bigint;
+        BEGIN
+            SELECT COUNT(*) INTO delta FROM changed;
+            IF delta > 0 THEN
+                EXECUTE format('UPDATE admin_counters SET %1$I = %1$I + $1 WHERE shard = $2', TG_ARGV[0])
+                USING CASE WHEN TG_OP = 'INSERT' THEN delta ELSE -delta END,
+                      pg_backend_pid() % {ADMIN_COUNTER_SHARDS};
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """)
+
+    # Без записей в таблицы, пока создаются триггеры и идет пересчет
+    op.execute("LOCK TABLE users, favorites IN SHARE MODE")
+
+    for table, column in (('users', 'total_users'), ('favorites', 'total_favorites')):
+        op.execute(f"""
+            CREATE TRIGGER {table}_admin_counters_insert AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION admin_counters_add('{column}')
+        """)
+        op.execute(f"""
+            CREATE TRIGGER {table}_admin_counters_delete AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION admin_counters_add('{column}')
+        """)
+
+    op.execute(f"""
+        INSERT INTO admin_counters (shard, total_users, total_favorites)
+        SELECT shard,
+               CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM users) ELSE 0 END,
+               CASE WHEN shard = 0 THEN (SELECT COUNT(*) FROM favorites) ELSE 0 END
+        FROM generate_series(0, {ADMIN_COUNTER_SHARDS - 1}) AS shard
+    """)
+
+
+def downgrade() -> None:
+    for table in ('users', 'favorites'):
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_admin_counters_insert ON {table}")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_admin_counters_delete ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS admin_counters_add()")
+    op.drop_table('admin_counters')
+    op.drop_index('ix_user_stats_total_excuses', table_name='user_stats')
+    op.drop_table('excuse_rollup_daily')
+    op.drop_table('excuse_rollup_hourly')
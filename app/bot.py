@@ -5,14 +5,32 @@
 import asyncio
 import logging
 import random
+import re
 import time
 import io
+from typing import Optional
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from app.config import config
-from app.llm_client import generate_text
+from app.llm_client import (
+    generate_text, generate_text_stream, generate_batch_excuses, generate_candidates, is_fallback_response,
+    is_llm_saturated, get_singleflight_stats, get_hedge_stats, new_deadline
+)
+from app.limiter import PREMIUM, REGULAR
+from app.providers import get_provider_stats
+from app.response_cache import response_cache
+from app.prefetch import (
+    start_prefetch, start_voice_prefetch, take_prefetch, get_prefetched_style, get_prefetch_stats
+)
+from app.warm_pool import warm_pool
+from app.usage import TokenUsage, quota_tracker
+from app.transcription import check_voice_limits, transcribe_voice, get_transcription_stats
+from app.user_registry import get_user, user_registry
+from app.excuse_writer import excuse_writer, save_excuse
+from app.middlewares import db_session_middleware, db_release_middleware
+from app.rollups import admin_stats, get_rollup_stats
 from app.prompts import EXCUSE_PROMPTS
 from app.styles import STYLES
 from app import database as db
@@ -26,8 +44,17 @@ request_logger = logging.getLogger("requests")
 bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 
+# Общая сессия БД на апдейт, коммит перед каждым запросом к Telegram
+dp.update.outer_middleware(db_session_middleware)
+bot.session.middleware(db_release_middleware)
+
 # Хранение временных состояний (для регенерации)
-regenerate_cache = {}  # {user_id: {"original_message": str, "style": str}}
+regenerate_cache = {}  # {user_id: {"original_message": str, "style": str, "lane": str}}
+
+# Генерации в процессе: повторное нажатие той же кнопки не запускает вторую,
+# новый выбор отменяет прежнюю генерацию до записи в БД
+active_generations = {}  # {user_id: (ключ нажатия, asyncio.Task)}
+generation_stats = {"started": 0, "duplicates": 0, "superseded": 0}
 
 
 def create_main_menu_keyboard() -> InlineKeyboardMarkup:
@@ -48,35 +75,18 @@ def create_main_menu_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
-def create_style_keyboard() -> InlineKeyboardMarkup:
-    """Создать клавиатуру выбора стилей"""
+def create_style_keyboard(ready_style: str = None) -> InlineKeyboardMarkup:
+    """Создать клавиатуру выбора стилей (ready_style - отмазка в этом стиле уже готовится)"""
+    def style_button(style: str) -> InlineKeyboardButton:
+        label = f"{STYLES[style]['emoji']} {STYLES[style]['name']}"
+        if style == ready_style:
+            label = f"⚡ {label}"
+        return InlineKeyboardButton(text=label, callback_data=f"style_{style}")
+
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text=f"{STYLES['быдло']['emoji']} {STYLES['быдло']['name']}",
-                callback_data="style_быдло"
-            ),
-            InlineKeyboardButton(
-                text=f"{STYLES['корпорат']['emoji']} {STYLES['корпорат']['name']}",
-                callback_data="style_корпорат"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text=f"{STYLES['монах']['emoji']} {STYLES['монах']['name']}",
-                callback_data="style_монах"
-            ),
-            InlineKeyboardButton(
-                text=f"{STYLES['инфоцыган']['emoji']} {STYLES['инфоцыган']['name']}",
-                callback_data="style_инфоцыган"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text=f"{STYLES['случайный']['emoji']} {STYLES['случайный']['name']}",
-                callback_data="style_случайный"
-            )
-        ],
+        [style_button('быдло'), style_button('корпорат')],
+        [style_button('монах'), style_button('инфоцыган')],
+        [style_button('случайный')],
         [
             InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")
         ]
@@ -106,6 +116,242 @@ def create_action_keyboard(excuse_id: int, is_fav: bool = False) -> InlineKeyboa
     return keyboard
 
 
+async def render_excuse_stream(
+    message: types.Message, header: str, prompt: str, user_id: int, style: str,
+    deadline: float = None, lane: str = REGULAR, usage: TokenUsage = None, coalesce: bool = True
+) -> str:
+    """
+    Сгенерировать отмазку потоком, постепенно обновляя сообщение
+
+    Правки сообщения троттлятся по STREAM_EDIT_INTERVAL, чтобы не упереться
+    в лимиты Telegram на редактирование; ошибки промежуточных правок (в том
+    числе флуд-лимит) генерацию не прерывают. Финальную правку с клавиатурой
+    делает вызывающий код, когда отмазка уже сохранена в БД. coalesce=False -
+    без объединения с одинаковыми запросами (для "Другой вариант").
+
+    Returns:
+        Полный сгенерированный текст
+    """
+    if not config.LLM_STREAMING:
+        return await generate_text(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage, coalesce=coalesce
+        )
+
+    text = ""
+    shown_text = ""
+    last_edit = 0.0
+
+    async for chunk in generate_text_stream(
+        prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage, coalesce=coalesce
+    ):
+        text += chunk
+
+        now = time.monotonic()
+        if now - last_edit < config.STREAM_EDIT_INTERVAL or text.strip() == shown_text:
+            continue
+
+        try:
+            # Без Markdown: незакрытая разметка в середине потока ломает парсинг
+            await message.edit_text(f"{header}\n\n{text.strip()} ▌")
+            shown_text = text.strip()
+        except TelegramRetryAfter as e:
+            # Флуд-лимит: промежуточные правки пропускаем, пока он не истечет
+            logger.debug(f"Stream edits paused for user {user_id} for {e.retry_after}s")
+            now += e.retry_after
+        except TelegramAPIError as e:
+            # Промежуточная правка необязательна - генерацию не прерываем
+            logger.debug(f"Skipped stream edit for user {user_id}: {e}")
+        last_edit = now
+
+    return text.strip()
+
+
+def user_lane(user) -> str:
+    """Полоса приоритета запросов к LLM для пользователя"""
+    return PREMIUM if user.is_premium else REGULAR
+
+
+def quota_exceeded(user_id: int) -> bool:
+    """Исчерпал ли пользователь дневную квоту токенов (премиум без квоты)"""
+    if regenerate_cache[user_id].get("lane") == PREMIUM or not quota_tracker.is_exceeded(user_id):
+        return False
+    request_logger.info(f"QUOTA_EXCEEDED | User: {user_id} | Used: {quota_tracker.used(user_id)}")
+    return True
+
+
+def is_duplicate_tap(user_id: int, key: tuple) -> bool:
+    """Нажата ли та же кнопка, генерация по которой еще идет"""
+    current = active_generations.get(user_id)
+    if current is None or current[0] != key:
+        return False
+    generation_stats["duplicates"] += 1
+    request_logger.info(f"DUPLICATE_TAP | User: {user_id} | Action: {key[1]}")
+    return True
+
+
+def cancel_generation(user_id: int, reason: str = "superseded"):
+    """Отменить незавершенную генерацию пользователя (результат больше не нужен)"""
+    current = active_generations.pop(user_id, None)
+    if current is None or current[1].done():
+        return
+    current[1].cancel()
+    generation_stats["superseded"] += 1
+    request_logger.info(f"SUPERSEDED | User: {user_id} | Action: {current[0][1]} | Reason: {reason}")
+
+
+def start_generation(user_id: int, key: tuple, coro) -> asyncio.Task:
+    """Запустить генерацию пользователя, отменив прежнюю"""
+    cancel_generation(user_id)
+    task = asyncio.create_task(coro)
+    active_generations[user_id] = (key, task)
+    generation_stats["started"] += 1
+    return task
+
+
+def finish_generation(user_id: int, task: asyncio.Task):
+    """Снять генерацию с учета, когда обработчик закончил (в том числе запись в БД)"""
+    current = active_generations.get(user_id)
+    if current is not None and current[1] is task:
+        del active_generations[user_id]
+
+
+async def await_generation(task: asyncio.Task) -> Optional[str]:
+    """
+    Дождаться генерации
+
+    Returns:
+        Текст или None, если генерацию отменил более новый выбор пользователя
+    """
+    # Соединение не держим, пока ждем LLM
+    await db.release_session()
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            # Отменили сам обработчик - генерация тоже не нужна
+            task.cancel()
+            raise
+        return None
+
+
+def escape_markdown(text: str) -> str:
+    """Экранировать пользовательский текст для parse_mode="Markdown" (_ * ` [)"""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def sparkline(values: list) -> str:
+    """Мини-график ряда чисел блочными символами (для /admin)"""
+    bars = "▁▂▃▄▅▆▇█"
+    top = max(values, default=0)
+    if not top:
+        return bars[0] * len(values)
+    return "".join(bars[min(len(bars) - 1, value * len(bars) // top)] for value in values)
+
+
+def take_candidate(user_id: int, style: str) -> Optional[str]:
+    """Забрать сохраненный запасной вариант отмазки для текущей ситуации пользователя"""
+    candidates = regenerate_cache[user_id].get("candidates", {}).get(style)
+    if not candidates:
+        return None
+    request_logger.info(f"CANDIDATE_HIT | User: {user_id} | Style: {style} | Left: {len(candidates) - 1}")
+    return candidates.pop(0)
+
+
+async def obtain_excuse(
+    message: types.Message, header: str, prompt: str, user_id: int, style: str,
+    use_pool: bool = False, deadline: float = None, usage: TokenUsage = None
+) -> str:
+    """
+    Получить отмазку для выбранного стиля самым дешевым доступным способом
+
+    Порядок: предзагрузка -> пул готовых отмазок (для случайного стиля или
+    при перегрузке LLM) -> результаты пакетной генерации -> запасные
+    варианты от прошлых запросов с n > 1 -> кэш ->
+    пакетная генерация всех стилей (если включена) -> потоковая генерация.
+    Запросы к LLM укладываются в общий дедлайн обработчика, потраченные
+    токены добавляются в usage.
+    """
+    state = regenerate_cache[user_id]
+    original_message = state["original_message"]
+    lane = state.get("lane", REGULAR)
+
+    response = await take_prefetch(user_id, style, original_message, usage=usage, lane=lane)
+    if response is not None:
+        return response
+
+    if config.WARM_POOL_ENABLED and (use_pool or is_llm_saturated()):
+        response = warm_pool.take(style, original_message)
+        if response is not None:
+            request_logger.info(f"POOL_HIT | User: {user_id} | Style: {style} | Shed: {not use_pool}")
+            return response
+
+    # Отмазки, сгенерированные пакетом для этой ситуации, отдаем по одному разу
+    batch = state.get("batch")
+    if batch and style in batch:
+        request_logger.info(f"BATCH_HIT | User: {user_id} | Style: {style}")
+        return batch.pop(style)
+
+    response = take_candidate(user_id, style)
+    if response is not None:
+        return response
+
+    if config.RESPONSE_CACHE_ENABLED:
+        response = response_cache.get(style, original_message)
+        if response is not None:
+            request_logger.info(f"CACHE_HIT | User: {user_id} | Style: {style}")
+            return response
+
+    if config.BATCH_GENERATION and "batch" not in state:
+        batch = await generate_batch_excuses(
+            original_message, user_id=user_id, deadline=deadline, lane=lane, usage=usage
+        )
+        if batch is not None:
+            if config.RESPONSE_CACHE_ENABLED:
+                for batch_style, text in batch.items():
+                    response_cache.put(batch_style, original_message, text)
+            response = batch.pop(style)
+            state["batch"] = batch
+            return response
+        # Ответ не разобрался - дальше генерируем по одному стилю
+        state["batch"] = {}
+
+    response = await render_excuse_stream(
+        message, header, prompt, user_id, style, deadline=deadline, lane=lane, usage=usage
+    )
+    if config.RESPONSE_CACHE_ENABLED and not is_fallback_response(response):
+        response_cache.put(style, original_message, response)
+    return response
+
+
+async def regenerate_excuse(
+    message: types.Message, header: str, prompt: str, user_id: int, style: str,
+    deadline: float = None, usage: TokenUsage = None
+) -> str:
+    """
+    Получить новый вариант отмазки для кнопки "Другой вариант"
+
+    Сначала отдаются сохраненные запасные варианты. При LLM_CANDIDATES > 1
+    делается один запрос с n вариантами: первый показываем, остальные
+    сохраняем для следующих нажатий. Иначе - обычная потоковая генерация.
+    """
+    response = take_candidate(user_id, style)
+    if response is not None:
+        return response
+
+    lane = regenerate_cache[user_id].get("lane", REGULAR)
+    if config.LLM_CANDIDATES > 1:
+        candidates = await generate_candidates(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
+        )
+        regenerate_cache[user_id].setdefault("candidates", {})[style] = candidates[1:]
+        return candidates[0]
+
+    # Пользователь просит другой вариант - чужой запрос с тем же промптом не подходит
+    return await render_excuse_stream(
+        message, header, prompt, user_id, style, deadline=deadline, lane=lane, usage=usage, coalesce=False
+    )
+
+
 # ==================== КОМАНДЫ ====================
 
 @dp.message(Command("start"))
@@ -115,8 +361,8 @@ async def start_handler(message: types.Message):
     username = message.from_user.username
     first_name = message.from_user.first_name
 
-    # Создаем или обновляем пользователя в БД
-    await db.get_or_create_user(user_id, username, first_name)
+    # Создаем пользователя в БД или обновляем его в реестре (запись пачкой)
+    await get_user(user_id, username, first_name)
 
     keyboard = create_main_menu_keyboard()
 
@@ -159,6 +405,7 @@ async def history_handler(message: types.Message):
 
     try:
         # Загружаем больше отмазок, чтобы выбрать те, что влезут
+        await excuse_writer.sync_user(user_id)
         excuses = await db.get_user_history(user_id, limit=20)
 
         if not excuses:
@@ -266,8 +513,9 @@ async def stats_handler(message: types.Message):
     user_id = message.from_user.id
 
     try:
+        await excuse_writer.sync_user(user_id)
         stats = await db.get_user_stats(user_id)
-        user = await db.get_or_create_user(user_id)
+        user = await get_user(user_id)
 
         response = "📊 *Твоя статистика:*\n\n"
         response += f"🎭 Всего отмазок: {stats['total_excuses']}\n"
@@ -322,13 +570,18 @@ async def admin_handler(message: types.Message):
             await message.answer("❌ Неверный пароль")
             return
 
-        # Получаем статистику
-        stats = await db.get_admin_stats()
+        # Получаем статистику (снимок из сводок, см. app/rollups.py)
+        stats = await admin_stats.get()
 
         # Формируем ответ
         response = "👑 *Админ-панель*\n\n"
         response += "📊 *Общая статистика:*\n\n"
         response += f"👥 Всего пользователей: {stats['total_users']}\n"
+        registry_stats = user_registry.stats()
+        response += (
+            f"🗂 Реестр пользователей: {registry_stats['known']} в памяти, "
+            f"hit rate {registry_stats['hit_rate']:.0%}, ждут записи {registry_stats['pending_rows']}\n"
+        )
         response += f"🎭 Всего отмазок: {stats['total_excuses']}\n"
         response += f"⭐ Всего в избранном: {stats['total_favorites']}\n"
 
@@ -339,11 +592,128 @@ async def admin_handler(message: types.Message):
             pop_style = STYLES[stats['popular_style']]
             response += f"🔥 Популярный стиль: {pop_style['emoji']} {pop_style['name']}\n"
 
+        # Расход токенов LLM (всего - на сохраненные отмазки по сводкам, сегодня - из квот в памяти)
+        quota_stats = quota_tracker.stats()
+        response += (
+            f"🪙 Токены: всего {stats['total_prompt_tokens'] + stats['total_completion_tokens']} "
+            f"(промпт {stats['total_prompt_tokens']}, ответ {stats['total_completion_tokens']}), "
+            f"сегодня {quota_stats['tokens_today']}, "
+            f"превысили квоту {quota_stats['over_quota']}, отказов {quota_stats['rejected']}\n"
+        )
+        if stats['tokens_by_style']:
+            response += "    " + ", ".join(
+                f"{STYLES[style]['emoji'] if style in STYLES else style} ~{tokens}"
+                for style, tokens in stats['tokens_by_style']
+            ) + " токенов на отмазку\n"
+
+        # Объем по часам за сутки и динамика стилей за неделю (из сводок)
+        rollup_stats = get_rollup_stats()
+        hourly_counts = [count for _, count in stats['hourly_volume']]
+        response += f"📈 За 24 часа: {sum(hourly_counts)} `{sparkline(hourly_counts)}`\n"
+        for style, counts in sorted(stats['style_trend'].items(), key=lambda item: -sum(item[1])):
+            style_label = f"{STYLES[style]['emoji']} {STYLES[style]['name']}" if style in STYLES else style
+            response += f"    {style_label} за неделю: {sum(counts)} `{sparkline(counts)}`\n"
+        if rollup_stats['last_run_at']:
+            response += (
+                f"🧮 Сводки обновлены {rollup_stats['last_run_at']:%H:%M} UTC "
+                f"за {rollup_stats['last_run_time']:.2f}с, снимку {rollup_stats['snapshot_age']:.0f}с, "
+                f"ошибок {rollup_stats['failed']}\n"
+            )
+
+        # Запросов к БД на апдейт (общая сессия апдейта)
+        db_unit_stats = db_session_middleware.stats()
+        if db_unit_stats:
+            response += "🗄 Запросов к БД на апдейт: " + ", ".join(
+                f"{escape_markdown(key)} ~{unit['avg_queries']} (max {unit['max_queries']})"
+                for key, unit in sorted(db_unit_stats.items(), key=lambda item: -item[1]['updates'])[:6]
+            ) + "\n"
+
+        writer_stats = excuse_writer.stats()
+        response += (
+            f"📝 Запись отмазок: {writer_stats['written']} пачками по ~{writer_stats['avg_batch']}, "
+            f"в буфере {writer_stats['pending']}, ошибок {writer_stats['failed_batches']}, "
+            f"отвергнуто {writer_stats['rejected']}, вытеснено {writer_stats['spilled']}\n"
+        )
+
+        # Кэш отмазок
+        cache_stats = response_cache.stats()
+        response += (
+            f"💾 Кэш отмазок: {cache_stats['entries']} ключей, "
+            f"hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+        )
+
+        # Провайдеры LLM: состояние circuit breaker'а, лимит и очередь
+        for provider_stats in get_provider_stats():
+            state_emoji = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}[provider_stats['state']]
+            response += (
+                f"🚦 {state_emoji} {provider_stats['name']} ({provider_stats['model']}): "
+                f"лимит {provider_stats['limit']}, в работе {provider_stats['in_flight']}, "
+                f"очередь {provider_stats['queue_depth']} (макс {provider_stats['max_queue_depth']}), "
+                f"ожидание p95 {provider_stats['p95_wait']}с, отказов {provider_stats['rejected']}\n"
+            )
+            response += "    " + ", ".join(
+                f"{lane}: очередь {lane_stats['queue_depth']}, p95 {lane_stats['p95_wait']}с"
+                for lane, lane_stats in provider_stats['lanes'].items()
+            ) + "\n"
+
+        # Хеджирование медленных запросов
+        if config.LLM_HEDGING:
+            hedge_stats = get_hedge_stats()
+            response += (
+                f"🪃 Hedge-запросов: {hedge_stats['hedged']} из {hedge_stats['requests']}, "
+                f"выиграли {hedge_stats['hedge_wins']}\n"
+            )
+
+        # Объединение одинаковых запросов к LLM
+        flight_stats = get_singleflight_stats()
+        response += f"🔗 Объединено запросов к LLM: {flight_stats['coalesced']}\n"
+
+        # Предзагрузка отмазок
+        if config.PREFETCH_ENABLED or config.VOICE_PIPELINE_ENABLED:
+            prefetch_stats = get_prefetch_stats()
+            response += (
+                f"🔮 Предзагрузка: запущено {prefetch_stats['started']} "
+                f"(из них голосовых {prefetch_stats['voice_pipelined']}), "
+                f"hit rate {prefetch_stats['hit_rate']:.0%}, "
+                f"брошено по таймауту {prefetch_stats['expired']}, "
+                f"из очереди в полосу пользователя {prefetch_stats['requeued']}\n"
+            )
+
+        # Пул готовых отмазок
+        if config.WARM_POOL_ENABLED:
+            pool_stats = warm_pool.stats()
+            response += (
+                f"🧊 Пул отмазок: {pool_stats['size']} готово, "
+                f"выдано {pool_stats['served']}, ситуаций {pool_stats['situations']}\n"
+            )
+
+        voice_stats = get_transcription_stats()
+        response += (
+            f"🎤 Голосовых: {voice_stats['transcribed']}, "
+            f"скачивание p50/p95 {voice_stats['download_p50']}/{voice_stats['download_p95']}с, "
+            f"Whisper p50/p95 {voice_stats['transcribe_p50']}/{voice_stats['transcribe_p95']}с, "
+            f"отклонено {voice_stats['rejected_duration'] + voice_stats['rejected_size']}, "
+            f"ошибок {voice_stats['failed']} (скачивание {voice_stats['download_failed']}), "
+            f"кэш {voice_stats['cache']['hits'] + voice_stats['cache']['db_hits']}/"
+            f"{voice_stats['cache']['misses']} (hit rate {voice_stats['cache']['hit_rate']:.0%})\n"
+        )
+        for name, backend_stats in voice_stats['backends'].items():
+            response += (
+                f"   └ {name}: {backend_stats['count']}, p50 {backend_stats['p50']}с, "
+                f"{backend_stats['per_audio_second_p50']}с на секунду аудио\n"
+            )
+
+        response += (
+            f"👆 Генераций: {generation_stats['started']}, "
+            f"повторных нажатий: {generation_stats['duplicates']}, "
+            f"отменено устаревших: {generation_stats['superseded']}\n"
+        )
+
         # Топ пользователей
         if stats['top_users']:
             response += "\n🏆 *Топ-5 пользователей:*\n"
             for i, (uid, username, count) in enumerate(stats['top_users'], 1):
-                username_display = f"@{username}" if username else f"ID {uid}"
+                username_display = f"@{escape_markdown(username)}" if username else f"ID {uid}"
                 response += f"{i}. {username_display} - {count} отмазок\n"
 
         await message.answer(response, parse_mode="Markdown")
@@ -363,37 +733,28 @@ async def voice_handler(message: types.Message):
     username = message.from_user.username or "Unknown"
 
     try:
-        await message.answer("🎤 Обрабатываю голосовое сообщение...")
-
-        # Скачиваем голосовое сообщение
         voice = message.voice
-        file = await bot.get_file(voice.file_id)
-        voice_bytes = io.BytesIO()
-        await bot.download_file(file.file_path, voice_bytes)
-        voice_bytes.seek(0)
-
-        # Транскрибируем через OpenAI Whisper API
-        from app.llm_client import get_whisper_client
-        whisper_client = get_whisper_client()
-
-        # Создаем файл с правильным расширением
-        voice_bytes.name = "voice.ogg"
-
-        # Выполняем транскрипцию в executor (синхронный вызов в async)
-        def transcribe():
-            # Не передаём prompt, чтобы избежать его возврата при ошибках
-            # Параметр language="ru" помогает улучшить качество для русского языка
-            return whisper_client.audio.transcriptions.create(
-                model=config.WHISPER_MODEL,  # gpt-4o-mini-transcribe по умолчанию
-                file=voice_bytes,
-                response_format="text",  # Простой текст вместо JSON
-                language="ru"  # Указываем русский язык для лучшего распознавания
+
+        # Слишком длинное или тяжелое голосовое отклоняем до скачивания
+        rejection = check_voice_limits(voice.duration, voice.file_size)
+        if rejection:
+            request_logger.info(
+                f"VOICE_REJECTED | User: {user_id} | Duration: {voice.duration}s | Size: {voice.file_size}"
             )
+            await message.answer(f"🎤 {rejection}\nЗапиши покороче или отправь текстом.")
+            return
 
-        transcription = await asyncio.get_event_loop().run_in_executor(None, transcribe)
+        await message.answer("🎤 Обрабатываю голосовое сообщение...")
+
+        # Скачивание и транскрипция - под собственным лимитом параллельности Whisper
+        async def download(buffer: io.BytesIO):
+            file = await bot.get_file(voice.file_id)
+            await bot.download_file(file.file_path, buffer)
 
-        # При response_format="text" возвращается просто строка
-        transcribed_text = transcription.strip() if isinstance(transcription, str) else transcription.text.strip()
+        # Пересланное или повторное голосовое берется из кэша без скачивания
+        transcribed_text = await transcribe_voice(
+            download, user_id=user_id, file_unique_id=voice.file_unique_id, duration=voice.duration
+        )
 
         # Проверяем, что текст не пустой
         if not transcribed_text:
@@ -416,10 +777,17 @@ async def voice_handler(message: types.Message):
             return
 
         # Сохраняем в кэш для регенерации
-        regenerate_cache[user_id] = {"original_message": transcribed_text}
+        cancel_generation(user_id, reason="new_message")
+        user = await get_user(user_id, username, message.from_user.first_name)
+        regenerate_cache[user_id] = {"original_message": transcribed_text, "lane": user_lane(user)}
+
+        # Конвейер: генерация в ожидаемом стиле идет, пока пользователь смотрит на кнопки
+        ready_style = await start_voice_prefetch(
+            user_id, transcribed_text, user.default_style, user_lane(user)
+        )
 
         # Показываем кнопки выбора стиля
-        keyboard = create_style_keyboard()
+        keyboard = create_style_keyboard(ready_style)
         await message.answer(
             f"🎤 Распознано: _{transcribed_text}_\n\n"
             "Выбери стиль для отмазки:",
@@ -446,8 +814,8 @@ async def message_handler(message: types.Message):
     username = message.from_user.username or "Unknown"
 
     try:
-        # Создаем или обновляем пользователя
-        await db.get_or_create_user(user_id, username, message.from_user.first_name)
+        # Известный пользователь берется из реестра без запроса к БД
+        user = await get_user(user_id, username, message.from_user.first_name)
 
         # Логируем входящее сообщение
         request_logger.info(f"MESSAGE | User: {user_id} (@{username}) | Text: '{message.text[:100]}' | Length: {len(message.text)}")
@@ -461,8 +829,9 @@ async def message_handler(message: types.Message):
             )
             return
 
-        # Сохраняем сообщение для регенерации
-        regenerate_cache[user_id] = {"original_message": message.text}
+        # Сохраняем сообщение для регенерации (генерация по прежней ситуации уже не нужна)
+        cancel_generation(user_id, reason="new_message")
+        regenerate_cache[user_id] = {"original_message": message.text, "lane": user_lane(user)}
 
         # Показываем кнопки выбора стиля
         keyboard = create_style_keyboard()
@@ -473,6 +842,9 @@ async def message_handler(message: types.Message):
 
         logger.info(f"Style selection shown to user {user_id}")
 
+        # Пока пользователь выбирает, генерируем отмазку в его любимом стиле
+        await start_prefetch(user_id, message.text)
+
     except Exception as e:
         error_logger.error(f"ERROR in message_handler | User: {user_id} | Error: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка. Попробуй еще раз или напиши /start")
@@ -521,6 +893,7 @@ async def menu_history_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
     try:
+        await excuse_writer.sync_user(user_id)
         excuses = await db.get_user_history(user_id, limit=20)
 
         if not excuses:
@@ -650,8 +1023,9 @@ async def menu_stats_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
     try:
+        await excuse_writer.sync_user(user_id)
         stats = await db.get_user_stats(user_id)
-        user = await db.get_or_create_user(user_id)
+        user = await get_user(user_id)
 
         response = "📊 *Твоя статистика:*\n\n"
         response += f"🎭 Всего отмазок: {stats['total_excuses']}\n"
@@ -711,6 +1085,10 @@ async def style_callback_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     username = callback.from_user.username or "Unknown"
 
+    # Ответ полезен, пока пользователь его ждет: все запросы к LLM укладываются в дедлайн
+    deadline = new_deadline()
+    task = None
+
     try:
         # Извлекаем выбранный стиль
         selected_style = callback.data.replace("style_", "")
@@ -721,13 +1099,32 @@ async def style_callback_handler(callback: types.CallbackQuery):
             logger.warning(f"No cached message for user {user_id} when selecting style")
             return
 
+        # Повторное нажатие той же кнопки ждет уже идущую генерацию
+        tap_key = (callback.message.message_id, callback.data)
+        if is_duplicate_tap(user_id, tap_key):
+            await callback.answer("⏳ Уже генерирую, секунду...")
+            return
+
+        # Квота проверяется по счетчикам в памяти, без запроса к БД
+        if quota_exceeded(user_id):
+            await callback.answer("⛔ Лимит отмазок на сегодня исчерпан, приходи завтра!", show_alert=True)
+            return
+
         original_message = regenerate_cache[user_id]["original_message"]
 
         # Обрабатываем случайный стиль
         actual_style = selected_style
         if selected_style == "случайный":
+            # Если отмазка в каком-то стиле уже готова или готовится - берем его
             available_styles = [s for s in STYLES.keys() if s != "случайный"]
-            actual_style = random.choice(available_styles)
+            batch = regenerate_cache[user_id].get("batch")
+            if batch:
+                available_styles = list(batch.keys())
+            actual_style = (
+                get_prefetched_style(user_id, original_message)
+                or (warm_pool.available_style(original_message) if config.WARM_POOL_ENABLED else None)
+                or random.choice(available_styles)
+            )
             logger.info(f"Random style selected for user {user_id}: {actual_style}")
 
         # Сохраняем стиль для регенерации
@@ -742,28 +1139,36 @@ async def style_callback_handler(callback: types.CallbackQuery):
         # Формируем промпт для выбранного стиля
         prompt = EXCUSE_PROMPTS[actual_style].format(user_message=original_message)
 
-        # Генерируем отмазку через LLM
+        style_emoji = STYLES[actual_style]["emoji"]
+        style_name = STYLES[actual_style]["name"]
+
+        # Получаем отмазку: из готовых результатов или через LLM
         start_time = time.time()
-        response = await generate_text(prompt, user_id=user_id, style=actual_style)
+        usage = TokenUsage()
+        task = start_generation(user_id, tap_key, obtain_excuse(
+            callback.message, f"Стиль: {style_emoji} {style_name}", prompt, user_id, actual_style,
+            use_pool=selected_style == "случайный", deadline=deadline, usage=usage
+        ))
+        response = await await_generation(task)
+        if response is None:
+            # Пользователь уже выбрал другой стиль - эту отмазку не сохраняем
+            await callback.answer()
+            return
         response_time = time.time() - start_time
 
-        # Сохраняем в БД
-        excuse = await db.create_excuse(
+        # Сохраняем в БД (через буфер пакетной записи, ID выделен сразу)
+        excuse_id = await save_excuse(
             user_id=user_id,
             original_message=original_message,
             style=actual_style,
             generated_text=response,
-            response_time=response_time
+            response_time=response_time,
+            prompt_tokens=usage.prompt_tokens if usage.total else None,
+            completion_tokens=usage.completion_tokens if usage.total else None
         )
 
-        # Проверяем, в избранном ли
-        is_fav = await db.is_favorite(user_id, excuse.id)
-
-        # Отправляем отмазку с кнопками действий
-        style_emoji = STYLES[actual_style]["emoji"]
-        style_name = STYLES[actual_style]["name"]
-
-        keyboard = create_action_keyboard(excuse.id, is_fav)
+        # Отправляем отмазку с кнопками действий (новая отмазка еще не в избранном)
+        keyboard = create_action_keyboard(excuse_id)
 
         await callback.message.edit_text(
             f"*Стиль: {style_emoji} {style_name}*\n\n{response}",
@@ -775,7 +1180,7 @@ async def style_callback_handler(callback: types.CallbackQuery):
         await callback.answer(f"✅ Отмазка готова!")
 
         # Логируем завершение
-        logger.info(f"Excuse {excuse.id} generated for user {user_id} in style {actual_style}")
+        logger.info(f"Excuse {excuse_id} generated for user {user_id} in style {actual_style}")
 
     except Exception as e:
         error_logger.error(f"ERROR in style_callback_handler | User: {user_id} | Error: {e}", exc_info=True)
@@ -784,6 +1189,9 @@ async def style_callback_handler(callback: types.CallbackQuery):
             await callback.message.edit_text("❌ Произошла ошибка. Попробуй еще раз или напиши /start")
         except:
             pass
+    finally:
+        if task is not None:
+            finish_generation(user_id, task)
 
 
 @dp.callback_query(F.data.startswith("rate_"))
@@ -799,11 +1207,14 @@ async def rating_callback_handler(callback: types.CallbackQuery):
 
         rating = 1 if action == "up" else -1
 
-        # Обновляем рейтинг в БД
-        await db.update_excuse_rating(excuse_id, rating)
+        # Обновляем рейтинг в БД (отмазка могла еще лежать в буфере записи)
+        await excuse_writer.sync_user(user_id)
+        is_fav = await db.update_excuse_rating(user_id, excuse_id, rating)
+        if is_fav is None:
+            await callback.answer("❌ Отмазка не найдена")
+            return
 
-        # Обновляем клавиатуру
-        is_fav = await db.is_favorite(user_id, excuse_id)
+        # Обновляем клавиатуру (статус избранного пришел вместе с обновлением)
         keyboard = create_action_keyboard(excuse_id, is_fav)
 
         try:
@@ -832,22 +1243,22 @@ async def favorite_toggle_handler(callback: types.CallbackQuery):
         # Парсим данные: fav_toggle_123
         excuse_id = int(callback.data.split("_")[2])
 
-        # Проверяем текущий статус
-        is_fav = await db.is_favorite(user_id, excuse_id)
+        # Переключаем одним запросом (отмазка могла еще лежать в буфере записи)
+        await excuse_writer.sync_user(user_id)
+        is_fav = await db.toggle_favorite(user_id, excuse_id)
 
+        if is_fav is None:
+            await callback.answer("❌ Не удалось изменить избранное, попробуй еще раз")
+            return
         if is_fav:
-            # Удаляем из избранного
-            await db.remove_from_favorites(user_id, excuse_id)
-            await callback.answer("⭐ Удалено из избранного")
-            logger.info(f"User {user_id} removed excuse {excuse_id} from favorites")
-        else:
-            # Добавляем в избранное
-            await db.add_to_favorites(user_id, excuse_id)
             await callback.answer("⭐ Добавлено в избранное!")
             logger.info(f"User {user_id} added excuse {excuse_id} to favorites")
+        else:
+            await callback.answer("⭐ Удалено из избранного")
+            logger.info(f"User {user_id} removed excuse {excuse_id} from favorites")
 
         # Обновляем клавиатуру
-        keyboard = create_action_keyboard(excuse_id, not is_fav)
+        keyboard = create_action_keyboard(excuse_id, is_fav)
 
         try:
             await callback.message.edit_reply_markup(reply_markup=keyboard)
@@ -898,12 +1309,25 @@ async def regenerate_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     username = callback.from_user.username or "Unknown"
 
+    deadline = new_deadline()
+    task = None
+
     try:
         # Проверяем есть ли кэшированные данные
         if user_id not in regenerate_cache or "style" not in regenerate_cache[user_id]:
             await callback.answer("❌ Данные для регенерации не найдены. Отправь новое сообщение.")
             return
 
+        # Повторное нажатие, пока вариант еще генерируется, не запускает вторую генерацию
+        tap_key = (callback.message.message_id, callback.data)
+        if is_duplicate_tap(user_id, tap_key):
+            await callback.answer("⏳ Уже генерирую, секунду...")
+            return
+
+        if quota_exceeded(user_id):
+            await callback.answer("⛔ Лимит отмазок на сегодня исчерпан, приходи завтра!", show_alert=True)
+            return
+
         original_message = regenerate_cache[user_id]["original_message"]
         style = regenerate_cache[user_id]["style"]
 
@@ -914,28 +1338,38 @@ async def regenerate_handler(callback: types.CallbackQuery):
         # Формируем промпт
         prompt = EXCUSE_PROMPTS[style].format(user_message=original_message)
 
-        # Генерируем новую отмазку
+        style_emoji = STYLES[style]["emoji"]
+        style_name = STYLES[style]["name"]
+
         start_time = time.time()
-        response = await generate_text(prompt, user_id=user_id, style=style)
+        usage = TokenUsage()
+        task = start_generation(user_id, tap_key, regenerate_excuse(
+            callback.message, f"Стиль: {style_emoji} {style_name} 🔄", prompt, user_id, style,
+            deadline=deadline, usage=usage
+        ))
+        response = await await_generation(task)
+        if response is None:
+            # Пользователь уже выбрал другое действие - этот вариант не сохраняем
+            return
         response_time = time.time() - start_time
 
-        # Сохраняем в БД
-        excuse = await db.create_excuse(
+        # Новый вариант пополняет пул кэша для этой ситуации
+        if config.RESPONSE_CACHE_ENABLED and not is_fallback_response(response):
+            response_cache.put(style, original_message, response)
+
+        # Сохраняем в БД (через буфер пакетной записи, ID выделен сразу)
+        excuse_id = await save_excuse(
             user_id=user_id,
             original_message=original_message,
             style=style,
             generated_text=response,
-            response_time=response_time
+            response_time=response_time,
+            prompt_tokens=usage.prompt_tokens if usage.total else None,
+            completion_tokens=usage.completion_tokens if usage.total else None
         )
 
-        # Проверяем избранное
-        is_fav = await db.is_favorite(user_id, excuse.id)
-
-        # Отправляем новую отмазку
-        style_emoji = STYLES[style]["emoji"]
-        style_name = STYLES[style]["name"]
-
-        keyboard = create_action_keyboard(excuse.id, is_fav)
+        # Отправляем новую отмазку (она еще не в избранном)
+        keyboard = create_action_keyboard(excuse_id)
 
         await callback.message.edit_text(
             f"*Стиль: {style_emoji} {style_name}* 🔄\n\n{response}",
@@ -943,12 +1377,15 @@ async def regenerate_handler(callback: types.CallbackQuery):
             parse_mode="Markdown"
         )
 
-        request_logger.info(f"REGENERATE | User: {user_id} (@{username}) | Style: {style} | Excuse: {excuse.id}")
-        logger.info(f"Regenerated excuse {excuse.id} for user {user_id}")
+        request_logger.info(f"REGENERATE | User: {user_id} (@{username}) | Style: {style} | Excuse: {excuse_id}")
+        logger.info(f"Regenerated excuse {excuse_id} for user {user_id}")
 
     except Exception as e:
         error_logger.error(f"Error in regenerate_handler: {e}", exc_info=True)
         await callback.answer("❌ Ошибка при регенерации")
+    finally:
+        if task is not None:
+            finish_generation(user_id, task)
 
 
 # ==================== ЗАПУСК БОТА ====================
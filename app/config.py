@@ -20,12 +20,111 @@ class Config:
     TEMPERATURE: float = 0.7
     RETRY_COUNT: int = 1
 
+    # Дедлайн запроса к LLM: повторы и ожидание в очереди укладываются в него
+    LLM_REQUEST_DEADLINE: float = float(os.getenv("LLM_REQUEST_DEADLINE", "20.0"))
+    LLM_MIN_ATTEMPT_TIME: float = float(os.getenv("LLM_MIN_ATTEMPT_TIME", "1.0"))  # Меньше осталось - не пробуем
+    LLM_ATTEMPT_TIMEOUT: float = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "15.0"))  # Ответ или начало потока, сек
+    LLM_RETRY_BACKOFF_BASE: float = float(os.getenv("LLM_RETRY_BACKOFF_BASE", "0.5"))
+    LLM_RETRY_BACKOFF_CAP: float = float(os.getenv("LLM_RETRY_BACKOFF_CAP", "4.0"))
+
+    # Пул соединений и ограничение параллельных запросов к LLM
+    LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+    LLM_MAX_KEEPALIVE: int = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+    LLM_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "100"))
+
+    # Адаптивный лимит (AIMD): растет на успехах, падает на 429/таймаутах
+    LLM_MIN_CONCURRENCY: int = int(os.getenv("LLM_MIN_CONCURRENCY", "2"))
+    LLM_INITIAL_CONCURRENCY: int = int(os.getenv("LLM_INITIAL_CONCURRENCY", "20"))
+    LLM_MAX_QUEUE_WAIT: float = float(os.getenv("LLM_MAX_QUEUE_WAIT", "5.0"))  # Дольше в очереди - отказ
+    # Доли слотов при очереди: премиум, обычные пользователи, фон (prefetch, пул)
+    LLM_LANE_WEIGHTS: str = os.getenv("LLM_LANE_WEIGHTS", "premium:6,regular:3,background:1")
+
+    # Резервные OpenAI-совместимые провайдеры: "base_url|model[|api_key],..."
+    LLM_FALLBACK_PROVIDERS: str = os.getenv("LLM_FALLBACK_PROVIDERS", "")
+
+    # Circuit breaker на каждого провайдера
+    LLM_BREAKER_WINDOW: int = int(os.getenv("LLM_BREAKER_WINDOW", "20"))  # Последних вызовов в окне
+    LLM_BREAKER_MIN_CALLS: int = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+    LLM_BREAKER_FAILURE_RATE: float = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+    LLM_BREAKER_SLOW_CALL: float = float(os.getenv("LLM_BREAKER_SLOW_CALL", "10.0"))  # Медленнее - считается ошибкой
+    LLM_BREAKER_OPEN_DURATION: float = float(os.getenv("LLM_BREAKER_OPEN_DURATION", "30.0"))  # Пауза до пробы
+
+    # Хеджирование медленных запросов вторым запросом
+    LLM_HEDGING: bool = os.getenv("LLM_HEDGING", "false").lower() == "true"
+    LLM_HEDGE_PERCENTILE: float = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))  # Порог по недавним задержкам
+    LLM_HEDGE_BUDGET: float = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))  # Максимум доли лишних запросов
+    LLM_HEDGE_MIN_SAMPLES: int = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+    LLM_STREAM_USAGE: bool = os.getenv("LLM_STREAM_USAGE", "true").lower() == "true"  # Токены в потоковом ответе
+    LLM_CANDIDATES: int = int(os.getenv("LLM_CANDIDATES", "1"))  # Вариантов за запрос для "Другой вариант"
+    LLM_SINGLE_FLIGHT: bool = os.getenv("LLM_SINGLE_FLIGHT", "true").lower() == "true"  # Объединять одинаковые запросы
+
+    # Потоковая генерация с постепенным обновлением сообщения
+    LLM_STREAMING: bool = os.getenv("LLM_STREAMING", "true").lower() == "true"
+    STREAM_EDIT_INTERVAL: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Лимит Telegram ~1 edit/сек на чат
+
+    # Кэш отмазок по (стиль, ситуация)
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    RESPONSE_CACHE_MAX_BYTES: int = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(5 * 1024 * 1024)))
+    RESPONSE_CACHE_VARIANTS: int = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))  # Вариантов на ключ
+
+    # Предиктивная генерация в любимом стиле, пока показана клавиатура стилей
+    PREFETCH_ENABLED: bool = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"
+    PREFETCH_MAX_IN_FLIGHT: int = int(os.getenv("PREFETCH_MAX_IN_FLIGHT", "10"))  # Общий бюджет
+    PREFETCH_MIN_HISTORY: int = int(os.getenv("PREFETCH_MIN_HISTORY", "5"))  # Минимум отмазок в истории
+    PREFETCH_MIN_SHARE: float = float(os.getenv("PREFETCH_MIN_SHARE", "0.4"))  # Минимальная доля стиля
+    PREFETCH_TTL: float = float(os.getenv("PREFETCH_TTL", "120"))  # Сколько ждать выбора стиля
+    # Голосовые: генерация в стиле пользователя стартует сразу после транскрипции
+    VOICE_PIPELINE_ENABLED: bool = os.getenv("VOICE_PIPELINE_ENABLED", "false").lower() == "true"
+
+    # Генерация всех стилей одним запросом (JSON)
+    BATCH_GENERATION: bool = os.getenv("BATCH_GENERATION", "false").lower() == "true"
+    BATCH_MAX_TOKENS: int = int(os.getenv("BATCH_MAX_TOKENS", "1500"))
+
+    # Пул заранее сгенерированных отмазок для типовых ситуаций
+    WARM_POOL_ENABLED: bool = os.getenv("WARM_POOL_ENABLED", "false").lower() == "true"
+    WARM_POOL_SIZE: int = int(os.getenv("WARM_POOL_SIZE", "3"))  # Отмазок на (стиль, ситуация)
+    WARM_POOL_MAX_SITUATIONS: int = int(os.getenv("WARM_POOL_MAX_SITUATIONS", "50"))
+    WARM_POOL_MAX_AGE: float = float(os.getenv("WARM_POOL_MAX_AGE", str(24 * 3600)))  # Свежесть, сек
+    WARM_POOL_REFILL_CONCURRENCY: int = int(os.getenv("WARM_POOL_REFILL_CONCURRENCY", "2"))
+    WARM_POOL_REFILL_INTERVAL: float = float(os.getenv("WARM_POOL_REFILL_INTERVAL", "300"))
+
+    # Учет токенов и дневные квоты (0 - без ограничений, премиум без квоты)
+    USER_DAILY_TOKEN_QUOTA: int = int(os.getenv("USER_DAILY_TOKEN_QUOTA", "0"))
+    USAGE_FLUSH_INTERVAL: float = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))  # Сброс расхода в БД, сек
+
+    # Отложенная пакетная запись отмазок (ID резервируются блоками из последовательности)
+    EXCUSE_WRITE_BEHIND: bool = os.getenv("EXCUSE_WRITE_BEHIND", "true").lower() == "true"
+    EXCUSE_FLUSH_INTERVAL: float = float(os.getenv("EXCUSE_FLUSH_INTERVAL", "0.5"))  # Сек
+    EXCUSE_FLUSH_BATCH: int = int(os.getenv("EXCUSE_FLUSH_BATCH", "100"))  # Писать раньше при стольких строках
+    EXCUSE_ID_BLOCK: int = int(os.getenv("EXCUSE_ID_BLOCK", "100"))  # ID за один запрос к последовательности
+    EXCUSE_MAX_PENDING: int = int(os.getenv("EXCUSE_MAX_PENDING", "10000"))  # Сверх этого старые строки - в файл
+
+    # Реестр пользователей в памяти: last_active и профиль пишутся в БД пачками
+    USER_REGISTRY_MAX_ENTRIES: int = int(os.getenv("USER_REGISTRY_MAX_ENTRIES", "50000"))
+    USER_REGISTRY_TTL: float = float(os.getenv("USER_REGISTRY_TTL", "600"))  # Перечитать из БД не реже, сек
+    USER_FLUSH_INTERVAL: float = float(os.getenv("USER_FLUSH_INTERVAL", "30"))  # Сброс активности в БД, сек
+
     # Whisper API для транскрипции голосовых сообщений
     # По умолчанию использует те же credentials что и LLM
     # Можно указать отдельные, если Whisper на другом сервере
     WHISPER_API_KEY: str = os.getenv("WHISPER_API_KEY") or os.getenv("OPENROUTER_API_KEY", "")
     WHISPER_BASE_URL: str = os.getenv("WHISPER_BASE_URL") or "https://api.openai.com/v1"  # Стандартный OpenAI endpoint
     WHISPER_MODEL: str = os.getenv("WHISPER_MODEL") or "gpt-4o-mini-transcribe"  # Быстрая и дешевая модель
+    WHISPER_MAX_CONCURRENCY: int = int(os.getenv("WHISPER_MAX_CONCURRENCY", "4"))  # Параллельных транскрипций
+    WHISPER_MAX_DURATION: int = int(os.getenv("WHISPER_MAX_DURATION", "120"))  # Длиннее - отказ до скачивания, сек
+    WHISPER_MAX_FILE_SIZE: int = int(os.getenv("WHISPER_MAX_FILE_SIZE", str(5 * 1024 * 1024)))  # Байт
+    # remote - Whisper API, local - faster-whisper на CPU, auto - короткие локально, длинные в API
+    TRANSCRIPTION_BACKEND: str = os.getenv("TRANSCRIPTION_BACKEND", "remote").lower()
+    LOCAL_WHISPER_MODEL: str = os.getenv("LOCAL_WHISPER_MODEL", "small")  # Модель faster-whisper
+    LOCAL_WHISPER_COMPUTE_TYPE: str = os.getenv("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+    LOCAL_WHISPER_WORKERS: int = int(os.getenv("LOCAL_WHISPER_WORKERS", "2"))  # Процессов с моделью
+    LOCAL_WHISPER_THREADS: int = int(os.getenv("LOCAL_WHISPER_THREADS", "2"))  # Потоков CPU на процесс
+    LOCAL_WHISPER_MAX_DURATION: int = int(os.getenv("LOCAL_WHISPER_MAX_DURATION", "30"))  # auto: до стольки сек - локально
+    TRANSCRIPTION_CACHE_MAX_ENTRIES: int = int(os.getenv("TRANSCRIPTION_CACHE_MAX_ENTRIES", "2000"))  # По file_unique_id
+    TRANSCRIPTION_CACHE_DB: bool = os.getenv("TRANSCRIPTION_CACHE_DB", "false").lower() == "true"  # Хранить в Postgres
     # Примечание: параметр prompt в Whisper используется для контекста, а не для инструкций
     # Оставляем пустым, чтобы избежать возврата промпта при ошибках распознавания
     WHISPER_PROMPT: str = ""
@@ -38,6 +137,11 @@ class Config:
 
     # Admin
     ADMIN_PASSWORD: str = os.getenv("ADMIN_PASSWORD", "")
+    # Статистика /admin: почасовые/дневные сводки отмазок и кэшированный снимок
+    ROLLUP_INTERVAL: float = float(os.getenv("ROLLUP_INTERVAL", "300"))  # Период фоновой агрегации, сек
+    ROLLUP_LOOKBACK_HOURS: int = int(os.getenv("ROLLUP_LOOKBACK_HOURS", "2"))  # Пересчитывать последние N часов
+    ROLLUP_CHUNK_HOURS: int = int(os.getenv("ROLLUP_CHUNK_HOURS", "168"))  # Часов истории за один запрос
+    ADMIN_STATS_TTL: float = float(os.getenv("ADMIN_STATS_TTL", "60"))  # Возраст снимка статистики, сек
 
     # Logging
     LOG_LEVEL: str = "INFO"
@@ -1,16 +1,23 @@
 """
 Database service layer для работы с PostgreSQL
 """
+import asyncio
 import logging
-from datetime import datetime
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from typing import Optional, List
 from contextlib import asynccontextmanager
 
-from sqlalchemy import select, desc, func
+from sqlalchemy import BigInteger, Date, cast, event, select, desc, func, text, exists, literal, delete, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import selectinload
 
-from app.models import Base, User, Excuse, Favorite
+from app.models import (
+    Base, User, Excuse, Favorite, UserStats, UserTokenUsage, VoiceTranscription,
+    ExcuseRollupHourly, ExcuseRollupDaily, AdminCounters
+)
 from app.config import config
 
 logger = logging.getLogger(__name__)
@@ -20,6 +27,49 @@ engine = None
 async_session_maker = None
 
 
+@dataclass
+class UnitOfWork:
+    """Общая сессия и счетчики обращений к БД за обработку одного апдейта"""
+    task: Optional[asyncio.Task] = None  # Задача обработчика апдейта
+    session: Optional[AsyncSession] = None
+    queries: int = 0
+    checkouts: int = 0
+    sessions: int = 0  # Сколько раз открывалась общая сессия
+    closed: bool = False
+
+
+# Единица работы текущего апдейта (задачи, созданные из хендлера, видят ее копию)
+_unit_of_work: ContextVar[Optional[UnitOfWork]] = ContextVar("db_unit_of_work", default=None)
+
+
+def _active_unit_of_work() -> Optional[UnitOfWork]:
+    uow = _unit_of_work.get()
+    return uow if uow is not None and not uow.closed else None
+
+
+def _shared_unit_of_work() -> Optional[UnitOfWork]:
+    """
+    Единица работы, сессию которой можно взять
+
+    Только в задаче обработчика: задачи, запущенные из него (генерация,
+    предзагрузка), работают параллельно и получают собственные сессии.
+    """
+    uow = _active_unit_of_work()
+    return uow if uow is not None and uow.task is asyncio.current_task() else None
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    uow = _active_unit_of_work()
+    if uow is not None:
+        uow.queries += 1
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    uow = _active_unit_of_work()
+    if uow is not None:
+        uow.checkouts += 1
+
+
 async def init_database():
     """Инициализация базы данных"""
     global engine, async_session_maker
@@ -35,6 +85,10 @@ async def init_database():
         max_overflow=20
     )
 
+    # Счетчики запросов и выдач соединений для единицы работы апдейта
+    event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+    event.listen(engine.sync_engine.pool, "checkout", _count_checkout)
+
     # Создаем session maker
     async_session_maker = async_sessionmaker(
         engine,
@@ -57,8 +111,29 @@ async def close_database():
 
 
 @asynccontextmanager
-async def get_session():
-    """Получить сессию БД"""
+async def get_session(independent: bool = False):
+    """
+    Получить сессию БД
+
+    Внутри обработчика апдейта (см. unit_of_work) возвращается общая сессия
+    апдейта: подряд идущие запросы идут в одной транзакции и одном
+    соединении до release_session() или конца обработки. independent=True -
+    отдельная сессия со своим коммитом: для фоновых сбросов буферов и
+    записей, которые должны попасть в БД независимо от исхода апдейта.
+    """
+    uow = None if independent else _shared_unit_of_work()
+    if uow is not None:
+        if uow.session is None:
+            uow.session = async_session_maker()
+            uow.sessions += 1
+        try:
+            yield uow.session
+        except Exception:
+            # Без отката общая сессия непригодна для следующих запросов апдейта
+            await uow.session.rollback()
+            raise
+        return
+
     async with async_session_maker() as session:
         try:
             yield session
@@ -68,11 +143,59 @@ async def get_session():
             raise
 
 
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Общая сессия для запросов к БД при обработке апдейта
+
+    Соединение берется из пула при первом запросе, а не при входе, и
+    возвращается в пул release_session() - перед запросами к Telegram и
+    LLM, - или в конце обработки.
+    """
+    uow = UnitOfWork(task=asyncio.current_task())
+    token = _unit_of_work.set(uow)
+    try:
+        yield uow
+        await release_session()
+    except Exception:
+        if uow.session is not None:
+            await uow.session.rollback()
+        raise
+    finally:
+        uow.closed = True
+        if uow.session is not None:
+            await uow.session.close()
+        _unit_of_work.reset(token)
+
+
+async def release_session():
+    """
+    Закоммитить общую сессию апдейта и вернуть соединение в пул
+
+    Вызывается перед долгими ожиданиями и перед отправкой в Telegram:
+    соединение не простаивает, а строки, на которые ссылаются кнопки
+    сообщения, к моменту отправки уже в БД. Ошибка коммита всплывает до
+    отправки. Следующий запрос апдейта откроет новую сессию.
+    """
+    uow = _shared_unit_of_work()
+    if uow is None or uow.session is None:
+        return
+    session, uow.session = uow.session, None
+    try:
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
 # ==================== USER OPERATIONS ====================
 
 async def get_or_create_user(user_id: int, username: str = None, first_name: str = None) -> User:
     """Получить или создать пользователя"""
-    async with get_session() as session:
+    # Отдельный коммит: строка пользователя нужна до пакетной записи его отмазок
+    async with get_session(independent=True) as session:
         # Проверяем существует ли пользователь
         result = await session.execute(
             select(User).where(User.user_id == user_id)
@@ -100,6 +223,27 @@ async def get_or_create_user(user_id: int, username: str = None, first_name: str
         return user
 
 
+async def upsert_users(rows: list):
+    """
+    Записать профили и last_active пачкой пользователей одним запросом
+
+    Args:
+        rows: [{"user_id", "username", "first_name", "created_at", "last_active"}]
+    """
+    async with get_session(independent=True) as session:
+        stmt = insert(User).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={
+                "username": func.coalesce(stmt.excluded.username, User.username),
+                "first_name": func.coalesce(stmt.excluded.first_name, User.first_name),
+                "last_active": func.greatest(stmt.excluded.last_active, User.last_active)
+            }
+        )
+        await session.execute(stmt)
+        logger.debug(f"Flushed activity for {len(rows)} users")
+
+
 async def update_user_settings(user_id: int, default_style: str = None, is_premium: bool = None):
     """Обновить настройки пользователя"""
     async with get_session() as session:
@@ -123,7 +267,9 @@ async def create_excuse(
     original_message: str,
     style: str,
     generated_text: str,
-    response_time: float = None
+    response_time: float = None,
+    prompt_tokens: int = None,
+    completion_tokens: int = None
 ) -> Excuse:
     """Создать новую отмазку"""
     async with get_session() as session:
@@ -132,7 +278,9 @@ async def create_excuse(
             original_message=original_message,
             style=style,
             generated_text=generated_text,
-            response_time=response_time
+            response_time=response_time,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens
         )
         session.add(excuse)
         await session.flush()  # Получаем ID
@@ -142,6 +290,100 @@ async def create_excuse(
         return excuse
 
 
+async def add_token_usage(rows: list):
+    """
+    Прибавить накопленный расход токенов одним запросом (upsert)
+
+    Args:
+        rows: [(user_id, день, prompt_tokens, completion_tokens)]
+    """
+    async with get_session(independent=True) as session:
+        stmt = insert(UserTokenUsage).values([
+            {"user_id": user_id, "day": day, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+            for user_id, day, prompt_tokens, completion_tokens in rows
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserTokenUsage.user_id, UserTokenUsage.day],
+            set_={
+                "prompt_tokens": UserTokenUsage.prompt_tokens + stmt.excluded.prompt_tokens,
+                "completion_tokens": UserTokenUsage.completion_tokens + stmt.excluded.completion_tokens
+            }
+        )
+        await session.execute(stmt)
+        logger.debug(f"Flushed token usage for {len(rows)} users")
+
+
+async def get_token_usage_by_user(day: date) -> dict:
+    """Расход токенов за день по пользователям: {user_id: токенов}"""
+    async with get_session() as session:
+        result = await session.execute(
+            select(
+                UserTokenUsage.user_id,
+                UserTokenUsage.prompt_tokens + UserTokenUsage.completion_tokens
+            )
+            .where(UserTokenUsage.day == day)
+        )
+        return {user_id: total for user_id, total in result.all()}
+
+
+# ==================== VOICE OPERATIONS ====================
+
+async def get_transcription(file_unique_id: str) -> Optional[str]:
+    """Ранее распознанный текст голосового или None"""
+    # Отдельная сессия: не держим соединение апдейта, пока идет распознавание
+    async with get_session(independent=True) as session:
+        result = await session.execute(
+            select(VoiceTranscription.text).where(VoiceTranscription.file_unique_id == file_unique_id)
+        )
+        return result.scalar_one_or_none()
+
+
+async def save_transcription(file_unique_id: str, text: str, duration: int = None):
+    """Сохранить распознанный текст (повторная запись того же файла игнорируется)"""
+    async with get_session(independent=True) as session:
+        stmt = insert(VoiceTranscription).values(
+            file_unique_id=file_unique_id,
+            text=text,
+            duration=duration,
+            created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=[VoiceTranscription.file_unique_id])
+        await session.execute(stmt)
+
+
+async def reserve_excuse_ids(count: int) -> List[int]:
+    """Зарезервировать блок ID отмазок из последовательности одним запросом"""
+    async with get_session(independent=True) as session:
+        result = await session.execute(
+            text("SELECT nextval('excuses_id_seq') FROM generate_series(1, :count)"),
+            {"count": count}
+        )
+        return [row[0] for row in result.all()]
+
+
+async def add_excuses(rows: list):
+    """
+    Записать пачку отмазок с заранее выделенными ID одним INSERT
+
+    Args:
+        rows: словари с полями Excuse, включая id
+    """
+    async with get_session(independent=True) as session:
+        await session.execute(insert(Excuse).values(rows))
+        logger.info(f"Created {len(rows)} excuses: {rows[0]['id']}..{rows[-1]['id']}")
+
+
+async def get_top_rated_excuses(limit: int = 500) -> List[Excuse]:
+    """Получить последние отмазки с оценкой 👍 (для прогрева пула)"""
+    async with get_session() as session:
+        result = await session.execute(
+            select(Excuse)
+            .where(Excuse.rating == 1)
+            .order_by(desc(Excuse.created_at))
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+
+
 async def get_user_history(user_id: int, limit: int = 10) -> List[Excuse]:
     """Получить историю отмазок пользователя"""
     async with get_session() as session:
@@ -165,21 +407,69 @@ async def get_excuse_by_id(excuse_id: int) -> Optional[Excuse]:
         return result.scalar_one_or_none()
 
 
-async def update_excuse_rating(excuse_id: int, rating: int):
-    """Обновить рейтинг отмазки (1 для 👍, -1 для 👎)"""
+async def update_excuse_rating(user_id: int, excuse_id: int, rating: int) -> Optional[bool]:
+    """
+    Обновить рейтинг отмазки пользователя (1 для 👍, -1 для 👎) одним UPDATE
+
+    Returns:
+        Находится ли отмазка в избранном (для клавиатуры) или None,
+        если отмазки нет или она чужая
+    """
     async with get_session() as session:
         result = await session.execute(
-            select(Excuse).where(Excuse.id == excuse_id)
+            update(Excuse)
+            .where(Excuse.id == excuse_id, Excuse.user_id == user_id)
+            .values(rating=rating)
+            .returning(
+                exists(select(Favorite.id).where(Favorite.user_id == user_id, Favorite.excuse_id == excuse_id))
+            )
         )
-        excuse = result.scalar_one_or_none()
-
-        if excuse:
-            excuse.rating = rating
+        is_fav = result.scalar_one_or_none()
+        if is_fav is not None:
             logger.info(f"Updated rating for excuse {excuse_id}: {rating}")
+        return is_fav
 
 
 # ==================== FAVORITE OPERATIONS ====================
 
+async def toggle_favorite(user_id: int, excuse_id: int) -> Optional[bool]:
+    """
+    Переключить избранное одним запросом (DELETE ... RETURNING, иначе INSERT)
+
+    Returns:
+        True - добавлена, False - удалена, None - отмазки нет, она чужая
+        или избранное одновременно изменил параллельный запрос
+    """
+    async with get_session() as session:
+        deleted = (
+            delete(Favorite)
+            .where(Favorite.user_id == user_id, Favorite.excuse_id == excuse_id)
+            .returning(Favorite.id)
+            .cte("deleted")
+        )
+        inserted = (
+            insert(Favorite)
+            .from_select(
+                ["user_id", "excuse_id", "created_at"],
+                select(literal(user_id, BigInteger), literal(excuse_id), literal(datetime.utcnow()))
+                .where(Excuse.id == excuse_id, Excuse.user_id == user_id, ~exists(select(deleted.c.id)))
+            )
+            .on_conflict_do_nothing(index_elements=[Favorite.user_id, Favorite.excuse_id])
+            .returning(Favorite.id)
+            .cte("inserted")
+        )
+        result = await session.execute(select(exists(select(inserted.c.id)), exists(select(deleted.c.id))))
+        added, removed = result.one()
+
+        if added:
+            logger.info(f"Added excuse {excuse_id} to favorites for user {user_id}")
+            return True
+        if removed:
+            logger.info(f"Removed excuse {excuse_id} from favorites for user {user_id}")
+            return False
+        return None
+
+
 async def add_to_favorites(user_id: int, excuse_id: int) -> bool:
     """Добавить отмазку в избранное"""
     async with get_session() as session:
@@ -246,102 +536,262 @@ async def is_favorite(user_id: int, excuse_id: int) -> bool:
 # ==================== ANALYTICS ====================
 
 async def get_user_stats(user_id: int) -> dict:
-    """Получить статистику пользователя"""
+    """Получить статистику пользователя (одно чтение счетчиков по первичному ключу)"""
     async with get_session() as session:
-        # Количество всего отмазок
-        total_result = await session.execute(
-            select(func.count(Excuse.id))
-            .where(Excuse.user_id == user_id)
-        )
-        total_excuses = total_result.scalar()
+        stats = await session.get(UserStats, user_id)
 
-        # Количество избранных
-        favorites_result = await session.execute(
-            select(func.count(Favorite.id))
-            .where(Favorite.user_id == user_id)
-        )
-        total_favorites = favorites_result.scalar()
+        if stats is None:
+            return {"total_excuses": 0, "total_favorites": 0, "favorite_style": None}
 
         # Самый популярный стиль
-        style_result = await session.execute(
-            select(Excuse.style, func.count(Excuse.id).label('count'))
-            .where(Excuse.user_id == user_id)
-            .group_by(Excuse.style)
-            .order_by(desc('count'))
-            .limit(1)
-        )
-        favorite_style_row = style_result.first()
-        favorite_style = favorite_style_row[0] if favorite_style_row else None
+        style_counts = stats.style_counts or {}
+        favorite_style = max(style_counts, key=style_counts.get) if style_counts else None
 
         return {
-            "total_excuses": total_excuses,
-            "total_favorites": total_favorites,
+            "total_excuses": stats.total_excuses,
+            "total_favorites": stats.total_favorites,
             "favorite_style": favorite_style
         }
 
 
-async def get_admin_stats() -> dict:
+async def get_user_style_distribution(user_id: int, limit: int = 50) -> dict:
     """
-    Получить общую статистику для администратора
+    Распределение стилей среди последних отмазок пользователя
 
     Returns:
-        dict: Словарь со статистикой
+        dict: {стиль: количество} по последним limit отмазкам
     """
     async with get_session() as session:
-        # Общее количество пользователей
-        users_result = await session.execute(
-            select(func.count(User.user_id))
+        recent = (
+            select(Excuse.style)
+            .where(Excuse.user_id == user_id)
+            .order_by(desc(Excuse.created_at))
+            .limit(limit)
+            .subquery()
         )
-        total_users = users_result.scalar()
-
-        # Общее количество сгенерированных отмазок
-        excuses_result = await session.execute(
-            select(func.count(Excuse.id))
+        result = await session.execute(
+            select(recent.c.style, func.count().label('count'))
+            .group_by(recent.c.style)
         )
-        total_excuses = excuses_result.scalar()
+        return {style: count for style, count in result.all()}
+
+
+# ==================== ROLLUPS ====================
+
+_ROLLUP_COUNTERS = (
+    'excuses', 'response_time_sum', 'response_time_count',
+    'token_excuses', 'prompt_tokens', 'completion_tokens'
+)
+
 
-        # Количество избранных
-        favorites_result = await session.execute(
-            select(func.count(Favorite.id))
+def _excuse_counters() -> list:
+    """Агрегаты по excuses в порядке _ROLLUP_COUNTERS"""
+    return [
+        func.count(),
+        func.coalesce(func.sum(Excuse.response_time), 0.0),
+        func.count(Excuse.response_time),
+        func.count(Excuse.prompt_tokens),
+        func.coalesce(func.sum(Excuse.prompt_tokens), 0),
+        func.coalesce(func.sum(Excuse.completion_tokens), 0)
+    ]
+
+
+async def get_rollup_start() -> Optional[datetime]:
+    """
+    С какого часа продолжать агрегацию
+
+    Последний час почасовой сводки, а для пустой сводки - час первой
+    отмазки (min(created_at) читается по индексу ix_excuses_created_at).
+    """
+    async with get_session(independent=True) as session:
+        last_hour = await session.scalar(select(func.max(ExcuseRollupHourly.hour)))
+        if last_hour is not None:
+            return last_hour
+        first_created = await session.scalar(select(func.min(Excuse.created_at)))
+        return first_created.replace(minute=0, second=0, microsecond=0) if first_created else None
+
+
+async def refresh_rollups(start: datetime, end: datetime):
+    """
+    Пересчитать почасовую сводку за [start, end) и дневную за затронутые дни
+
+    Строки окна удаляются и вставляются заново в одной транзакции: пересчет
+    идемпотентен, а читатели видят либо старую, либо новую сводку.
+
+    Args:
+        start: начало окна (ровно час)
+        end: конец окна, не включая
+    """
+    async with get_session(independent=True) as session:
+        hour = func.date_trunc('hour', Excuse.created_at)
+        hourly = (
+            select(hour, Excuse.style, *_excuse_counters())
+            .where(Excuse.created_at >= start, Excuse.created_at < end)
+            .group_by(hour, Excuse.style)
+        )
+        await session.execute(
+            delete(ExcuseRollupHourly)
+            .where(ExcuseRollupHourly.hour >= start, ExcuseRollupHourly.hour < end)
+        )
+        await session.execute(
+            insert(ExcuseRollupHourly).from_select(['hour', 'style', *_ROLLUP_COUNTERS], hourly)
         )
-        total_favorites = favorites_result.scalar()
 
-        # Среднее время генерации
-        avg_time_result = await session.execute(
-            select(func.avg(Excuse.response_time))
-            .where(Excuse.response_time.isnot(None))
+        # Дни окна пересчитываются целиком из почасовой сводки
+        first_day = start.date()
+        last_day = (end - timedelta(microseconds=1)).date()
+        day = cast(func.date_trunc('day', ExcuseRollupHourly.hour), Date)
+        daily = (
+            select(
+                day,
+                ExcuseRollupHourly.style,
+                *[func.sum(getattr(ExcuseRollupHourly, counter)) for counter in _ROLLUP_COUNTERS]
+            )
+            .where(
+                ExcuseRollupHourly.hour >= datetime.combine(first_day, datetime.min.time()),
+                ExcuseRollupHourly.hour < end
+            )
+            .group_by(day, ExcuseRollupHourly.style)
+        )
+        await session.execute(
+            delete(ExcuseRollupDaily)
+            .where(ExcuseRollupDaily.day >= first_day, ExcuseRollupDaily.day <= last_day)
+        )
+        await session.execute(
+            insert(ExcuseRollupDaily).from_select(['day', 'style', *_ROLLUP_COUNTERS], daily)
         )
-        avg_response_time = avg_time_result.scalar()
 
-        # Самые активные пользователи (топ-5)
-        top_users_result = await session.execute(
+
+def _add_counters(by_style: dict, rows: list, sign: int = 1):
+    """Прибавить строки (стиль, *_ROLLUP_COUNTERS) к итогам по стилям"""
+    for style, *values in rows:
+        counters = by_style.setdefault(style, dict.fromkeys(_ROLLUP_COUNTERS, 0))
+        for counter, value in zip(_ROLLUP_COUNTERS, values):
+            # SUM по bigint приходит как Decimal
+            value = float(value) if counter == 'response_time_sum' else int(value)
+            counters[counter] += sign * value
+
+
+async def get_admin_stats(now: datetime = None) -> dict:
+    """
+    Получить общую статистику для администратора
+
+    Отмазки и токены считаются по дневной сводке (app/rollups.py), в
+    которой последний час сводки заменяется живым агрегатом по excuses с
+    начала этого часа - хвост, который агрегация еще не догнала. Пока
+    сводки пусты (первое заполнение), отмазки не считаются. Токены - только
+    ушедшие на сохраненные отмазки. Пользователи и избранное - из
+    admin_counters, которые ведут триггеры.
+
+    Returns:
+        dict: Словарь со статистикой, включая объем по часам за сутки
+        и динамику стилей по дням за неделю
+    """
+    now = now or datetime.utcnow()
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
+    hours = [current_hour - timedelta(hours=i) for i in range(23, -1, -1)]
+    days = [now.date() - timedelta(days=i) for i in range(6, -1, -1)]
+
+    # Независимая сессия: снимок может собираться в фоне, пока апдейт держит свою
+    async with get_session(independent=True) as session:
+        # Пользователи и избранное - сумма шардов счетчиков
+        totals_result = await session.execute(
             select(
-                User.user_id,
-                User.username,
-                func.count(Excuse.id).label('excuse_count')
+                func.coalesce(func.sum(AdminCounters.total_users), 0),
+                func.coalesce(func.sum(AdminCounters.total_favorites), 0)
             )
-            .join(Excuse, User.user_id == Excuse.user_id)
-            .group_by(User.user_id, User.username)
-            .order_by(desc('excuse_count'))
+        )
+        total_users, total_favorites = (int(value) for value in totals_result.one())
+
+        # Самые активные пользователи (топ-5) - по индексу user_stats.total_excuses
+        top_users_result = await session.execute(
+            select(User.user_id, User.username, UserStats.total_excuses)
+            .join(UserStats, User.user_id == UserStats.user_id)
+            .where(UserStats.total_excuses > 0)
+            .order_by(desc(UserStats.total_excuses))
             .limit(5)
         )
         top_users = top_users_result.all()
 
-        # Самый популярный стиль
-        style_result = await session.execute(
-            select(Excuse.style, func.count(Excuse.id).label('count'))
-            .group_by(Excuse.style)
-            .order_by(desc('count'))
-            .limit(1)
+        # Итоги по стилям за все время: строк в дневной сводке - дни x стили
+        styles_result = await session.execute(
+            select(
+                ExcuseRollupDaily.style,
+                *[func.sum(getattr(ExcuseRollupDaily, counter)) for counter in _ROLLUP_COUNTERS]
+            )
+            .group_by(ExcuseRollupDaily.style)
         )
-        popular_style_row = style_result.first()
-        popular_style = popular_style_row[0] if popular_style_row else None
+        by_style = {}
+        _add_counters(by_style, styles_result.all())
+
+        # Хвост: последний час сводки пересчитывается по excuses (индекс по created_at)
+        last_hour = await session.scalar(select(func.max(ExcuseRollupHourly.hour)))
+        if last_hour is not None:
+            rolled_result = await session.execute(
+                select(
+                    ExcuseRollupHourly.style,
+                    *[getattr(ExcuseRollupHourly, counter) for counter in _ROLLUP_COUNTERS]
+                )
+                .where(ExcuseRollupHourly.hour == last_hour)
+            )
+            _add_counters(by_style, rolled_result.all(), sign=-1)
+            tail_result = await session.execute(
+                select(Excuse.style, *_excuse_counters())
+                .where(Excuse.created_at >= last_hour)
+                .group_by(Excuse.style)
+            )
+            _add_counters(by_style, tail_result.all())
 
-        return {
-            "total_users": total_users,
-            "total_excuses": total_excuses,
-            "total_favorites": total_favorites,
-            "avg_response_time": round(avg_response_time, 2) if avg_response_time else None,
-            "top_users": [(user_id, username or "Unknown", count) for user_id, username, count in top_users],
-            "popular_style": popular_style
-        }
+        # Объем отмазок по часам за последние сутки
+        hourly_result = await session.execute(
+            select(ExcuseRollupHourly.hour, func.sum(ExcuseRollupHourly.excuses))
+            .where(ExcuseRollupHourly.hour >= hours[0])
+            .group_by(ExcuseRollupHourly.hour)
+        )
+        per_hour = dict(hourly_result.all())
+
+        # Динамика стилей по дням за неделю
+        trend_result = await session.execute(
+            select(ExcuseRollupDaily.day, ExcuseRollupDaily.style, ExcuseRollupDaily.excuses)
+            .where(ExcuseRollupDaily.day >= days[0])
+        )
+        per_day_style = {(day, style): count for day, style, count in trend_result.all()}
+
+    by_style = {style: counters for style, counters in by_style.items() if counters['excuses'] > 0}
+    total_excuses = sum(counters['excuses'] for counters in by_style.values())
+    response_time_count = sum(counters['response_time_count'] for counters in by_style.values())
+    avg_response_time = (
+        sum(counters['response_time_sum'] for counters in by_style.values()) / response_time_count
+        if response_time_count else None
+    )
+    popular_style = max(by_style, key=lambda style: by_style[style]['excuses']) if by_style else None
+    total_prompt_tokens = sum(counters['prompt_tokens'] for counters in by_style.values())
+    total_completion_tokens = sum(counters['completion_tokens'] for counters in by_style.values())
+
+    # Средний расход токенов на отмазку по стилям
+    tokens_by_style = sorted(
+        (
+            (style, round((counters['prompt_tokens'] + counters['completion_tokens']) / counters['token_excuses']))
+            for style, counters in by_style.items() if counters['token_excuses']
+        ),
+        key=lambda item: -item[1]
+    )
+
+    style_trend = {
+        style: [per_day_style.get((day, style), 0) for day in days]
+        for style in sorted({style for _, style in per_day_style})
+    }
+
+    return {
+        "total_users": total_users,
+        "total_excuses": total_excuses,
+        "total_favorites": total_favorites,
+        "avg_response_time": round(avg_response_time, 2) if avg_response_time else None,
+        "top_users": [(user_id, username or "Unknown", count) for user_id, username, count in top_users],
+        "popular_style": popular_style,
+        "total_prompt_tokens": total_prompt_tokens,
+        "total_completion_tokens": total_completion_tokens,
+        "tokens_by_style": tokens_by_style,
+        "hourly_volume": [(hour, per_hour.get(hour, 0)) for hour in hours],
+        "style_trend": style_trend
+    }
@@ -0,0 +1,265 @@
+"""
+Отложенная пакетная запись отмазок в БД (write-behind)
+
+ID отмазки нужен сразу - на нем построены кнопки оценки и избранного, -
+поэтому ID заранее резервируются из последовательности блоками, а сами
+строки копятся в буфере и пишутся одним многострочным INSERT по таймеру
+или при заполнении пачки. Перед чтением отмазок пользователя (оценка,
+избранное, история) его строки из буфера дописываются в БД.
+
+Пачка, которую БД отвергла из-за данных, делится пополам до отдельных
+строк: хорошие строки записываются, плохие уходят в UNSAVED_EXCUSES_PATH.
+При недоступной БД строки ждут в буфере, но не больше EXCUSE_MAX_PENDING -
+самые старые сверх лимита тоже сохраняются в файл.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app.config import config
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+# Куда сохранить строки, которые не удалось записать при остановке
+UNSAVED_EXCUSES_PATH = "logs/unsaved_excuses.jsonl"
+
+
+class ExcuseWriter:
+    """Буфер новых отмазок с заранее выделенными ID"""
+
+    def __init__(self, batch_size: int, id_block: int, max_pending: int):
+        self.batch_size = batch_size
+        self.id_block = id_block
+        self.max_pending = max_pending
+
+        self._ids = deque()
+        self._pending = []  # Строки для INSERT в порядке создания
+        self._pending_users = {}  # {user_id: строк в буфере}
+        self._id_lock = None
+        self._flush_lock = None
+        self._flush_requested = None
+
+        self.written = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.rejected = 0  # Строки, которые БД не принимает
+        self.spilled = 0  # Строки, вытесненные из переполненного буфера
+
+    def _locks(self):
+        # Примитивы asyncio создаются в работающем event loop
+        if self._id_lock is None:
+            self._id_lock = asyncio.Lock()
+            self._flush_lock = asyncio.Lock()
+            self._flush_requested = asyncio.Event()
+
+    async def _next_id(self) -> int:
+        """ID из зарезервированного блока (за новым блоком - один запрос к БД)"""
+        self._locks()
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    self._ids.extend(await db.reserve_excuse_ids(self.id_block))
+        return self._ids.popleft()
+
+    async def add(
+        self,
+        user_id: int,
+        original_message: str,
+        style: str,
+        generated_text: str,
+        response_time: float = None,
+        prompt_tokens: int = None,
+        completion_tokens: int = None
+    ) -> int:
+        """
+        Поставить отмазку в очередь на запись
+
+        Returns:
+            ID отмазки (уже зарезервирован в последовательности)
+        """
+        excuse_id = await self._next_id()
+        self._pending.append({
+            "id": excuse_id,
+            "user_id": user_id,
+            "original_message": original_message,
+            "style": style,
+            "generated_text": generated_text,
+            "created_at": datetime.utcnow(),
+            "response_time": response_time,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens
+        })
+        self._pending_users[user_id] = self._pending_users.get(user_id, 0) + 1
+        if len(self._pending) > self.max_pending:
+            self._spill(len(self._pending) - self.max_pending)
+        if len(self._pending) >= self.batch_size:
+            self._flush_requested.set()
+        return excuse_id
+
+    def _spill(self, count: int):
+        """Переполнение при недоступной БД: самые старые строки - в файл"""
+        rows = self._pending[:count]
+        self._pending = self._pending[count:]
+        self._forget(rows)
+        self.spilled += len(rows)
+        _append_rows(UNSAVED_EXCUSES_PATH, rows)
+        error_logger.error(f"Excuse buffer over {self.max_pending} rows: {len(rows)} saved to {UNSAVED_EXCUSES_PATH}")
+
+    def _forget(self, rows: list):
+        """Строки больше не ждут записи (записаны или сохранены в файл)"""
+        for row in rows:
+            left = self._pending_users[row["user_id"]] - 1
+            if left:
+                self._pending_users[row["user_id"]] = left
+            else:
+                del self._pending_users[row["user_id"]]
+
+    async def wait_for_batch(self, timeout: float):
+        """Подождать, пока наберется полная пачка, но не дольше timeout"""
+        self._locks()
+        try:
+            await asyncio.wait_for(self._flush_requested.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._flush_requested.clear()
+
+    def has_pending(self, user_id: int) -> bool:
+        return user_id in self._pending_users
+
+    async def flush(self) -> bool:
+        """
+        Записать буфер одним INSERT
+
+        Returns:
+            False, если запись не удалась (строки остаются в буфере)
+        """
+        self._locks()
+        async with self._flush_lock:
+            rows = self._pending
+            if not rows:
+                return True
+            self._pending = []
+            written, rejected = [], []
+            ok = True
+            try:
+                await self._write(rows, written, rejected)
+                self.batches += 1
+            except Exception as e:
+                # БД недоступна: незаписанное возвращается в начало буфера
+                done = {row["id"] for row in written + rejected}
+                self._pending = [row for row in rows if row["id"] not in done] + self._pending
+                self.failed_batches += 1
+                error_logger.error(f"Excuse flush failed ({len(rows) - len(done)} rows): {e}", exc_info=True)
+                ok = False
+
+            self._forget(written + rejected)
+            self.written += len(written)
+            if rejected:
+                self.rejected += len(rejected)
+                _append_rows(UNSAVED_EXCUSES_PATH, rejected)
+            return ok
+
+    async def _write(self, rows: list, written: list, rejected: list):
+        """Записать строки, деля пачку пополам, пока БД отвергает данные"""
+        try:
+            await db.add_excuses(rows)
+        except (IntegrityError, DataError) as e:
+            if len(rows) == 1:
+                rejected.extend(rows)
+                error_logger.error(f"Excuse {rows[0]['id']} rejected by DB, saved to {UNSAVED_EXCUSES_PATH}: {e}")
+                return
+            middle = len(rows) // 2
+            await self._write(rows[:middle], written, rejected)
+            await self._write(rows[middle:], written, rejected)
+            return
+        written.extend(rows)
+
+    async def sync_user(self, user_id: int):
+        """Дописать отмазки пользователя перед тем, как читать их из БД"""
+        if self.has_pending(user_id):
+            await self.flush()
+
+    def dump_pending(self, path: str):
+        """Сохранить незаписанные строки в файл, чтобы их можно было догрузить вручную"""
+        _append_rows(path, self._pending)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "reserved_ids": len(self._ids),
+            "written": self.written,
+            "batches": self.batches,
+            "avg_batch": round(self.written / self.batches, 1) if self.batches else 0.0,
+            "failed_batches": self.failed_batches,
+            "rejected": self.rejected,
+            "spilled": self.spilled
+        }
+
+
+def _append_rows(path: str, rows: list):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+
+excuse_writer = ExcuseWriter(
+    batch_size=config.EXCUSE_FLUSH_BATCH,
+    id_block=config.EXCUSE_ID_BLOCK,
+    max_pending=config.EXCUSE_MAX_PENDING
+)
+
+_flush_task = None
+
+
+async def save_excuse(**fields) -> int:
+    """Сохранить отмазку и вернуть ее ID (через буфер или сразу, если write-behind выключен)"""
+    if config.EXCUSE_WRITE_BEHIND:
+        return await excuse_writer.add(**fields)
+    excuse = await db.create_excuse(**fields)
+    return excuse.id
+
+
+async def _flush_loop():
+    """Писать буфер по таймеру или раньше, если набралась полная пачка"""
+    while True:
+        await excuse_writer.wait_for_batch(config.EXCUSE_FLUSH_INTERVAL)
+        # Остановка не обрывает начатый INSERT: финальный сброс дождется его под локом
+        await asyncio.shield(excuse_writer.flush())
+
+
+def start_excuse_writer():
+    """Запустить фоновую запись буфера отмазок"""
+    global _flush_task
+    if config.EXCUSE_WRITE_BEHIND:
+        _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_excuse_writer():
+    """Остановить фоновую запись и дописать буфер (при неудаче - в файл)"""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+
+    for attempt in range(3):
+        if await excuse_writer.flush():
+            logger.info("Excuse buffer flushed")
+            return
+        await asyncio.sleep(1.0 * (attempt + 1))
+
+    excuse_writer.dump_pending(UNSAVED_EXCUSES_PATH)
+    error_logger.error(
+        f"Excuse buffer not flushed: {excuse_writer.stats()['pending']} rows saved to {UNSAVED_EXCUSES_PATH}"
+    )
@@ -0,0 +1,211 @@
+"""
+Адаптивный лимит параллельных запросов к LLM (AIMD) с приоритетными очередями
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: платные пользователи, обычные, фоновая работа (prefetch, пул)
+PREMIUM = "premium"
+REGULAR = "regular"
+BACKGROUND = "background"
+LANES = (PREMIUM, REGULAR, BACKGROUND)
+
+# Событие "слот получен" для задачи-владельца (наследуется дочерними задачами):
+# по нему предзагрузка понимает, что еще стоит в очереди, а не генерирует
+slot_acquired: contextvars.ContextVar[Optional[asyncio.Event]] = contextvars.ContextVar(
+    "slot_acquired", default=None
+)
+
+
+def parse_lane_weights(spec: str) -> dict:
+    """
+    Разобрать веса полос из строки вида "premium:6,regular:3,background:1"
+
+    Неизвестные полосы игнорируются, пропущенные получают вес 1.
+    """
+    weights = {lane: 1 for lane in LANES}
+    for item in spec.split(","):
+        lane, _, weight = item.partition(":")
+        lane = lane.strip()
+        if lane in weights and weight.strip().isdigit():
+            weights[lane] = max(1, int(weight))
+    return weights
+
+
+def _notify_acquired():
+    event = slot_acquired.get()
+    if event is not None:
+        event.set()
+
+
+class LLMOverloadedError(Exception):
+    """Запрос не дождался свободного слота к LLM за отведенное время"""
+    pass
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель параллелизма с AIMD-регулировкой лимита
+
+    Успешный ответ увеличивает лимит примерно на 1 за "окно" запросов
+    (additive increase), 429 или таймаут уменьшают его в backoff раз
+    (multiplicative decrease, не чаще раза в cooldown секунд). Запросы
+    сверх лимита ждут не дольше max_wait в FIFO очереди своей полосы.
+    Освободившиеся слоты делятся между полосами по весам (smooth weighted
+    round-robin): под нагрузкой фон уступает первым, но не голодает.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        backoff: float = 0.5,
+        cooldown: float = 1.0,
+        lane_weights: dict = None
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self.lane_weights = lane_weights or {lane: 1 for lane in LANES}
+        self._waiters = {lane: deque() for lane in LANES}
+        self._lane_credit = {lane: 0 for lane in LANES}
+        self._last_decrease = 0.0
+        self._recent_waits = deque(maxlen=1000)
+        self._lane_waits = {lane: deque(maxlen=1000) for lane in LANES}
+        self._lane_served = {lane: 0 for lane in LANES}
+
+        self.max_queue_depth = 0
+        self.rejected = 0
+        self.decreases = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def is_saturated(self) -> bool:
+        """Все слоты заняты или уже есть очередь"""
+        return self.queue_depth > 0 or self.in_flight >= int(self.limit)
+
+    def _next_lane(self) -> str:
+        """Выбрать полосу для следующего слота (smooth weighted round-robin по непустым полосам)"""
+        ready = [lane for lane in LANES if self._waiters[lane]]
+        if len(ready) == 1:
+            return ready[0]
+        total = 0
+        for lane in ready:
+            self._lane_credit[lane] += self.lane_weights[lane]
+            total += self.lane_weights[lane]
+        lane = max(ready, key=lambda name: self._lane_credit[name])
+        self._lane_credit[lane] -= total
+        return lane
+
+    def _wake(self):
+        """Отдать освободившиеся слоты ожидающим с учетом весов полос"""
+        while self.queue_depth and self.in_flight < int(self.limit):
+            waiter = self._waiters[self._next_lane()].popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, max_wait: float, lane: str = REGULAR):
+        """
+        Занять слот, при необходимости подождав в очереди своей полосы
+
+        Raises:
+            LLMOverloadedError: если слот не освободился за max_wait секунд
+        """
+        if self.queue_depth == 0 and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._record_wait(lane, 0.0)
+            _notify_acquired()
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        started = time.monotonic()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Слот успели выдать одновременно с отменой - возвращаем его
+                self._release_slot()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise LLMOverloadedError(f"No LLM slot within {max_wait:.1f}s") from None
+            raise
+        finally:
+            self._record_wait(lane, time.monotonic() - started)
+            if waiter in self._waiters[lane]:
+                self._waiters[lane].remove(waiter)
+        _notify_acquired()
+
+    def _record_wait(self, lane: str, wait: float):
+        self._recent_waits.append(wait)
+        self._lane_waits[lane].append(wait)
+        self._lane_served[lane] += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def release(self, outcome: str = "success"):
+        """
+        Освободить слот и скорректировать лимит
+
+        Args:
+            outcome: "success", "overload" (429/таймаут) или "error" (не влияет на лимит)
+        """
+        if outcome == "success":
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        elif outcome == "overload":
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+                self.decreases += 1
+                logger.warning(f"LLM concurrency limit decreased to {int(self.limit)}")
+        self._release_slot()
+
+    def stats(self) -> dict:
+        """Метрики лимита и очереди"""
+        return dict(
+            _wait_stats(self._recent_waits),
+            limit=int(self.limit),
+            in_flight=self.in_flight,
+            queue_depth=self.queue_depth,
+            max_queue_depth=self.max_queue_depth,
+            rejected=self.rejected,
+            decreases=self.decreases,
+            lanes={
+                lane: dict(
+                    _wait_stats(self._lane_waits[lane]),
+                    queue_depth=len(self._waiters[lane]),
+                    served=self._lane_served[lane]
+                )
+                for lane in LANES
+            }
+        )
+
+
+def _wait_stats(recent_waits: deque) -> dict:
+    """Среднее и p95 времени ожидания слота"""
+    waits = sorted(recent_waits)
+    return {
+        "avg_wait": round(sum(waits) / len(waits), 3) if waits else 0.0,
+        "p95_wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0
+    }
@@ -3,149 +3,777 @@
 """
 import asyncio
 import logging
+import json
+import random
 import time
+from collections import deque
+from typing import AsyncIterator, List, Optional
+import httpx
 import openai
 from app.config import config
+from app.prompts import EXCUSE_PROMPTS, BATCH_EXCUSE_PROMPT
+from app.limiter import AdaptiveLimiter, LLMOverloadedError, REGULAR
+from app.usage import TokenUsage, quota_tracker
+from app.providers import Provider, get_providers, pick_provider, record_result, close_providers
 
 logger = logging.getLogger(__name__)
 error_logger = logging.getLogger("error")
 request_logger = logging.getLogger("requests")
 
 # Ленивая инициализация клиентов
-_llm_client = None
 _whisper_client = None
 
-def get_client():
-    """Получить OpenAI клиент для LLM с ленивой инициализацией"""
-    global _llm_client
-    if _llm_client is None:
-        logger.info(f"Initializing LLM client: {config.LLM_BASE_URL}")
-        logger.info(f"LLM API key length: {len(config.OPENROUTER_API_KEY)}")
-
-        _llm_client = openai.OpenAI(
-            base_url=config.LLM_BASE_URL,
-            api_key=config.OPENROUTER_API_KEY,
-            timeout=15.0,   # Разумный timeout
-            max_retries=0   # Собственная retry логика
-        )
-    return _llm_client
+# Single-flight: запросы с одинаковым промптом, которые выполняются прямо сейчас
+_inflight = {}          # {(prompt, lane): asyncio.Future}
+_flight_waiters = {}    # {asyncio.Future: количество ожидающих}
+_singleflight_stats = {"leaders": 0, "coalesced": 0}
+
+# Хеджирование: недавние задержки успешных запросов и счетчики
+_recent_latencies = deque(maxlen=500)
+_hedge_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "over_budget": 0}
+
+def get_client() -> openai.AsyncOpenAI:
+    """Получить общий async клиент основного LLM провайдера (пул keep-alive соединений)"""
+    return get_providers()[0].client
+
+
+def get_llm_limiter() -> AdaptiveLimiter:
+    """Адаптивный лимит одновременных запросов к основному провайдеру"""
+    return get_providers()[0].limiter
+
+
+def get_limiter_stats() -> dict:
+    """Метрики лимита и очереди запросов к основному провайдеру"""
+    return get_llm_limiter().stats()
+
+
+def is_llm_saturated() -> bool:
+    """У всех доступных провайдеров заняты все слоты (или доступных нет)"""
+    return all(p.limiter.is_saturated() for p in get_providers() if p.breaker.allow_request())
+
+
+def is_overload_error(error: Exception) -> bool:
+    """429 или таймаут - сигнал, что провайдер перегружен"""
+    if isinstance(error, (asyncio.TimeoutError, openai.RateLimitError, openai.APITimeoutError)):
+        return True
+    error_str = str(error).lower()
+    return "rate limit" in error_str or "429" in error_str
 
 
-def get_whisper_client():
-    """Получить OpenAI клиент для Whisper API с ленивой инициализацией"""
+async def close_clients():
+    """Закрыть пулы соединений LLM провайдеров и Whisper"""
+    global _whisper_client
+    await close_providers()
+    if _whisper_client is not None:
+        await _whisper_client.close()
+        _whisper_client = None
+
+
+def get_whisper_client() -> openai.AsyncOpenAI:
+    """Получить async клиент для Whisper API с ленивой инициализацией (свой пул соединений)"""
     global _whisper_client
     if _whisper_client is None:
         logger.info(f"Initializing Whisper client: {config.WHISPER_BASE_URL}")
         logger.info(f"Whisper API key length: {len(config.WHISPER_API_KEY)}")
 
-        _whisper_client = openai.OpenAI(
+        _whisper_client = openai.AsyncOpenAI(
             base_url=config.WHISPER_BASE_URL,
             api_key=config.WHISPER_API_KEY,
             timeout=30.0,   # Whisper может быть медленнее
-            max_retries=1
+            max_retries=1,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=config.WHISPER_MAX_CONCURRENCY,
+                    max_keepalive_connections=config.WHISPER_MAX_CONCURRENCY
+                ),
+                timeout=httpx.Timeout(30.0, connect=5.0)
+            )
         )
     return _whisper_client
 
 
-async def generate_text(prompt: str, user_id: int = None, style: str = "unknown") -> str:
+# Fallback ответы для разных ошибок
+FALLBACK_RESPONSES = {
+    "timeout": [
+        "Сервер медленно отвечает, попробуйте еще раз",
+        "Запрос занимает слишком много времени",
+        "Timeout ошибка, повторите запрос"
+    ],
+    "api_error": [
+        "Произошла ошибка API, попробуйте позже", 
+        "Сервис временно недоступен",
+        "Техническая ошибка, повторите попытку"
+    ],
+    "rate_limit": [
+        "Слишком много запросов, подождите минуту",
+        "Превышен лимит запросов, попробуйте позже"
+    ],
+    "overloaded": [
+        "Сейчас очень много желающих отмазаться, попробуйте через минуту",
+        "Генератор отмазок перегружен, повторите чуть позже"
+    ]
+}
+
+
+def is_fallback_response(text: str) -> bool:
+    """Проверить, является ли текст fallback сообщением об ошибке"""
+    return any(text in responses for responses in FALLBACK_RESPONSES.values())
+
+
+def new_deadline() -> float:
+    """Абсолютный дедлайн (time.monotonic) для запроса, начатого сейчас"""
+    return time.monotonic() + config.LLM_REQUEST_DEADLINE
+
+
+def _remaining(deadline: float) -> float:
+    """Сколько секунд осталось до дедлайна (не меньше нуля)"""
+    return max(0.0, deadline - time.monotonic())
+
+
+def log_event(target: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """Записать структурированное событие одной JSON-строкой"""
+    target.log(level, json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+
+def classify_error(error: Exception) -> str:
     """
-    Генерация текста через OpenRouter с retry логикой и логированием
+    Тип ошибки для политики повторов
+
+    Returns:
+        "timeout", "rate_limit", "server_error" (5xx и сеть) или "client_error" (4xx, повтор бесполезен)
+    """
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError)):
+        return "timeout"
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code == 429:
+            return "rate_limit"
+        if 400 <= error.status_code < 500:
+            return "client_error"
+        return "server_error"
+    if is_overload_error(error):
+        return "rate_limit"
+    return "server_error"
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Значение заголовка Retry-After в секундах, если провайдер его прислал"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.headers.get("retry-after", "")))
+    except (TypeError, ValueError):
+        return None
+
+
+def _record_usage(api_usage, user_id: Optional[int], usage: Optional[TokenUsage]):
+    """Учесть токены ответа API: в счетчике генерации и в дневной квоте пользователя"""
+    if api_usage is None:
+        return
+    prompt_tokens = api_usage.prompt_tokens or 0
+    completion_tokens = api_usage.completion_tokens or 0
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens)
+    if user_id is not None:
+        quota_tracker.record(user_id, prompt_tokens, completion_tokens)
+
+
+async def _attempt(
+    provider: Provider, prompt: str, max_tokens: int, deadline: float, n: int = 1, lane: str = REGULAR
+):
+    """
+    Одна попытка запроса к провайдеру: слот лимитера, запрос, учет результата
+
+    Ожидание в очереди и таймаут запроса ограничены оставшимся до deadline временем.
+
+    Returns:
+        (ответ API, провайдер)
+    """
+    # Ждем свободный слот: лучше постоять в очереди, чем сразу отказать
+    await provider.limiter.acquire(min(config.LLM_MAX_QUEUE_WAIT, _remaining(deadline)), lane)
+    request_start = time.time()
+    try:
+        # Нативный async запрос: поток не блокируется, соединение берется из пула
+        response = await asyncio.wait_for(
+            provider.client.chat.completions.create(
+                model=provider.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens or config.MAX_TOKENS,
+                temperature=config.TEMPERATURE,
+                n=n
+            ),
+            timeout=min(config.LLM_ATTEMPT_TIMEOUT, _remaining(deadline))
+        )
+    except BaseException as e:
+        # Отмена (например, проигравший hedge-запрос) не считается ошибкой провайдера
+        provider.limiter.release("overload" if isinstance(e, Exception) and is_overload_error(e) else "error")
+        if isinstance(e, Exception):
+            record_result(provider, success=False, latency=time.time() - request_start)
+        raise
+
+    latency = time.time() - request_start
+    provider.limiter.release("success")
+    record_result(provider, success=True, latency=latency)
+    _recent_latencies.append(latency)
+    return response, provider
+
+
+def _hedge_delay() -> Optional[float]:
+    """Задержка перед hedge-запросом: перцентиль недавних задержек или None, если хеджировать нельзя"""
+    if not config.LLM_HEDGING or len(_recent_latencies) < config.LLM_HEDGE_MIN_SAMPLES:
+        return None
+    if _hedge_stats["hedged"] >= config.LLM_HEDGE_BUDGET * _hedge_stats["requests"]:
+        _hedge_stats["over_budget"] += 1
+        return None
+    latencies = sorted(_recent_latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * config.LLM_HEDGE_PERCENTILE))]
+
+
+async def _hedged_attempt(
+    provider: Provider, prompt: str, max_tokens: int, deadline: float, n: int = 1, lane: str = REGULAR
+):
+    """
+    Попытка с хеджированием хвостовых задержек
+
+    Если ответ не пришел за перцентиль недавних задержек, отправляется
+    второй запрос (к резервному провайдеру, если он доступен). Берется
+    первый успешный ответ, проигравший запрос отменяется.
+    """
+    _hedge_stats["requests"] += 1
+    first = asyncio.ensure_future(_attempt(provider, prompt, max_tokens, deadline, n, lane))
+    delay = _hedge_delay()
+    if delay is None:
+        return await first
+
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            hedge_provider = pick_provider(exclude={provider.name}) or provider
+            _hedge_stats["hedged"] += 1
+            logger.info(f"Hedging slow LLM request after {delay:.2f}s to {hedge_provider.name}")
+            second = asyncio.ensure_future(_attempt(hedge_provider, prompt, max_tokens, deadline, n, lane))
+            tasks.add(second)
+
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        _hedge_stats["hedge_wins"] += 1
+                    return task.result()
+            if not tasks:
+                # Оба запроса упали - отдаем ошибку первого
+                return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _request_choices(
+    prompt: str, user_id: int = None, style: str = "unknown", max_tokens: int = None,
+    deadline: float = None, n: int = 1, lane: str = REGULAR, usage: TokenUsage = None
+) -> List[str]:
+    """
+    Запрос к LLM с retry логикой и логированием (без объединения запросов)
+
+    Повторы укладываются в дедлайн запроса: таймаут каждой попытки считается
+    от оставшегося времени, паузы между попытками - full jitter backoff
+    (или Retry-After для 429), ошибки 4xx не повторяются.
     
     Args:
         prompt: Промпт для генерации
         user_id: ID пользователя для логирования
         style: Выбранный стиль для статистики
+        max_tokens: Лимит токенов ответа
+        deadline: Абсолютный дедлайн (time.monotonic), по умолчанию now + LLM_REQUEST_DEADLINE
+        n: Сколько вариантов запросить в одном completion
+        lane: Полоса приоритета в очереди к LLM (premium/regular/background)
+        usage: Счетчик, в который добавляются потраченные токены
         
     Returns:
-        Сгенерированный текст или fallback сообщение
+        Сгенерированные варианты (провайдер может вернуть меньше n) или [fallback сообщение]
     """
     start_time = time.time()
+    if deadline is None:
+        deadline = new_deadline()
     
-    # Fallback ответы для разных ошибок
-    fallback_responses = {
-        "timeout": [
-            "Сервер медленно отвечает, попробуйте еще раз",
-            "Запрос занимает слишком много времени",
-            "Timeout ошибка, повторите запрос"
-        ],
-        "api_error": [
-            "Произошла ошибка API, попробуйте позже", 
-            "Сервис временно недоступен",
-            "Техническая ошибка, повторите попытку"
-        ],
-        "rate_limit": [
-            "Слишком много запросов, подождите минуту",
-            "Превышен лимит запросов, попробуйте позже"
-        ]
-    }
-    
-    # Попытки с экспоненциальной задержкой
-    max_retries = config.RETRY_COUNT + 1  # +1 к конфигурации
+    # Каждый резервный провайдер дает еще одну попытку
+    max_retries = config.RETRY_COUNT + len(get_providers())
+    failed_providers = set()
+    provider = None
+    error_kind = None
+    retry_after = None
+    attempt = 0
     for attempt in range(max_retries):
+        previous = provider
+        provider = pick_provider(exclude=failed_providers)
+        if provider is None:
+            # Все circuit breaker'ы открыты - не тратим время на таймауты
+            log_event(error_logger, "all_providers_down", logging.ERROR, user_id=user_id, style=style)
+            return [random.choice(FALLBACK_RESPONSES["api_error"])]
+
+        if attempt > 0 and (provider is previous or provider.name in failed_providers):
+            # Full jitter: случайная пауза до экспоненциального потолка. Без паузы - только
+            # переход на еще не пробованный провайдер; новый круг по упавшим ждет как повтор.
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(config.LLM_RETRY_BACKOFF_CAP, config.LLM_RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+            )
+            if delay + config.LLM_MIN_ATTEMPT_TIME > _remaining(deadline):
+                break
+            logger.info(f"Retry {attempt}/{max_retries-1} after {error_kind}, waiting {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        if _remaining(deadline) < config.LLM_MIN_ATTEMPT_TIME:
+            break
+
+        logger.info(
+            f"LLM request attempt {attempt+1}/{max_retries} to {provider.name} ({provider.base_url}), "
+            f"budget {_remaining(deadline):.1f}s"
+        )
+
         try:
-            if attempt > 0:
-                # Экспоненциальная задержка: 1s, 2s, 4s
-                delay = 2 ** (attempt - 1)
-                logger.info(f"Retry {attempt}/{max_retries-1}, waiting {delay}s")
-                await asyncio.sleep(delay)
-            
-            logger.info(f"LLM request attempt {attempt+1}/{max_retries} to {config.LLM_BASE_URL}")
-            
-            # Выполняем запрос в executor
-            def make_request():
-                client = get_client()
-                return client.chat.completions.create(
-                    model=config.MODEL_NAME,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=config.MAX_TOKENS,
-                    temperature=config.TEMPERATURE
+            response, provider = await _hedged_attempt(provider, prompt, max_tokens, deadline, n, lane)
+
+        except LLMOverloadedError:
+            log_event(
+                error_logger, "overloaded", logging.ERROR,
+                user_id=user_id, style=style, provider=provider.name,
+                waited=round(time.time() - start_time, 2), queue=provider.limiter.queue_depth
+            )
+            return [random.choice(FALLBACK_RESPONSES["overloaded"])]
+
+        except Exception as e:
+            failed_providers.add(provider.name)
+            error_kind = classify_error(e)
+            retry_after = get_retry_after(e) if error_kind == "rate_limit" else None
+            logger.warning(f"LLM {error_kind} (attempt {attempt+1}, {provider.name}): {e}")
+
+            if error_kind == "client_error":
+                # Неверный запрос или ключ - повтор ничего не изменит
+                log_event(
+                    error_logger, "non_retryable_error", logging.ERROR,
+                    user_id=user_id, style=style, provider=provider.name, error=str(e)
                 )
-            
-            # Ждем с таймаутом
-            response = await asyncio.wait_for(
-                asyncio.get_event_loop().run_in_executor(None, make_request),
-                timeout=15.0
+                return [random.choice(FALLBACK_RESPONSES["api_error"])]
+            continue
+
+        _record_usage(response.usage, user_id, usage)
+        results = [
+            choice.message.content.strip()
+            for choice in response.choices
+            if choice.message.content and choice.message.content.strip()
+        ]
+        if not results:
+            error_kind = "server_error"
+            logger.warning(f"LLM returned empty response (attempt {attempt+1}, {provider.name})")
+            continue
+        result = results[0]
+        elapsed_time = time.time() - start_time
+        
+        # Логируем успешный запрос
+        request_logger.info(
+            f"SUCCESS | User: {user_id} | Style: {style} | "
+            f"Time: {elapsed_time:.2f}s | Length: {len(result)} | "
+            f"Attempts: {attempt+1} | Provider: {provider.name} | Candidates: {len(results)}"
+        )
+        
+        logger.info(f"LLM response successful: {len(result)} chars in {elapsed_time:.2f}s")
+        return results
+
+    # Попытки или время закончились
+    elapsed_time = time.time() - start_time
+    log_event(
+        error_logger, "retry_budget_exhausted", logging.ERROR,
+        user_id=user_id, style=style, attempts=attempt + 1, elapsed=round(elapsed_time, 2),
+        last_error=error_kind, deadline_left=round(_remaining(deadline), 2)
+    )
+    fallback_kind = {"timeout": "timeout", "rate_limit": "rate_limit"}.get(error_kind, "api_error")
+    return [random.choice(FALLBACK_RESPONSES[fallback_kind])]
+
+
+async def _request_text(
+    prompt: str, user_id: int = None, style: str = "unknown", max_tokens: int = None,
+    deadline: float = None, lane: str = REGULAR, usage: TokenUsage = None
+) -> str:
+    """Запрос одного варианта текста (см. _request_choices)"""
+    results = await _request_choices(
+        prompt, user_id=user_id, style=style, max_tokens=max_tokens,
+        deadline=deadline, lane=lane, usage=usage
+    )
+    return results[0]
+
+
+async def _stream_text(
+    prompt: str, user_id: int = None, style: str = "unknown", deadline: float = None,
+    lane: str = REGULAR, usage: TokenUsage = None
+) -> AsyncIterator[str]:
+    """
+    Потоковый запрос к LLM (без объединения запросов)
+
+    Если поток упал до первого фрагмента, делает обычный запрос
+    (с retry и fallback) в пределах оставшегося дедлайна и отдает
+    результат одним куском. Дедлайн ограничивает и чтение потока:
+    по его истечении поток закрывается, показанный текст остается.
+    """
+    start_time = time.time()
+    if deadline is None:
+        deadline = new_deadline()
+    first_chunk_time = None
+    length = 0
+
+    provider = pick_provider()
+    if provider is None:
+        # Все провайдеры недоступны - обычный запрос вернет fallback без ожидания
+        yield await _request_text(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
+        )
+        return
+
+    limiter = provider.limiter
+    try:
+        await limiter.acquire(min(config.LLM_MAX_QUEUE_WAIT, _remaining(deadline)), lane)
+    except LLMOverloadedError:
+        log_event(
+            error_logger, "overloaded", logging.ERROR,
+            user_id=user_id, style=style, provider=provider.name, queue=limiter.queue_depth
+        )
+        yield random.choice(FALLBACK_RESPONSES["overloaded"])
+        return
+
+    outcome = "error"
+    stream_error = None
+    stream = None
+    request_start = time.time()
+    try:
+        stream = await asyncio.wait_for(
+            provider.client.chat.completions.create(
+                model=provider.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=config.MAX_TOKENS,
+                temperature=config.TEMPERATURE,
+                stream=True,
+                # Расход токенов приходит последним фрагментом без choices
+                **({"stream_options": {"include_usage": True}} if config.LLM_STREAM_USAGE else {})
+            ),
+            timeout=min(config.LLM_ATTEMPT_TIMEOUT, _remaining(deadline))
+        )
+        chunks = stream.__aiter__()
+        while True:
+            try:
+                # Дедлайн действует и на чтение: медленный поток не держит слот лимитера
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=_remaining(deadline))
+            except StopAsyncIteration:
+                break
+            if getattr(chunk, "usage", None) is not None:
+                _record_usage(chunk.usage, user_id, usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = time.time() - start_time
+            length += len(delta)
+            yield delta
+        outcome = "success"
+    except Exception as e:
+        stream_error = e
+        outcome = "overload" if is_overload_error(e) else "error"
+    finally:
+        if stream is not None:
+            # Брошенный поток (дедлайн, ошибка, отмена) закрываем, чтобы не держать соединение
+            await stream.close()
+        # Слот освобождаем до fallback-запроса, который займет свой
+        limiter.release(outcome)
+        if outcome != "error" or stream_error is not None:
+            # Для потока скорость провайдера - это время до первого фрагмента
+            latency = first_chunk_time if first_chunk_time is not None else time.time() - request_start
+            record_result(provider, success=stream_error is None, latency=latency)
+
+    if stream_error is not None:
+        if first_chunk_time is None:
+            # Ничего не успели показать - откатываемся на обычную генерацию
+            logger.warning(f"LLM stream failed before first chunk, falling back: {stream_error}")
+            yield await _request_text(
+                prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
             )
-            
-            result = response.choices[0].message.content.strip()
-            elapsed_time = time.time() - start_time
-            
-            # Логируем успешный запрос
-            request_logger.info(
-                f"SUCCESS | User: {user_id} | Style: {style} | "
-                f"Time: {elapsed_time:.2f}s | Length: {len(result)} | "
-                f"Attempts: {attempt+1}"
+            return
+
+        # Часть текста уже у пользователя - оставляем то, что успели получить
+        error_logger.error(
+            f"STREAM_ERROR | User: {user_id} | Style: {style} | "
+            f"Received: {length} chars | Error: {stream_error}"
+        )
+        return
+
+    if first_chunk_time is None:
+        # Поток завершился пустым - пробуем обычную генерацию
+        logger.warning("LLM stream returned no content, falling back")
+        yield await _request_text(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
+        )
+        return
+
+    elapsed_time = time.time() - start_time
+    request_logger.info(
+        f"SUCCESS_STREAM | User: {user_id} | Style: {style} | "
+        f"Time: {elapsed_time:.2f}s | First chunk: {first_chunk_time or 0:.2f}s | Length: {length} | "
+        f"Provider: {provider.name}"
+    )
+
+
+def get_hedge_stats() -> dict:
+    """Счетчики хеджирования запросов"""
+    return dict(_hedge_stats)
+
+
+def get_singleflight_stats() -> dict:
+    """Счетчики объединения одинаковых запросов"""
+    return dict(_singleflight_stats, in_flight=len(_inflight))
+
+
+def _forget_flight(key: tuple, flight: asyncio.Future):
+    """Убрать завершенный запрос из таблицы single-flight"""
+    if _inflight.get(key) is flight:
+        del _inflight[key]
+    _flight_waiters.pop(flight, None)
+
+
+async def generate_text(
+    prompt: str, user_id: int = None, style: str = "unknown", max_tokens: int = None,
+    deadline: float = None, lane: str = REGULAR, usage: TokenUsage = None, coalesce: bool = True
+) -> str:
+    """
+    Генерация текста через OpenRouter с retry логикой и логированием
+
+    Одновременные вызовы с одинаковым промптом и полосой ждут один общий
+    запрос к LLM (single-flight). Отмена одного из ожидающих не отменяет
+    общий запрос, пока его ждет кто-то еще.
+
+    Args:
+        prompt: Промпт для генерации
+        user_id: ID пользователя для логирования
+        style: Выбранный стиль для статистики
+        max_tokens: Лимит токенов ответа (по умолчанию config.MAX_TOKENS)
+        deadline: Абсолютный дедлайн (time.monotonic), по умолчанию now + LLM_REQUEST_DEADLINE
+        lane: Полоса приоритета в очереди к LLM (premium/regular/background)
+        usage: Счетчик, в который добавляются потраченные токены
+        coalesce: False - всегда отдельный запрос (нужен новый вариант, а не общий ответ)
+
+    Returns:
+        Сгенерированный текст или fallback сообщение
+    """
+    if deadline is None:
+        deadline = new_deadline()
+
+    if not (config.LLM_SINGLE_FLIGHT and coalesce):
+        return await _request_text(
+            prompt, user_id=user_id, style=style, max_tokens=max_tokens,
+            deadline=deadline, lane=lane, usage=usage
+        )
+
+    start_time = time.time()
+    key = (prompt, lane)
+    flight = _inflight.get(key)
+    is_leader = flight is None
+
+    if is_leader:
+        flight = asyncio.ensure_future(
+            _request_text(
+                prompt, user_id=user_id, style=style, max_tokens=max_tokens,
+                deadline=deadline, lane=lane, usage=usage
             )
-            
-            logger.info(f"LLM response successful: {len(result)} chars in {elapsed_time:.2f}s")
-            return result
-            
-        except asyncio.TimeoutError:
-            elapsed_time = time.time() - start_time
-            logger.warning(f"LLM request timeout after {elapsed_time:.2f}s (attempt {attempt+1})")
-            
-            if attempt == max_retries - 1:  # Последняя попытка
-                error_logger.error(f"TIMEOUT | User: {user_id} | Style: {style} | Total time: {elapsed_time:.2f}s")
-                import random
-                return random.choice(fallback_responses["timeout"])
-                
-        except Exception as e:
-            elapsed_time = time.time() - start_time
-            error_str = str(e).lower()
-            
-            # Определяем тип ошибки
-            if "rate limit" in error_str or "429" in error_str:
-                error_logger.error(f"RATE_LIMIT | User: {user_id} | Error: {e}")
-                import random
-                return random.choice(fallback_responses["rate_limit"])
-            
-            logger.error(f"LLM API error (attempt {attempt+1}): {e}")
-            
-            if attempt == max_retries - 1:  # Последняя попытка
-                error_logger.error(f"API_ERROR | User: {user_id} | Style: {style} | Error: {e}", exc_info=True)
-                import random
-                return random.choice(fallback_responses["api_error"])
-    
-    # Не должно сюда дойти, но на всякий случай
-    import random
-    return random.choice(fallback_responses["api_error"])
+        )
+        _inflight[key] = flight
+        flight.add_done_callback(lambda f: _forget_flight(key, f))
+        _singleflight_stats["leaders"] += 1
+    else:
+        _singleflight_stats["coalesced"] += 1
+        logger.info(f"Coalescing LLM request for user {user_id} with in-flight request")
+
+    _flight_waiters[flight] = _flight_waiters.get(flight, 0) + 1
+    try:
+        # Чужой общий запрос ждем не дольше собственного дедлайна
+        result = await asyncio.wait_for(asyncio.shield(flight), timeout=_remaining(deadline))
+    except asyncio.TimeoutError:
+        log_event(
+            error_logger, "deadline_exceeded", logging.ERROR,
+            user_id=user_id, style=style, coalesced=not is_leader, waited=round(time.time() - start_time, 2)
+        )
+        return random.choice(FALLBACK_RESPONSES["timeout"])
+    except asyncio.CancelledError:
+        if flight.cancelled() and not asyncio.current_task().cancelling():
+            # Общий запрос отменил его владелец, а не нас - делаем свой
+            logger.info(f"Shared LLM request aborted, retrying for user {user_id}")
+            return await _request_text(
+                prompt, user_id=user_id, style=style, max_tokens=max_tokens,
+                deadline=deadline, lane=lane, usage=usage
+            )
+        raise
+    finally:
+        if not flight.done():
+            waiters = _flight_waiters.get(flight, 1) - 1
+            _flight_waiters[flight] = waiters
+            if waiters <= 0 and isinstance(flight, asyncio.Task):
+                # Последний ожидающий ушел - запрос больше никому не нужен
+                flight.cancel()
+                logger.info(f"Cancelled orphaned LLM request (last waiter: user {user_id})")
+
+    if not is_leader:
+        request_logger.info(
+            f"COALESCED | User: {user_id} | Style: {style} | "
+            f"Time: {time.time() - start_time:.2f}s | Length: {len(result)}"
+        )
+    return result
+
+
+async def generate_text_stream(
+    prompt: str, user_id: int = None, style: str = "unknown", deadline: float = None,
+    lane: str = REGULAR, usage: TokenUsage = None, coalesce: bool = True
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация текста: отдает фрагменты ответа по мере их появления
+
+    Поток регистрируется в single-flight: одновременные generate_text
+    с тем же промптом и полосой получат его итоговый текст. Если такой же
+    запрос уже выполняется, результат отдается одним куском.
+
+    Args:
+        prompt: Промпт для генерации
+        user_id: ID пользователя для логирования
+        style: Выбранный стиль для статистики
+        deadline: Абсолютный дедлайн (time.monotonic), по умолчанию now + LLM_REQUEST_DEADLINE
+        lane: Полоса приоритета в очереди к LLM (premium/regular/background)
+        usage: Счетчик, в который добавляются потраченные токены
+        coalesce: False - не объединять с другими запросами (см. generate_text)
+
+    Yields:
+        Фрагменты сгенерированного текста
+    """
+    if deadline is None:
+        deadline = new_deadline()
+
+    if not (config.LLM_SINGLE_FLIGHT and coalesce):
+        async for chunk in _stream_text(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
+        ):
+            yield chunk
+        return
+
+    key = (prompt, lane)
+    if key in _inflight:
+        yield await generate_text(prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage)
+        return
+
+    flight = asyncio.get_running_loop().create_future()
+    _inflight[key] = flight
+    _singleflight_stats["leaders"] += 1
+    parts = []
+    try:
+        async for chunk in _stream_text(
+            prompt, user_id=user_id, style=style, deadline=deadline, lane=lane, usage=usage
+        ):
+            parts.append(chunk)
+            yield chunk
+        if not flight.done():
+            flight.set_result("".join(parts).strip())
+    finally:
+        if not flight.done():
+            # Поток прерван - ожидающие сделают собственные запросы
+            flight.cancel()
+        _forget_flight(key, flight)
+
+
+async def generate_candidates(
+    prompt: str, user_id: int = None, style: str = "unknown", n: int = None,
+    deadline: float = None, lane: str = REGULAR, usage: TokenUsage = None
+) -> List[str]:
+    """
+    Сгенерировать несколько вариантов текста одним запросом к LLM (параметр n)
+
+    Запрос не объединяется через single-flight: одинаковые варианты у разных
+    пользователей здесь не нужны.
+
+    Args:
+        prompt: Промпт для генерации
+        user_id: ID пользователя для логирования
+        style: Выбранный стиль для статистики
+        n: Сколько вариантов запросить (по умолчанию config.LLM_CANDIDATES)
+        deadline: Абсолютный дедлайн (time.monotonic)
+        lane: Полоса приоритета в очереди к LLM
+        usage: Счетчик, в который добавляются потраченные токены
+
+    Returns:
+        Непустой список различных вариантов; при ошибке - [fallback сообщение]
+    """
+    results = await _request_choices(
+        prompt, user_id=user_id, style=style, deadline=deadline,
+        n=n or config.LLM_CANDIDATES, lane=lane, usage=usage
+    )
+    if is_fallback_response(results[0]):
+        return results[:1]
+    # Провайдер может вернуть одинаковые варианты - оставляем уникальные
+    return list(dict.fromkeys(results))
+
+
+def parse_batch_excuses(text: str) -> Optional[dict]:
+    """
+    Разобрать JSON с отмазками во всех стилях
+
+    Returns:
+        {стиль: текст} для всех стилей из EXCUSE_PROMPTS или None, если ответ невалиден
+    """
+    text = text.strip()
+    # Модели часто оборачивают JSON в markdown-блок
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
+
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, ValueError):
+        return None
+
+    if not isinstance(data, dict):
+        return None
+
+    excuses = {}
+    for style in EXCUSE_PROMPTS:
+        value = data.get(style)
+        if not isinstance(value, str) or not value.strip():
+            return None
+        excuses[style] = value.strip()
+    return excuses
+
+
+async def generate_batch_excuses(
+    user_message: str, user_id: int = None, deadline: float = None,
+    lane: str = REGULAR, usage: TokenUsage = None
+) -> Optional[dict]:
+    """
+    Сгенерировать отмазки во всех стилях одним запросом к LLM
+
+    Returns:
+        {стиль: текст} или None, если запрос не удался или ответ не разобрался
+        (тогда вызывающий код откатывается на генерацию по одному стилю)
+    """
+    prompt = BATCH_EXCUSE_PROMPT.format(user_message=user_message)
+    result = await generate_text(
+        prompt, user_id=user_id, style="batch",
+        max_tokens=config.BATCH_MAX_TOKENS, deadline=deadline, lane=lane, usage=usage
+    )
+
+    if is_fallback_response(result):
+        return None
+
+    excuses = parse_batch_excuses(result)
+    if excuses is None:
+        error_logger.error(f"BATCH_PARSE_ERROR | User: {user_id} | Response: {result[:200]!r}")
+        return None
+
+    logger.info(f"Batch generation for user {user_id}: {len(excuses)} styles")
+    return excuses
@@ -83,6 +83,13 @@ def validate_startup():
 async def run_bot():
     """Запуск бота с инициализацией БД"""
     from app.database import init_database, close_database
+    from app.llm_client import close_clients
+    from app.warm_pool import start_warm_pool, stop_warm_pool
+    from app.usage import start_usage_tracking, stop_usage_tracking
+    from app.transcription import start_transcription, stop_transcription
+    from app.user_registry import start_user_registry, stop_user_registry
+    from app.excuse_writer import start_excuse_writer, stop_excuse_writer
+    from app.rollups import start_rollups, stop_rollups
 
     app_logger = logging.getLogger("app")
 
@@ -92,10 +99,47 @@ async def run_bot():
         await init_database()
         app_logger.info("✅ База данных готова")
 
+        # Расход токенов за сегодня для квот
+        await start_usage_tracking()
+
+        # Пакетная запись активности пользователей и отмазок
+        start_user_registry()
+        start_excuse_writer()
+
+        # Фоновая агрегация сводок для /admin
+        start_rollups()
+
+        # Прогрев пула готовых отмазок
+        await start_warm_pool()
+
+        # Загрузка локальной модели распознавания (если включена)
+        await start_transcription()
+
         # Запуск бота
         await start_bot()
 
     finally:
+        # Остановка фонового пополнения пула
+        await stop_warm_pool()
+
+        # Остановка процессов локального распознавания
+        await stop_transcription()
+
+        # Закрытие пула соединений LLM
+        await close_clients()
+
+        # Остановка агрегации сводок
+        await stop_rollups()
+
+        # Запись отмазок из буфера (до закрытия БД и без потери при ошибке)
+        await stop_excuse_writer()
+
+        # Запись накопленного расхода токенов
+        await stop_usage_tracking()
+
+        # Запись накопленной активности пользователей
+        await stop_user_registry()
+
         # Закрытие соединения с БД
         app_logger.info("🗄️  Закрытие соединения с БД...")
         await close_database()
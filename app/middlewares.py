@@ -0,0 +1,112 @@
+"""
+Middleware aiogram: общая сессия БД на апдейт и счетчики запросов к БД
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject, Update
+
+from app import database as db
+
+logger = logging.getLogger(__name__)
+
+# Произвольные /команды не должны раздувать статистику
+MAX_UPDATE_KEYS = 50
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Привязывает к апдейту единицу работы БД (db.unit_of_work)
+
+    Функции app.database, вызванные обработчиком, работают в общей сессии,
+    которая коммитится и отдает соединение перед запросами к Telegram и LLM
+    (см. DbReleaseRequestMiddleware). Число запросов и выдач соединений,
+    включая независимые сессии, копится по типам апдейтов.
+    """
+
+    def __init__(self):
+        self._by_type = {}  # {тип апдейта: deque[(запросов, выдач соединений)]}
+        self.updates = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        started = time.monotonic()
+        uow = None
+        try:
+            async with db.unit_of_work() as uow:
+                return await handler(event, data)
+        finally:
+            if uow is not None:
+                self._record(event, uow, time.monotonic() - started)
+
+    def _record(self, event: TelegramObject, uow: db.UnitOfWork, elapsed: float):
+        update_type = _update_key(event)
+        if update_type not in self._by_type and len(self._by_type) >= MAX_UPDATE_KEYS:
+            update_type = "other"
+        self.updates += 1
+        self._by_type.setdefault(update_type, deque(maxlen=1000)).append((uow.queries, uow.checkouts))
+        logger.debug(
+            f"DB_UNIT | Update: {update_type} | Queries: {uow.queries} | "
+            f"Checkouts: {uow.checkouts} | Time: {elapsed:.3f}s"
+        )
+
+    def stats(self) -> dict:
+        """Среднее и максимум запросов к БД на апдейт по типам апдейтов"""
+        result = {}
+        for update_type, samples in self._by_type.items():
+            queries = [q for q, _ in samples]
+            checkouts = [c for _, c in samples]
+            result[update_type] = {
+                "updates": len(samples),
+                "avg_queries": round(sum(queries) / len(queries), 2),
+                "max_queries": max(queries),
+                "avg_checkouts": round(sum(checkouts) / len(checkouts), 2),
+                "max_checkouts": max(checkouts)
+            }
+        return result
+
+
+class DbReleaseRequestMiddleware(BaseRequestMiddleware):
+    """
+    Коммит и возврат соединения перед каждым запросом к Bot API
+
+    Кнопки отправляемого сообщения ссылаются только на закоммиченные строки,
+    а соединение не занято, пока ждем Telegram.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        await db.release_session()
+        return await make_request(bot, method)
+
+
+def _update_key(event: TelegramObject) -> str:
+    """Ключ для статистики: команда или callback без ID отмазки (fav_toggle_123 -> fav_toggle)"""
+    if not isinstance(event, Update):
+        return type(event).__name__
+    if event.callback_query is not None and event.callback_query.data:
+        prefix, _, tail = event.callback_query.data.rpartition("_")
+        return f"callback:{prefix if tail.isdigit() else event.callback_query.data}"
+    if event.message is not None:
+        if event.message.text and event.message.text.startswith("/"):
+            return f"command:{event.message.text.split()[0]}"
+        return "voice" if event.message.voice else "message"
+    return event.event_type
+
+
+db_session_middleware = DbSessionMiddleware()
+db_release_middleware = DbReleaseRequestMiddleware()
@@ -1,9 +1,10 @@
 """
 Database models для Telegram-бота "Отмазочник"
 """
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional
-from sqlalchemy import BigInteger, String, Text, Integer, DateTime, Boolean, ForeignKey, Index
+from sqlalchemy import BigInteger, String, Text, Integer, SmallInteger, Float, DateTime, Date, Boolean, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -54,6 +55,8 @@ class Excuse(Base):
 
     # Дополнительная информация
     response_time: Mapped[Optional[float]] = mapped_column(nullable=True)  # Время генерации в секундах
+    prompt_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # None - ответ без запроса к LLM
+    completion_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     # Отношения
     user: Mapped["User"] = relationship("User", back_populates="excuses")
@@ -90,3 +93,109 @@ class Favorite(Base):
 
     def __repr__(self):
         return f"<Favorite(id={self.id}, user_id={self.user_id}, excuse_id={self.excuse_id})>"
+
+
+class UserTokenUsage(Base):
+    """Расход токенов LLM пользователем за день (для квот и учета затрат)"""
+    __tablename__ = "user_token_usage"
+
+    user_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True
+    )
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    prompt_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    completion_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    # Индексы
+    __table_args__ = (
+        Index('ix_user_token_usage_day', 'day'),
+    )
+
+    def __repr__(self):
+        return f"<UserTokenUsage(user_id={self.user_id}, day={self.day})>"
+
+
+class UserStats(Base):
+    """
+    Счетчики пользователя для /stats
+
+    Поддерживаются триггерами на excuses и favorites (миграция 004),
+    приложение их только читает.
+    """
+    __tablename__ = "user_stats"
+
+    user_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True
+    )
+    total_excuses: Mapped[int] = mapped_column(Integer, default=0)
+    total_favorites: Mapped[int] = mapped_column(Integer, default=0)
+    style_counts: Mapped[dict] = mapped_column(JSONB, default=dict)  # {стиль: отмазок}
+
+    # Индексы
+    __table_args__ = (
+        Index('ix_user_stats_total_excuses', 'total_excuses'),  # Топ пользователей в /admin
+    )
+
+    def __repr__(self):
+        return f"<UserStats(user_id={self.user_id}, total_excuses={self.total_excuses})>"
+
+
+class AdminCounters(Base):
+    """
+    Общие счетчики для /admin, разбитые на шарды (значение - сумма строк)
+
+    Поддерживаются триггерами на users и favorites (миграция 005),
+    приложение их только читает.
+    """
+    __tablename__ = "admin_counters"
+
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    total_users: Mapped[int] = mapped_column(BigInteger, default=0)
+    total_favorites: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    def __repr__(self):
+        return f"<AdminCounters(shard={self.shard}, total_users={self.total_users})>"
+
+
+class RollupCounters:
+    """Агрегаты отмазок за период по стилю (общие колонки почасовой и дневной сводки)"""
+    style: Mapped[str] = mapped_column(String(50), primary_key=True)
+    excuses: Mapped[int] = mapped_column(Integer, default=0)
+    response_time_sum: Mapped[float] = mapped_column(Float, default=0.0)
+    response_time_count: Mapped[int] = mapped_column(Integer, default=0)
+    token_excuses: Mapped[int] = mapped_column(Integer, default=0)  # Отмазок с известным расходом токенов
+    prompt_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    completion_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class ExcuseRollupHourly(RollupCounters, Base):
+    """Почасовая сводка по отмазкам (заполняется фоновой агрегацией, app/rollups.py)"""
+    __tablename__ = "excuse_rollup_hourly"
+
+    hour: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+
+    def __repr__(self):
+        return f"<ExcuseRollupHourly(hour={self.hour}, style={self.style})>"
+
+
+class ExcuseRollupDaily(RollupCounters, Base):
+    """Дневная сводка по отмазкам (пересчитывается из почасовой)"""
+    __tablename__ = "excuse_rollup_daily"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+
+    def __repr__(self):
+        return f"<ExcuseRollupDaily(day={self.day}, style={self.style})>"
+
+
+class VoiceTranscription(Base):
+    """Распознанный текст голосового по file_unique_id Telegram (кэш между рестартами)"""
+    __tablename__ = "voice_transcriptions"
+
+    file_unique_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    text: Mapped[str] = mapped_column(Text)
+    duration: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # Длина голосового в секундах
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<VoiceTranscription(file_unique_id={self.file_unique_id})>"
@@ -0,0 +1,242 @@
+"""
+Предиктивная генерация отмазки, пока пользователь выбирает стиль
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from app.config import config
+from app.limiter import BACKGROUND, slot_acquired
+from app.llm_client import generate_text, is_fallback_response
+from app.usage import TokenUsage
+from app.prompts import EXCUSE_PROMPTS
+from app import database as db
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("requests")
+
+
+@dataclass
+class Prefetch:
+    """Фоновая генерация для одного пользователя"""
+    style: str
+    original_message: str
+    task: asyncio.Task
+    started_at: float
+    usage: TokenUsage
+    lane: str
+    slot_acquired: asyncio.Event
+
+
+# Активные предзагрузки по пользователям
+_prefetches = {}  # {user_id: Prefetch}
+
+_stats = {
+    "started": 0,
+    "hits": 0,
+    "misses": 0,
+    "cancelled": 0,
+    "expired": 0,
+    "requeued": 0,
+    "skipped_budget": 0,
+    "skipped_no_history": 0,
+    "voice_pipelined": 0
+}
+
+
+def get_prefetch_stats() -> dict:
+    """Счетчики предзагрузки для настройки расходов на LLM"""
+    decided = _stats["hits"] + _stats["misses"]
+    return dict(
+        _stats,
+        in_flight=sum(1 for p in _prefetches.values() if not p.task.done()),
+        hit_rate=round(_stats["hits"] / decided, 3) if decided else 0.0
+    )
+
+
+def _predict_style(distribution: dict) -> Optional[str]:
+    """Выбрать самый вероятный стиль, если он достаточно уверенно лидирует"""
+    total = sum(distribution.values())
+    if total < config.PREFETCH_MIN_HISTORY:
+        return None
+
+    style, count = max(distribution.items(), key=lambda item: item[1])
+    if style not in EXCUSE_PROMPTS or count / total < config.PREFETCH_MIN_SHARE:
+        return None
+    return style
+
+
+def cancel_prefetch(user_id: int, reason: str = "cancelled"):
+    """Отменить предзагрузку пользователя, если она есть"""
+    prefetch = _prefetches.pop(user_id, None)
+    if prefetch is None:
+        return
+
+    if not prefetch.task.done():
+        prefetch.task.cancel()
+    _stats[reason] += 1
+    logger.debug(f"Prefetch for user {user_id} dropped: {reason}")
+
+
+def _expire(user_id: int, prefetch: Prefetch):
+    """Снять брошенную предзагрузку по таймауту"""
+    if _prefetches.get(user_id) is prefetch:
+        cancel_prefetch(user_id, reason="expired")
+
+
+async def start_prefetch(user_id: int, original_message: str):
+    """
+    Запустить фоновую генерацию в самом вероятном для пользователя стиле
+
+    Ничего не делает, если предзагрузка выключена, исчерпан общий бюджет
+    или у пользователя мало истории для уверенного прогноза.
+    """
+    # Новая ситуация делает прежнюю предзагрузку (в том числе голосовую) бесполезной
+    cancel_prefetch(user_id)
+
+    if not config.PREFETCH_ENABLED:
+        return
+
+    if not _has_budget():
+        return
+
+    try:
+        distribution = await db.get_user_style_distribution(user_id)
+    except Exception as e:
+        logger.error(f"Failed to load style distribution for user {user_id}: {e}", exc_info=True)
+        return
+
+    style = _predict_style(distribution)
+    if style is None:
+        _stats["skipped_no_history"] += 1
+        return
+
+    _launch(user_id, original_message, style, BACKGROUND)
+
+
+async def start_voice_prefetch(
+    user_id: int, original_message: str, default_style: Optional[str], lane: str
+) -> Optional[str]:
+    """
+    Конвейер для голосовых: начать генерацию сразу после транскрипции
+
+    Стиль - настройка пользователя или самый частый в его истории (без порогов
+    уверенности обычной предзагрузки). Генерация идет в полосе пользователя:
+    он уже ждал транскрипцию, и выбранный заранее стиль почти всегда угадан.
+
+    Returns:
+        Стиль, в котором готовится отмазка, или None
+    """
+    if not config.VOICE_PIPELINE_ENABLED:
+        return None
+
+    cancel_prefetch(user_id)
+    if not _has_budget():
+        return None
+
+    style = default_style if default_style in EXCUSE_PROMPTS else None
+    if style is None:
+        try:
+            distribution = await db.get_user_style_distribution(user_id)
+        except Exception as e:
+            logger.error(f"Failed to load style distribution for user {user_id}: {e}", exc_info=True)
+            return None
+        distribution = {s: count for s, count in distribution.items() if s in EXCUSE_PROMPTS}
+        if not distribution:
+            _stats["skipped_no_history"] += 1
+            return None
+        style = max(distribution.items(), key=lambda item: item[1])[0]
+
+    _launch(user_id, original_message, style, lane)
+    _stats["voice_pipelined"] += 1
+    return style
+
+
+def _has_budget() -> bool:
+    """Не превышен ли общий бюджет параллельных предзагрузок"""
+    in_flight = sum(1 for p in _prefetches.values() if not p.task.done())
+    if in_flight >= config.PREFETCH_MAX_IN_FLIGHT:
+        _stats["skipped_budget"] += 1
+        return False
+    return True
+
+
+def _launch(user_id: int, original_message: str, style: str, lane: str):
+    """Запустить фоновую генерацию и снять ее по таймауту, если стиль так и не выбрали"""
+    prompt = EXCUSE_PROMPTS[style].format(user_message=original_message)
+    usage = TokenUsage()
+    acquired = asyncio.Event()
+    context = contextvars.copy_context()
+    context.run(slot_acquired.set, acquired)
+    task = asyncio.create_task(
+        generate_text(prompt, user_id=user_id, style=style, lane=lane, usage=usage), context=context
+    )
+    prefetch = Prefetch(
+        style=style, original_message=original_message, task=task, started_at=time.time(), usage=usage,
+        lane=lane, slot_acquired=acquired
+    )
+    _prefetches[user_id] = prefetch
+    _stats["started"] += 1
+
+    asyncio.get_running_loop().call_later(config.PREFETCH_TTL, _expire, user_id, prefetch)
+    logger.info(f"Prefetch started for user {user_id} in style {style}")
+
+
+def get_prefetched_style(user_id: int, original_message: str) -> Optional[str]:
+    """Стиль активной предзагрузки для этой ситуации (для выбора 'случайного' стиля)"""
+    prefetch = _prefetches.get(user_id)
+    if prefetch is None or prefetch.original_message != original_message:
+        return None
+    return prefetch.style
+
+
+async def take_prefetch(
+    user_id: int, style: str, original_message: str, usage: TokenUsage = None, lane: str = None
+) -> Optional[str]:
+    """
+    Забрать результат предзагрузки, если угадали стиль
+
+    При промахе фоновая генерация отменяется. При попадании токены
+    предзагрузки добавляются в usage. Если фоновая предзагрузка еще ждет
+    слот к LLM, она тоже отменяется: пользователь получит генерацию в своей
+    полосе (lane), а не в очереди за фоновой работой.
+
+    Returns:
+        Сгенерированный текст или None
+    """
+    prefetch = _prefetches.get(user_id)
+    if prefetch is None:
+        return None
+
+    if prefetch.style != style or prefetch.original_message != original_message:
+        cancel_prefetch(user_id, reason="misses")
+        return None
+
+    if lane is not None and prefetch.lane != lane and not prefetch.slot_acquired.is_set():
+        cancel_prefetch(user_id, reason="requeued")
+        return None
+
+    del _prefetches[user_id]
+    try:
+        result = await prefetch.task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        _stats["misses"] += 1
+        return None
+
+    if is_fallback_response(result):
+        _stats["misses"] += 1
+        return None
+
+    _stats["hits"] += 1
+    if usage is not None:
+        usage.add(prefetch.usage.prompt_tokens, prefetch.usage.completion_tokens)
+    request_logger.info(
+        f"PREFETCH_HIT | User: {user_id} | Style: {style} | "
+        f"Age: {time.time() - prefetch.started_at:.2f}s"
+    )
+    return result
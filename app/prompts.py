@@ -66,3 +66,19 @@ EXCUSE_PROMPTS = {
 
 Отмазка:"""
 }
+
+# Промпт для генерации отмазок сразу во всех стилях одним запросом
+BATCH_EXCUSE_PROMPT = """Ты генерируешь отмазки сразу в четырех стилях.
+
+Пользователь описал ситуацию: "{user_message}"
+
+Создай по одной отмазке в каждом стиле:
+- "быдло": грубовато, прямолинейно, с жаргоном ("братан", "чувак", "блин", "капец", "короче")
+- "корпорат": деловито, бюрократично, с канцеляритом и офисными терминами ("KPI", "дедлайн", "синергия")
+- "монах": философски, с духовным подтекстом ("путь дхармы", "кармическое воздаяние", притчи)
+- "инфоцыган": мистически, с эзотерикой и псевдонаукой ("квантовые вибрации", "торсионные поля")
+
+Каждая отмазка - от первого лица, правдоподобная но оригинальная, максимум 2-3 предложения.
+
+Ответь ТОЛЬКО валидным JSON без пояснений, строго с такими ключами:
+{{"быдло": "...", "корпорат": "...", "монах": "...", "инфоцыган": "..."}}"""
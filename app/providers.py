@@ -0,0 +1,245 @@
+"""
+OpenAI-совместимые LLM провайдеры с circuit breaker'ами для failover
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import httpx
+import openai
+
+from app.config import config
+from app.limiter import AdaptiveLimiter, parse_lane_weights
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker по доле ошибок и медленных ответов в скользящем окне
+
+    closed -> open: в окне не меньше min_calls вызовов и доля ошибок
+    (медленный ответ тоже считается ошибкой) >= failure_threshold.
+    open -> half_open: через open_duration запускается фоновая проба.
+    half_open -> closed/open: по результату пробы.
+    """
+
+    def __init__(self, window: int, min_calls: int, failure_threshold: float,
+                 slow_call_threshold: float, open_duration: float):
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.open_duration = open_duration
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._outcomes = deque(maxlen=window)  # True - неудача
+        self.times_opened = 0
+
+    def allow_request(self) -> bool:
+        """Пропускать ли пользовательские запросы (открытый и полуоткрытый - нет)"""
+        return self.state == CLOSED
+
+    def failure_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def record(self, success: bool, latency: float) -> bool:
+        """
+        Учесть результат вызова
+
+        Returns:
+            True, если breaker только что открылся
+        """
+        failed = not success or latency > self.slow_call_threshold
+        self._outcomes.append(failed)
+
+        if (
+            self.state == CLOSED
+            and len(self._outcomes) >= self.min_calls
+            and self.failure_rate() >= self.failure_threshold
+        ):
+            self.trip()
+            return True
+        return False
+
+    def trip(self):
+        """Открыть breaker"""
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+    def reopen(self):
+        """Вернуть в open после неудачной пробы (не новое открытие - times_opened не растет)"""
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def reset(self):
+        """Закрыть breaker после успешной пробы"""
+        self.state = CLOSED
+        self._outcomes.clear()
+
+
+@dataclass
+class Provider:
+    """Один OpenAI-совместимый endpoint с моделью"""
+    name: str
+    base_url: str
+    model: str
+    api_key: str
+    client: openai.AsyncOpenAI
+    limiter: AdaptiveLimiter
+    breaker: CircuitBreaker
+    probe_task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    def stats(self) -> dict:
+        return dict(
+            self.limiter.stats(),
+            name=self.name,
+            model=self.model,
+            state=self.breaker.state,
+            failure_rate=round(self.breaker.failure_rate(), 3),
+            times_opened=self.breaker.times_opened
+        )
+
+
+_providers: Optional[List[Provider]] = None
+
+
+def _create_client(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+    """Async клиент с собственным пулом keep-alive соединений"""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_MAX_KEEPALIVE,
+            keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(15.0, connect=5.0)
+    )
+    return openai.AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        timeout=15.0,   # Разумный timeout
+        max_retries=0,  # Собственная retry логика
+        http_client=http_client
+    )
+
+
+def _parse_provider_specs() -> list:
+    """
+    Основной провайдер из LLM_BASE_URL/MODEL_NAME и резервные из LLM_FALLBACK_PROVIDERS
+
+    Формат LLM_FALLBACK_PROVIDERS: "base_url|model[|api_key],base_url|model[|api_key]"
+    """
+    specs = [(config.LLM_BASE_URL, config.MODEL_NAME, config.OPENROUTER_API_KEY)]
+    for item in config.LLM_FALLBACK_PROVIDERS.split(","):
+        parts = [part.strip() for part in item.split("|")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        api_key = parts[2] if len(parts) > 2 and parts[2] else config.OPENROUTER_API_KEY
+        specs.append((parts[0], parts[1], api_key))
+    return specs
+
+
+def get_providers() -> List[Provider]:
+    """Провайдеры в порядке приоритета (ленивая инициализация)"""
+    global _providers
+    if _providers is None:
+        _providers = []
+        for index, (base_url, model, api_key) in enumerate(_parse_provider_specs()):
+            name = "primary" if index == 0 else f"fallback{index}"
+            logger.info(f"Initializing LLM provider {name}: {base_url} ({model})")
+            _providers.append(Provider(
+                name=name,
+                base_url=base_url,
+                model=model,
+                api_key=api_key,
+                client=_create_client(base_url, api_key),
+                limiter=AdaptiveLimiter(
+                    initial_limit=config.LLM_INITIAL_CONCURRENCY,
+                    min_limit=config.LLM_MIN_CONCURRENCY,
+                    max_limit=config.LLM_MAX_CONCURRENCY,
+                    lane_weights=parse_lane_weights(config.LLM_LANE_WEIGHTS)
+                ),
+                breaker=CircuitBreaker(
+                    window=config.LLM_BREAKER_WINDOW,
+                    min_calls=config.LLM_BREAKER_MIN_CALLS,
+                    failure_threshold=config.LLM_BREAKER_FAILURE_RATE,
+                    slow_call_threshold=config.LLM_BREAKER_SLOW_CALL,
+                    open_duration=config.LLM_BREAKER_OPEN_DURATION
+                )
+            ))
+    return _providers
+
+
+def pick_provider(exclude: set = frozenset()) -> Optional[Provider]:
+    """Первый провайдер с закрытым breaker'ом, которого еще не пробовали в этом запросе"""
+    available = [p for p in get_providers() if p.breaker.allow_request()]
+    for provider in available:
+        if provider.name not in exclude:
+            return provider
+    # Все доступные уже падали на этом запросе - повторяем на первом из них
+    return available[0] if available else None
+
+
+async def _probe(provider: Provider):
+    """Фоновая проверка восстановления открытого провайдера"""
+    while True:
+        await asyncio.sleep(provider.breaker.open_duration)
+        provider.breaker.state = HALF_OPEN
+        try:
+            await asyncio.wait_for(
+                provider.client.chat.completions.create(
+                    model=provider.model,
+                    messages=[{"role": "user", "content": "ping"}],
+                    max_tokens=1
+                ),
+                timeout=config.LLM_BREAKER_SLOW_CALL
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            provider.breaker.reopen()
+            logger.warning(f"LLM provider {provider.name} probe failed, staying open: {e}")
+            continue
+
+        provider.breaker.reset()
+        logger.info(f"LLM provider {provider.name} recovered, circuit closed")
+        return
+
+
+def record_result(provider: Provider, success: bool, latency: float):
+    """Учесть результат вызова провайдера и при открытии breaker'а запустить пробы"""
+    if provider.breaker.record(success, latency):
+        error_logger.error(
+            f"CIRCUIT_OPEN | Provider: {provider.name} ({provider.base_url}) | "
+            f"Failure rate: {provider.breaker.failure_rate():.0%}"
+        )
+        provider.probe_task = asyncio.create_task(_probe(provider))
+
+
+def get_provider_stats() -> list:
+    """Состояние breaker'ов и лимитов по провайдерам"""
+    return [provider.stats() for provider in get_providers()]
+
+
+async def close_providers():
+    """Остановить пробы и закрыть пулы соединений"""
+    global _providers
+    if _providers is None:
+        return
+    for provider in _providers:
+        if provider.probe_task is not None:
+            provider.probe_task.cancel()
+        await provider.client.close()
+    _providers = None
+    logger.info("LLM providers closed")
@@ -0,0 +1,135 @@
+"""
+In-process кэш сгенерированных отмазок по ключу (стиль, ситуация)
+"""
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    """Пул вариантов отмазок для одного ключа"""
+    variants: list = field(default_factory=list)
+    created_at: float = field(default_factory=time.monotonic)
+    size_bytes: int = 0
+
+
+def normalize_message(text: str) -> str:
+    """Нормализовать ситуацию: регистр, ё, пунктуация, лишние пробелы"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """
+    LRU кэш с TTL, ограничением по памяти и пулом вариантов на ключ
+
+    Пока в пуле меньше max_variants вариантов, lookup возвращает промах,
+    чтобы повторные запросы пополняли пул. Заполненный пул отдает
+    варианты случайно, не повторяя последний выданный.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int, max_variants: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_variants = max_variants
+
+        self._entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        self._last_served: dict = {}
+        self._size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, style: str, message: str) -> tuple:
+        return (style, normalize_message(message))
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._last_served.pop(key, None)
+        self._size_bytes -= entry.size_bytes
+
+    def _evict(self):
+        """Вытеснить самые старые записи, пока не уложимся в лимиты"""
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._size_bytes > self.max_bytes
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def get(self, style: str, message: str) -> Optional[str]:
+        """Получить вариант из кэша или None при промахе"""
+        key = self._key(style, message)
+        entry = self._entries.get(key)
+
+        if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+            self._remove(key)
+            entry = None
+
+        if entry is None or len(entry.variants) < self.max_variants:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        # Не выдаем подряд один и тот же вариант
+        last = self._last_served.get(key)
+        choices = [v for v in entry.variants if v != last] or entry.variants
+        text = random.choice(choices)
+        self._last_served[key] = text
+        return text
+
+    def put(self, style: str, message: str, text: str):
+        """Добавить сгенерированный вариант в пул ключа"""
+        key = self._key(style, message)
+        entry = self._entries.get(key)
+
+        if entry is None or time.monotonic() - entry.created_at > self.ttl:
+            if entry is not None:
+                self._remove(key)
+            entry = CacheEntry()
+            self._entries[key] = entry
+
+        if text in entry.variants or len(entry.variants) >= self.max_variants:
+            self._entries.move_to_end(key)
+            return
+
+        size = len(text.encode("utf-8"))
+        entry.variants.append(text)
+        entry.size_bytes += size
+        self._size_bytes += size
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def stats(self) -> dict:
+        """Счетчики кэша для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self._size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=config.RESPONSE_CACHE_TTL,
+    max_bytes=config.RESPONSE_CACHE_MAX_BYTES,
+    max_variants=config.RESPONSE_CACHE_VARIANTS
+)
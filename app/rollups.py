@@ -0,0 +1,137 @@
+"""
+Сводки отмазок по часам и дням и снимок статистики для /admin
+
+Агрегаты по всей таблице excuses дорожают вместе с ней, поэтому фоновая
+задача раз в ROLLUP_INTERVAL секунд пересчитывает последние
+ROLLUP_LOOKBACK_HOURS часов в почасовую сводку, а затронутые дни - в
+дневную. Пустые сводки заполняются историей порциями по
+ROLLUP_CHUNK_HOURS. /admin читает снимок из памяти: снимок старше
+ADMIN_STATS_TTL пересобирается из сводок в фоне, пока отдается прежний.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app.config import config
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+
+class AdminStatsSnapshot:
+    """Статистика /admin, кэшированная на ADMIN_STATS_TTL секунд"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._stats: Optional[dict] = None
+        self._built_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+        self.builds = 0
+        self.build_time = 0.0
+
+    def age(self) -> Optional[float]:
+        return time.monotonic() - self._built_at if self._stats is not None else None
+
+    async def refresh(self):
+        started = time.monotonic()
+        stats = await db.get_admin_stats()
+        self._stats = stats
+        self._built_at = time.monotonic()
+        self.builds += 1
+        self.build_time = self._built_at - started
+        logger.debug(f"Admin stats snapshot built in {self.build_time:.3f}s")
+
+    async def get(self) -> dict:
+        """
+        Снимок статистики
+
+        Первый снимок собирается сразу, устаревший - в фоне (ответ не ждет БД).
+        """
+        age = self.age()
+        if age is not None and age <= self.ttl:
+            return self._stats
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+            self._refresh_task.add_done_callback(_log_refresh_error)
+        if self._stats is None:
+            await asyncio.shield(self._refresh_task)
+        return self._stats
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        error_logger.error(f"Admin stats snapshot failed: {task.exception()}", exc_info=task.exception())
+
+
+admin_stats = AdminStatsSnapshot(ttl=config.ADMIN_STATS_TTL)
+
+_rollup_task = None
+_rollup_stats = {"runs": 0, "chunks": 0, "failed": 0, "last_run_time": 0.0, "last_run_at": None}
+
+
+async def run_rollup(now: datetime = None):
+    """
+    Довести сводки до текущего момента
+
+    Окно начинается за ROLLUP_LOOKBACK_HOURS до последнего часа сводки:
+    отмазки из буфера записи попадают в БД с опозданием, а пересчет часа
+    идемпотентен. История без сводки обрабатывается порциями.
+    """
+    started = time.monotonic()
+    now = now or datetime.utcnow()
+    start = await db.get_rollup_start()
+    if start is None:
+        return
+    start -= timedelta(hours=config.ROLLUP_LOOKBACK_HOURS)
+
+    chunk = timedelta(hours=config.ROLLUP_CHUNK_HOURS)
+    while start < now:
+        end = min(start + chunk, now)
+        await db.refresh_rollups(start, end)
+        _rollup_stats["chunks"] += 1
+        start = end
+
+    _rollup_stats["runs"] += 1
+    _rollup_stats["last_run_at"] = now
+    _rollup_stats["last_run_time"] = time.monotonic() - started
+    logger.info(f"Rollups refreshed up to {now:%Y-%m-%d %H:%M} in {_rollup_stats['last_run_time']:.2f}s")
+
+
+def get_rollup_stats() -> dict:
+    return dict(_rollup_stats, snapshot_age=admin_stats.age(), snapshot_build_time=admin_stats.build_time)
+
+
+async def _rollup_loop():
+    """Периодически обновлять сводки и снимок /admin"""
+    while True:
+        try:
+            await run_rollup()
+            # Снимок пересобирается, только если /admin им уже пользовался
+            if admin_stats.age() is not None:
+                await admin_stats.refresh()
+        except Exception as e:
+            _rollup_stats["failed"] += 1
+            error_logger.error(f"Rollup failed: {e}", exc_info=True)
+        await asyncio.sleep(config.ROLLUP_INTERVAL)
+
+
+def start_rollups():
+    """Запустить фоновую агрегацию сводок"""
+    global _rollup_task
+    _rollup_task = asyncio.create_task(_rollup_loop())
+
+
+async def stop_rollups():
+    """Остановить фоновую агрегацию"""
+    global _rollup_task
+    if _rollup_task is not None:
+        _rollup_task.cancel()
+        try:
+            await _rollup_task
+        except asyncio.CancelledError:
+            pass
+        _rollup_task = None
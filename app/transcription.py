@@ -0,0 +1,287 @@
+"""
+Транскрипция голосовых сообщений: кэш, лимиты и выбор бэкенда
+"""
+import asyncio
+import io
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+
+from app.config import config
+from app.transcription_backends import REMOTE, create_backends, select_backend
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+request_logger = logging.getLogger("requests")
+
+# Бэкенды со своими лимитами параллельности: не конкурируем с LLM за слоты и потоки,
+# а заодно ограничиваем число аудиофайлов в памяти (скачивание идет внутри слота)
+_backends = None
+
+_stats = {
+    "transcribed": 0, "rejected_duration": 0, "rejected_size": 0,
+    "failed": 0, "download_failed": 0, "local_fallbacks": 0
+}
+_download_times = deque(maxlen=500)
+_transcribe_times = deque(maxlen=500)
+_backend_times = {}  # {бэкенд: deque[(секунд распознавания, секунд аудио)]}
+
+
+class TranscriptionCache:
+    """
+    LRU кэш распознанных голосовых по file_unique_id
+
+    file_unique_id одинаков у пересланных копий одного файла, поэтому
+    повтор не требует ни скачивания, ни запроса к Whisper.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id: str) -> Optional[str]:
+        text = self._entries.get(file_unique_id)
+        if text is not None:
+            self._entries.move_to_end(file_unique_id)
+        return text
+
+    def put(self, file_unique_id: str, text: str):
+        self._entries[file_unique_id] = text
+        self._entries.move_to_end(file_unique_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.db_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.db_hits) / total, 3) if total else 0.0
+        }
+
+
+transcription_cache = TranscriptionCache(max_entries=config.TRANSCRIPTION_CACHE_MAX_ENTRIES)
+
+# Распознавания в процессе: одновременные копии одного файла ждут одно
+_inflight = {}  # {file_unique_id: asyncio.Task}
+
+
+def _get_backends() -> dict:
+    global _backends
+    if _backends is None:
+        _backends = create_backends(config.TRANSCRIPTION_BACKEND)
+    return _backends
+
+
+async def start_transcription():
+    """Подготовить бэкенды (локальный загружает модель заранее)"""
+    backends = _get_backends()
+    for name, backend in list(backends.items()):
+        try:
+            await backend.start()
+        except Exception as e:
+            error_logger.error(f"Transcription backend {name} failed to start: {e}", exc_info=True)
+            if name != REMOTE:
+                await backend.close()
+                del backends[name]
+
+
+async def stop_transcription():
+    """Остановить пул процессов локального бэкенда"""
+    global _backends
+    if _backends is None:
+        return
+    for backend in _backends.values():
+        await backend.close()
+    _backends = None
+
+
+def check_voice_limits(duration: Optional[int], file_size: Optional[int]) -> Optional[str]:
+    """
+    Проверить голосовое по метаданным Telegram до скачивания
+
+    Returns:
+        Текст отказа для пользователя или None, если можно обрабатывать
+    """
+    if duration and duration > config.WHISPER_MAX_DURATION:
+        _stats["rejected_duration"] += 1
+        return f"Голосовое слишком длинное: максимум {config.WHISPER_MAX_DURATION} сек."
+    if file_size and file_size > config.WHISPER_MAX_FILE_SIZE:
+        _stats["rejected_size"] += 1
+        return f"Файл слишком большой: максимум {config.WHISPER_MAX_FILE_SIZE // (1024 * 1024)} МБ."
+    return None
+
+
+async def _lookup_cached(file_unique_id: str, user_id: int = None) -> Optional[str]:
+    """Найти распознанный текст в памяти или (если включено) в БД"""
+    text = transcription_cache.get(file_unique_id)
+    if text is not None:
+        transcription_cache.hits += 1
+        request_logger.info(f"TRANSCRIPTION_CACHE_HIT | User: {user_id} | Source: memory")
+        return text
+
+    if config.TRANSCRIPTION_CACHE_DB:
+        try:
+            text = await db.get_transcription(file_unique_id)
+        except Exception as e:
+            error_logger.error(f"Failed to load cached transcription: {e}", exc_info=True)
+            text = None
+        if text is not None:
+            transcription_cache.db_hits += 1
+            transcription_cache.put(file_unique_id, text)
+            request_logger.info(f"TRANSCRIPTION_CACHE_HIT | User: {user_id} | Source: db")
+            return text
+
+    return None
+
+
+async def _store_cached(file_unique_id: str, text: str, duration: Optional[int]):
+    """Запомнить распознанный текст (пустой результат не кэшируем)"""
+    if not text:
+        return
+    transcription_cache.put(file_unique_id, text)
+    if config.TRANSCRIPTION_CACHE_DB:
+        try:
+            await db.save_transcription(file_unique_id, text, duration)
+        except Exception as e:
+            error_logger.error(f"Failed to save transcription: {e}", exc_info=True)
+
+
+async def transcribe_voice(
+    download: Callable[[io.BytesIO], Awaitable], user_id: int = None,
+    file_unique_id: str = None, duration: int = None
+) -> str:
+    """
+    Распознать голосовое сообщение, по возможности без скачивания
+
+    Повтор того же файла (пересылка, повторная отправка) берется из кэша
+    по file_unique_id; одновременные копии ждут одно распознавание.
+
+    Args:
+        download: Корутина, которая пишет файл в переданный буфер
+        user_id: ID пользователя для логирования
+        file_unique_id: Постоянный ID файла в Telegram (ключ кэша)
+        duration: Длина голосового в секундах (для записи в БД)
+
+    Returns:
+        Распознанный текст (может быть пустым)
+    """
+    if file_unique_id is None:
+        return await _download_and_transcribe(download, user_id, duration)
+
+    text = await _lookup_cached(file_unique_id, user_id)
+    if text is not None:
+        return text
+
+    task = _inflight.get(file_unique_id)
+    if task is None:
+        transcription_cache.misses += 1
+        task = asyncio.ensure_future(_download_and_transcribe(download, user_id, duration))
+        _inflight[file_unique_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(file_unique_id, None))
+    else:
+        transcription_cache.hits += 1
+        request_logger.info(f"TRANSCRIPTION_CACHE_HIT | User: {user_id} | Source: in_flight")
+
+    # Отмена одного ожидающего не должна обрывать распознавание для остальных
+    text = await asyncio.shield(task)
+    if transcription_cache.get(file_unique_id) is None:
+        await _store_cached(file_unique_id, text, duration)
+    return text
+
+
+async def _download_and_transcribe(
+    download: Callable[[io.BytesIO], Awaitable], user_id: int = None, duration: int = None
+) -> str:
+    """Скачать файл и распознать его выбранным бэкендом под его лимитом параллельности"""
+    backends = _get_backends()
+    backend = select_backend(backends, config.TRANSCRIPTION_BACKEND, duration)
+
+    buffer = io.BytesIO()
+    try:
+        local_error = None
+        async with backend.semaphore:
+            download_start = time.time()
+            try:
+                await download(buffer)
+            except Exception:
+                # Ошибки скачивания входят в failed и считаются отдельно
+                _stats["failed"] += 1
+                _stats["download_failed"] += 1
+                raise
+            download_time = time.time() - download_start
+            _download_times.append(download_time)
+            buffer.seek(0)
+
+            transcribe_start = time.time()
+            try:
+                text = await backend.transcribe(buffer)
+            except Exception as e:
+                if backend.name == REMOTE:
+                    _stats["failed"] += 1
+                    raise
+                local_error = e
+
+        if local_error is not None:
+            # Локальный бэкенд упал - аудио уже скачано, отдаем его в API под лимитом API
+            _stats["local_fallbacks"] += 1
+            error_logger.error(f"Local transcription failed for user {user_id}, using remote: {local_error}")
+            backend = backends[REMOTE]
+            buffer.seek(0)
+            async with backend.semaphore:
+                transcribe_start = time.time()
+                try:
+                    text = await backend.transcribe(buffer)
+                except Exception:
+                    _stats["failed"] += 1
+                    raise
+        transcribe_time = time.time() - transcribe_start
+    finally:
+        buffer.close()
+
+    _transcribe_times.append(transcribe_time)
+    _backend_times.setdefault(backend.name, deque(maxlen=500)).append((transcribe_time, duration or 0))
+    _stats["transcribed"] += 1
+    logger.info(
+        f"Voice from user {user_id} transcribed by {backend.name}: "
+        f"download {download_time:.2f}s, transcribe {transcribe_time:.2f}s, audio {duration}s"
+    )
+    return text
+
+
+def _percentile(values: deque, share: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * share))], 3)
+
+
+def get_transcription_stats() -> dict:
+    """Счетчики и задержки транскрипции раздельно для скачивания и Whisper"""
+    return dict(
+        _stats,
+        cache=transcription_cache.stats(),
+        download_p50=_percentile(_download_times, 0.5),
+        download_p95=_percentile(_download_times, 0.95),
+        transcribe_p50=_percentile(_transcribe_times, 0.5),
+        transcribe_p95=_percentile(_transcribe_times, 0.95),
+        backends={name: _backend_stats(samples) for name, samples in _backend_times.items()}
+    )
+
+
+def _backend_stats(samples: deque) -> dict:
+    """Задержка бэкенда и секунд распознавания на секунду аудио"""
+    per_audio_second = [latency / audio for latency, audio in samples if audio]
+    return {
+        "count": len(samples),
+        "p50": _percentile([latency for latency, _ in samples], 0.5),
+        "per_audio_second_p50": _percentile(per_audio_second, 0.5)
+    }
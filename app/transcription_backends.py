@@ -0,0 +1,171 @@
+"""
+Бэкенды распознавания голосовых: удаленный Whisper API и локальный CPU
+
+Локальный бэкенд (faster-whisper) работает в пуле процессов: распознавание
+занимает CPU на секунды и не должно блокировать event loop бота. Пакет
+faster-whisper необязателен - без него доступен только удаленный бэкенд.
+"""
+import asyncio
+import importlib.util
+from abc import ABC, abstractmethod
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from app.config import config
+from app.llm_client import get_whisper_client
+
+logger = logging.getLogger(__name__)
+
+REMOTE = "remote"
+LOCAL = "local"
+AUTO = "auto"
+
+
+class TranscriptionBackend(ABC):
+    """Общий интерфейс бэкенда: распознать аудио из буфера"""
+
+    name = ""
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Собственный лимит параллельности (создается в работающем event loop)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @abstractmethod
+    async def transcribe(self, buffer: io.BytesIO, language: str = "ru") -> str:
+        ...
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class RemoteWhisperBackend(TranscriptionBackend):
+    """OpenAI-совместимый Whisper API (WHISPER_BASE_URL)"""
+
+    name = REMOTE
+
+    async def transcribe(self, buffer: io.BytesIO, language: str = "ru") -> str:
+        # Буфер передается как файл: multipart читает его сам, без копии в bytes
+        # Не передаём prompt, чтобы избежать его возврата при ошибках
+        transcription = await get_whisper_client().audio.transcriptions.create(
+            model=config.WHISPER_MODEL,  # gpt-4o-mini-transcribe по умолчанию
+            file=("voice.ogg", buffer, "audio/ogg"),
+            response_format="text",  # Простой текст вместо JSON
+            language=language  # Указываем язык для лучшего распознавания
+        )
+        # При response_format="text" возвращается просто строка
+        return transcription.strip() if isinstance(transcription, str) else transcription.text.strip()
+
+
+# Модель внутри процесса пула: загружается один раз при старте процесса
+_worker_model = None
+
+
+def _init_worker(model_name: str, compute_type: str, cpu_threads: int):
+    global _worker_model
+    from faster_whisper import WhisperModel
+    _worker_model = WhisperModel(model_name, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def _worker_ready() -> bool:
+    return _worker_model is not None
+
+
+def _worker_transcribe(audio: bytes, language: str) -> str:
+    segments, _ = _worker_model.transcribe(io.BytesIO(audio), language=language, beam_size=1)
+    return "".join(segment.text for segment in segments).strip()
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """faster-whisper на CPU в пуле процессов (по модели на процесс)"""
+
+    name = LOCAL
+
+    def __init__(self, workers: int, model_name: str, compute_type: str, cpu_threads: int):
+        super().__init__(max_concurrency=workers)
+        self.workers = workers
+        self.model_name = model_name
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @staticmethod
+    def is_installed() -> bool:
+        return importlib.util.find_spec("faster_whisper") is not None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: форк процесса с работающим event loop и сокетами небезопасен
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.compute_type, self.cpu_threads)
+            )
+        return self._pool
+
+    async def start(self):
+        """Поднять процессы и загрузить модель до первого голосового"""
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        await asyncio.gather(*[loop.run_in_executor(pool, _worker_ready) for _ in range(self.workers)])
+        logger.info(f"Local Whisper ready: {self.model_name} ({self.compute_type}), {self.workers} workers")
+
+    async def transcribe(self, buffer: io.BytesIO, language: str = "ru") -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), _worker_transcribe, buffer.getvalue(), language)
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def create_backends(mode: str) -> dict:
+    """
+    Бэкенды для режима TRANSCRIPTION_BACKEND: {имя: бэкенд}
+
+    Локальный бэкенд создается только при установленном faster-whisper,
+    иначе режимы local/auto работают через удаленный API.
+    """
+    backends = {REMOTE: RemoteWhisperBackend(max_concurrency=config.WHISPER_MAX_CONCURRENCY)}
+    if mode in (LOCAL, AUTO):
+        if LocalWhisperBackend.is_installed():
+            backends[LOCAL] = LocalWhisperBackend(
+                workers=config.LOCAL_WHISPER_WORKERS,
+                model_name=config.LOCAL_WHISPER_MODEL,
+                compute_type=config.LOCAL_WHISPER_COMPUTE_TYPE,
+                cpu_threads=config.LOCAL_WHISPER_THREADS
+            )
+        else:
+            logger.warning(f"TRANSCRIPTION_BACKEND={mode}, but faster-whisper is not installed: using remote API")
+    return backends
+
+
+def select_backend(backends: dict, mode: str, duration: Optional[int]) -> TranscriptionBackend:
+    """
+    Выбрать бэкенд для голосового
+
+    auto: короткие голосовые (до LOCAL_WHISPER_MAX_DURATION) - локально,
+    длинные и без известной длины - в удаленный API.
+    """
+    local = backends.get(LOCAL)
+    if local is None or mode == REMOTE:
+        return backends[REMOTE]
+    if mode == LOCAL:
+        return local
+    if duration and duration <= config.LOCAL_WHISPER_MAX_DURATION:
+        return local
+    return backends[REMOTE]
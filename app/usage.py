@@ -0,0 +1,153 @@
+"""
+Учет токенов LLM и дневные квоты пользователей
+
+Счетчики живут в памяти: проверка квоты не ходит в БД. Накопленный
+расход периодически сбрасывается в Postgres одним запросом.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime
+
+from app.config import config
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+
+@dataclass
+class TokenUsage:
+    """Токены, потраченные на одну генерацию (заполняется llm_client)"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class QuotaTracker:
+    """Дневной расход токенов по пользователям с отложенной записью в БД"""
+
+    def __init__(self, daily_limit: int):
+        self.daily_limit = daily_limit  # 0 - без ограничений
+
+        self._day = datetime.utcnow().date()
+        self._used = {}     # {user_id: токенов за текущий день}
+        self._pending = {}  # {(user_id, день): [prompt_tokens, completion_tokens]} - еще не в БД
+
+        self.rejected = 0
+        self.flushed_rows = 0
+
+    def _roll_day(self):
+        """Новые сутки (UTC) - квоты начинаются заново"""
+        today = datetime.utcnow().date()
+        if today != self._day:
+            self._day = today
+            self._used.clear()
+
+    def load(self, day: date, totals: dict):
+        """Восстановить расход за день после рестарта"""
+        self._roll_day()
+        if day == self._day:
+            for user_id, total in totals.items():
+                self._used[user_id] = self._used.get(user_id, 0) + total
+
+    def record(self, user_id: int, prompt_tokens: int, completion_tokens: int):
+        """Учесть расход токенов пользователем"""
+        self._roll_day()
+        self._used[user_id] = self._used.get(user_id, 0) + prompt_tokens + completion_tokens
+        pending = self._pending.setdefault((user_id, self._day), [0, 0])
+        pending[0] += prompt_tokens
+        pending[1] += completion_tokens
+
+    def used(self, user_id: int) -> int:
+        self._roll_day()
+        return self._used.get(user_id, 0)
+
+    def is_exceeded(self, user_id: int) -> bool:
+        """Исчерпал ли пользователь дневную квоту (без запросов к БД)"""
+        if not self.daily_limit or self.used(user_id) < self.daily_limit:
+            return False
+        self.rejected += 1
+        return True
+
+    def drain(self) -> list:
+        """Забрать накопленный расход для записи в БД: [(user_id, день, prompt, completion)]"""
+        rows = [(user_id, day, p, c) for (user_id, day), (p, c) in self._pending.items()]
+        self._pending = {}
+        return rows
+
+    def restore(self, rows: list):
+        """Вернуть строки, которые не удалось записать, до следующего сброса"""
+        for user_id, day, prompt_tokens, completion_tokens in rows:
+            pending = self._pending.setdefault((user_id, day), [0, 0])
+            pending[0] += prompt_tokens
+            pending[1] += completion_tokens
+
+    def stats(self) -> dict:
+        self._roll_day()
+        return {
+            "users_today": len(self._used),
+            "tokens_today": sum(self._used.values()),
+            "over_quota": sum(1 for used in self._used.values() if self.daily_limit and used >= self.daily_limit),
+            "rejected": self.rejected,
+            "pending_rows": len(self._pending),
+            "flushed_rows": self.flushed_rows
+        }
+
+
+quota_tracker = QuotaTracker(daily_limit=config.USER_DAILY_TOKEN_QUOTA)
+
+_flush_task = None
+
+
+async def flush_usage():
+    """Записать накопленный расход в БД одним запросом"""
+    rows = quota_tracker.drain()
+    if not rows:
+        return
+    try:
+        await db.add_token_usage(rows)
+        quota_tracker.flushed_rows += len(rows)
+    except Exception as e:
+        quota_tracker.restore(rows)
+        error_logger.error(f"Token usage flush failed ({len(rows)} rows): {e}", exc_info=True)
+
+
+async def _flush_loop():
+    """Периодически сбрасывать расход токенов в БД"""
+    while True:
+        await asyncio.sleep(config.USAGE_FLUSH_INTERVAL)
+        await flush_usage()
+
+
+async def start_usage_tracking():
+    """Загрузить расход за сегодня и запустить периодический сброс"""
+    global _flush_task
+    today = datetime.utcnow().date()
+    try:
+        quota_tracker.load(today, await db.get_token_usage_by_user(today))
+    except Exception as e:
+        error_logger.error(f"Failed to load token usage: {e}", exc_info=True)
+
+    _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_usage_tracking():
+    """Остановить периодический сброс и записать остаток"""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    await flush_usage()
+    logger.info("Token usage flushed")
@@ -0,0 +1,175 @@
+"""
+Реестр пользователей в памяти процесса
+
+Известный пользователь обслуживается без запросов к БД: профиль и
+last_active меняются в памяти и периодически записываются одним
+upsert'ом. В БД ходим только за незнакомыми пользователями (их строка
+нужна сразу - на нее ссылаются отмазки) и раз в USER_REGISTRY_TTL
+секунд, чтобы подхватить изменения настроек, сделанные в обход бота.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from app.config import config
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+
+@dataclass
+class UserInfo:
+    """Снимок пользователя, которого знает процесс"""
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    created_at: datetime
+    last_active: datetime
+    default_style: Optional[str]
+    is_premium: bool
+    loaded_at: float  # time.monotonic() последнего чтения из БД
+
+
+class UserRegistry:
+    """LRU известных пользователей с отложенной записью профиля и last_active"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._users: "OrderedDict[int, UserInfo]" = OrderedDict()
+        self._pending = {}  # {user_id: строка для upsert} - еще не в БД
+
+        self.hits = 0
+        self.misses = 0
+        self.flushed_rows = 0
+
+    def get(self, user_id: int) -> Optional[UserInfo]:
+        """Пользователь из памяти, если он известен и не устарел"""
+        user = self._users.get(user_id)
+        if user is None or time.monotonic() - user.loaded_at > self.ttl:
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def put(self, user: UserInfo):
+        self._users[user.user_id] = user
+        self._users.move_to_end(user.user_id)
+        while len(self._users) > self.max_entries:
+            # Вытесненный пользователь не теряет изменений: они остаются в _pending
+            self._users.popitem(last=False)
+
+    def touch(self, user: UserInfo, username: str = None, first_name: str = None):
+        """Обновить профиль и last_active в памяти и поставить в очередь на запись"""
+        user.last_active = datetime.utcnow()
+        if username:
+            user.username = username
+        if first_name:
+            user.first_name = first_name
+        self._pending[user.user_id] = {
+            "user_id": user.user_id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "created_at": user.created_at,
+            "last_active": user.last_active
+        }
+
+    def drain(self) -> list:
+        """Забрать накопленные изменения для записи в БД"""
+        rows = list(self._pending.values())
+        self._pending = {}
+        return rows
+
+    def restore(self, rows: list):
+        """Вернуть строки, которые не удалось записать (более свежие изменения не затираем)"""
+        for row in rows:
+            self._pending.setdefault(row["user_id"], row)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "known": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "pending_rows": len(self._pending),
+            "flushed_rows": self.flushed_rows
+        }
+
+
+user_registry = UserRegistry(max_entries=config.USER_REGISTRY_MAX_ENTRIES, ttl=config.USER_REGISTRY_TTL)
+
+_flush_task = None
+
+
+async def get_user(user_id: int, username: str = None, first_name: str = None) -> UserInfo:
+    """
+    Получить пользователя, создав его в БД при первом обращении
+
+    Для известного пользователя не делает ни одного запроса к БД.
+    """
+    user = user_registry.get(user_id)
+    if user is not None:
+        user_registry.hits += 1
+        user_registry.touch(user, username, first_name)
+        return user
+
+    user_registry.misses += 1
+    row = await db.get_or_create_user(user_id, username, first_name)
+    user = UserInfo(
+        user_id=row.user_id,
+        username=row.username,
+        first_name=row.first_name,
+        created_at=row.created_at,
+        last_active=row.last_active or datetime.utcnow(),
+        default_style=row.default_style,
+        is_premium=bool(row.is_premium),
+        loaded_at=time.monotonic()
+    )
+    user_registry.put(user)
+    return user
+
+
+async def flush_users():
+    """Записать накопленные изменения пользователей одним запросом"""
+    rows = user_registry.drain()
+    if not rows:
+        return
+    try:
+        await db.upsert_users(rows)
+        user_registry.flushed_rows += len(rows)
+    except Exception as e:
+        user_registry.restore(rows)
+        error_logger.error(f"User activity flush failed ({len(rows)} rows): {e}", exc_info=True)
+
+
+async def _flush_loop():
+    """Периодически сбрасывать last_active и профили в БД"""
+    while True:
+        await asyncio.sleep(config.USER_FLUSH_INTERVAL)
+        await flush_users()
+
+
+def start_user_registry():
+    """Запустить периодическую запись активности пользователей"""
+    global _flush_task
+    _flush_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_user_registry():
+    """Остановить периодическую запись и сбросить остаток"""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    await flush_users()
+    logger.info("User activity flushed")
@@ -0,0 +1,188 @@
+"""
+Пул заранее сгенерированных отмазок для типовых ситуаций
+
+Пул засевается отмазками с оценкой 👍 и пополняется в фоне. Он отдает
+мгновенный ответ для случайного стиля и служит запасным путем, когда
+все слоты запросов к LLM заняты.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, deque
+from typing import Optional
+
+from app.config import config
+from app.limiter import BACKGROUND
+from app.llm_client import generate_text, is_fallback_response, is_llm_saturated
+from app.prompts import EXCUSE_PROMPTS
+from app.response_cache import normalize_message
+from app import database as db
+
+logger = logging.getLogger(__name__)
+error_logger = logging.getLogger("error")
+
+
+class WarmPool:
+    """Очереди готовых отмазок по ключу (стиль, нормализованная ситуация)"""
+
+    def __init__(self, size_per_key: int, max_situations: int, max_age: float):
+        self.size_per_key = size_per_key
+        self.max_situations = max_situations
+        self.max_age = max_age
+
+        self._situations = {}  # {нормализованная ситуация: исходный текст для промпта}
+        self._entries = {}     # {(стиль, ситуация): deque[(текст, время создания)]}
+
+        self.served = 0
+        self.refilled = 0
+        self.expired = 0
+
+    def _queue(self, style: str, situation: str) -> deque:
+        return self._entries.setdefault((style, situation), deque())
+
+    def _drop_expired(self, queue: deque):
+        now = time.monotonic()
+        while queue and now - queue[0][1] > self.max_age:
+            queue.popleft()
+            self.expired += 1
+
+    def seed(self, excuses: list):
+        """Засеять пул самыми популярными ситуациями из понравившихся отмазок"""
+        counts = Counter(normalize_message(e.original_message) for e in excuses)
+        top = {situation for situation, _ in counts.most_common(self.max_situations)}
+
+        for excuse in excuses:
+            situation = normalize_message(excuse.original_message)
+            if situation not in top or excuse.style not in EXCUSE_PROMPTS:
+                continue
+            self._situations.setdefault(situation, excuse.original_message)
+            queue = self._queue(excuse.style, situation)
+            if len(queue) < self.size_per_key and excuse.generated_text not in (t for t, _ in queue):
+                queue.append((excuse.generated_text, time.monotonic()))
+
+        logger.info(f"Warm pool seeded: {len(self._situations)} situations, {self.size()} excuses")
+
+    def add(self, style: str, situation: str, text: str):
+        """Положить свежую отмазку в пул"""
+        queue = self._queue(style, situation)
+        if len(queue) < self.size_per_key and text not in (t for t, _ in queue):
+            queue.append((text, time.monotonic()))
+            self.refilled += 1
+
+    def deficits(self) -> list:
+        """Ключи, которым не хватает отмазок: [(стиль, ситуация, сколько догенерировать)]"""
+        result = []
+        for situation in self._situations:
+            for style in EXCUSE_PROMPTS:
+                queue = self._queue(style, situation)
+                self._drop_expired(queue)
+                missing = self.size_per_key - len(queue)
+                if missing > 0:
+                    result.append((style, situation, missing))
+        return result
+
+    def prompt_text(self, situation: str) -> str:
+        return self._situations[situation]
+
+    def take(self, style: str, message: str) -> Optional[str]:
+        """Забрать готовую отмазку (каждая выдается один раз)"""
+        queue = self._entries.get((style, normalize_message(message)))
+        if not queue:
+            return None
+        self._drop_expired(queue)
+        if not queue:
+            return None
+        self.served += 1
+        return queue.popleft()[0]
+
+    def available_style(self, message: str) -> Optional[str]:
+        """Случайный стиль, для которого в пуле есть отмазка на эту ситуацию"""
+        situation = normalize_message(message)
+        styles = [style for style in EXCUSE_PROMPTS if self._entries.get((style, situation))]
+        return random.choice(styles) if styles else None
+
+    def size(self) -> int:
+        return sum(len(queue) for queue in self._entries.values())
+
+    def stats(self) -> dict:
+        return {
+            "situations": len(self._situations),
+            "size": self.size(),
+            "served": self.served,
+            "refilled": self.refilled,
+            "expired": self.expired
+        }
+
+
+warm_pool = WarmPool(
+    size_per_key=config.WARM_POOL_SIZE,
+    max_situations=config.WARM_POOL_MAX_SITUATIONS,
+    max_age=config.WARM_POOL_MAX_AGE
+)
+
+_refill_task = None
+
+
+async def _refill_key(semaphore: asyncio.Semaphore, style: str, situation: str, missing: int):
+    """
+    Догенерировать отмазки для одного ключа
+
+    Запросы по ключу идут последовательно: одинаковые одновременные
+    промпты объединились бы в один запрос и дали бы один и тот же текст.
+    """
+    prompt = EXCUSE_PROMPTS[style].format(user_message=warm_pool.prompt_text(situation))
+    for _ in range(missing):
+        async with semaphore:
+            # Пул - фоновая работа: не конкурируем с пользователями за LLM
+            if is_llm_saturated():
+                return
+            text = await generate_text(prompt, style=style, lane=BACKGROUND)
+        if not is_fallback_response(text):
+            warm_pool.add(style, situation, text)
+
+
+async def _refill_loop():
+    """Периодически пополнять пул до целевого размера"""
+    semaphore = asyncio.Semaphore(config.WARM_POOL_REFILL_CONCURRENCY)
+    while True:
+        try:
+            jobs = [
+                _refill_key(semaphore, style, situation, missing)
+                for style, situation, missing in warm_pool.deficits()
+            ]
+            if jobs:
+                await asyncio.gather(*jobs)
+                logger.info(f"Warm pool refilled: {warm_pool.stats()}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error_logger.error(f"Warm pool refill failed: {e}", exc_info=True)
+
+        await asyncio.sleep(config.WARM_POOL_REFILL_INTERVAL)
+
+
+async def start_warm_pool():
+    """Засеять пул из БД и запустить фоновое пополнение"""
+    global _refill_task
+    if not config.WARM_POOL_ENABLED:
+        return
+
+    try:
+        warm_pool.seed(await db.get_top_rated_excuses())
+    except Exception as e:
+        error_logger.error(f"Warm pool seeding failed: {e}", exc_info=True)
+
+    _refill_task = asyncio.create_task(_refill_loop())
+
+
+async def stop_warm_pool():
+    """Остановить фоновое пополнение пула"""
+    global _refill_task
+    if _refill_task is not None:
+        _refill_task.cancel()
+        try:
+            await _refill_task
+        except asyncio.CancelledError:
+            pass
+        _refill_task = None
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Сравнение бэкендов распознавания голосовых по задержке на секунду аудио
+
+Прогоняет один и тот же файл через удаленный Whisper API и (если установлен
+faster-whisper) через локальный CPU бэкенд, печатает p50/p95 задержки и
+секунд распознавания на секунду аудио - по этим числам выбирается
+LOCAL_WHISPER_MAX_DURATION для режима auto.
+
+Запуск:
+    python benchmark_transcription.py файл.ogg длительность_сек [повторов]
+"""
+import asyncio
+import io
+import sys
+import time
+
+from app.llm_client import close_clients
+from app.transcription_backends import AUTO, create_backends
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def run_backend(backend, audio: bytes, duration: float, repeats: int) -> list:
+    """Последовательные прогоны: меряем задержку одного голосового, а не пропускную способность"""
+    latencies = []
+    for i in range(repeats):
+        started = time.perf_counter()
+        text = await backend.transcribe(io.BytesIO(audio))
+        latencies.append(time.perf_counter() - started)
+        if i == 0:
+            print(f"  [{backend.name}] {text[:80]}")
+    return latencies
+
+
+async def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return
+
+    path = sys.argv[1]
+    duration = float(sys.argv[2])
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    with open(path, "rb") as f:
+        audio = f.read()
+
+    print("БЕНЧМАРК РАСПОЗНАВАНИЯ ГОЛОСОВЫХ")
+    print("=" * 40)
+    print(f"Файл: {path}, {duration:.1f}s аудио, {len(audio)} байт, прогонов: {repeats}")
+
+    backends = create_backends(AUTO)
+    try:
+        for backend in backends.values():
+            # Загрузка модели не входит в замер
+            await backend.start()
+            try:
+                latencies = await run_backend(backend, audio, duration, repeats)
+            except Exception as e:
+                print(f"\n{backend.name}: ошибка - {e}")
+                continue
+            p50, p95 = percentile(latencies, 0.5), percentile(latencies, 0.95)
+            print(f"\n{backend.name}:")
+            print(f"  Latency p50: {p50:.2f}s, p95: {p95:.2f}s")
+            print(f"  На секунду аудио p50: {p50 / duration:.3f}s, p95: {p95 / duration:.3f}s")
+    finally:
+        for backend in backends.values():
+            await backend.close()
+        await close_clients()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
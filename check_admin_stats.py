@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Проверка статистики /admin на базе после миграций
+
+Сверяет модели app/models.py со схемой БД (таблицы и колонки, созданные
+Alembic), затем доводит сводки до текущего момента (как фоновая
+агрегация) и собирает снимок get_admin_stats. Ничего, кроме сводок, не
+пишет.
+
+Запуск (после alembic upgrade head):
+    DATABASE_URL=postgresql+asyncpg://... python check_admin_stats.py
+"""
+import asyncio
+import sys
+
+from sqlalchemy import inspect
+
+from app import database as db
+from app.models import Base
+from app.rollups import run_rollup
+
+
+def missing_columns(sync_conn) -> list:
+    """Таблицы и колонки моделей, которых нет в БД"""
+    inspector = inspect(sync_conn)
+    tables = set(inspector.get_table_names())
+    problems = []
+    for name, table in Base.metadata.tables.items():
+        if name not in tables:
+            problems.append(f"таблица {name}")
+            continue
+        columns = {column["name"] for column in inspector.get_columns(name)}
+        problems.extend(f"колонка {name}.{column.name}" for column in table.columns if column.name not in columns)
+    return problems
+
+
+async def main() -> int:
+    print("ПРОВЕРКА СТАТИСТИКИ /admin")
+    print("=" * 40)
+
+    await db.init_database()
+    try:
+        async with db.engine.connect() as conn:
+            problems = await conn.run_sync(missing_columns)
+        if problems:
+            print("FAIL Модели не совпадают со схемой: " + ", ".join(problems))
+            return 1
+        print(f"OK Схема: {len(Base.metadata.tables)} таблиц моделей есть в БД")
+
+        await run_rollup()
+        print("OK Сводки обновлены")
+
+        stats = await db.get_admin_stats()
+        print(
+            f"OK Снимок: пользователей {stats['total_users']}, отмазок {stats['total_excuses']}, "
+            f"в избранном {stats['total_favorites']}, стиль {stats['popular_style']}, "
+            f"токенов {stats['total_prompt_tokens'] + stats['total_completion_tokens']}"
+        )
+        print(f"   За 24 часа: {sum(count for _, count in stats['hourly_volume'])}")
+        return 0
+    except Exception as e:
+        print(f"FAIL {type(e).__name__}: {e}")
+        return 1
+    finally:
+        await db.close_database()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Проверка failover между LLM провайдерами на локальных stub-серверах
+
+Основной провайдер падает (503), резервный отвечает. Скрипт показывает,
+что после открытия circuit breaker'а запросы сразу идут в резервный,
+а после восстановления основного фоновая проба закрывает breaker.
+
+Запуск:
+    python failover_test_llm.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+from load_test_llm import STUB_HOST, start_stub_server
+
+PRIMARY_PORT = 8771
+BACKUP_PORT = 8772
+
+
+async def main():
+    """Основная функция проверки failover"""
+    os.environ["LLM_BASE_URL"] = f"http://{STUB_HOST}:{PRIMARY_PORT}/v1"
+    os.environ["LLM_FALLBACK_PROVIDERS"] = f"http://{STUB_HOST}:{BACKUP_PORT}/v1|backup-model"
+    os.environ.setdefault("OPENROUTER_API_KEY", "stub-key")
+    os.environ["LLM_BREAKER_OPEN_DURATION"] = "1.0"
+
+    sys.path.append('.')
+    from app.llm_client import generate_text, close_clients
+    from app.providers import get_provider_stats
+
+    print("ПРОВЕРКА FAILOVER LLM ПРОВАЙДЕРОВ")
+    print("=" * 40)
+
+    primary = await start_stub_server(0.05, port=PRIMARY_PORT)
+    backup = await start_stub_server(0.05, port=BACKUP_PORT)
+
+    def show(title: str):
+        states = ", ".join(f"{p['name']}={p['state']}" for p in get_provider_stats())
+        print(f"{title}: {states} | запросов primary={primary.app['stats']['requests']}, "
+              f"backup={backup.app['stats']['requests']}")
+
+    try:
+        await generate_text("Тест", user_id=1, style="failover")
+        show("Оба провайдера живы")
+
+        primary.app["control"]["fail"] = True
+        for i in range(10):
+            await generate_text(f"Тест {i}", user_id=1, style="failover")
+        show("Основной падает")
+
+        started = time.perf_counter()
+        await generate_text("Тест при открытом breaker", user_id=1, style="failover")
+        print(f"Запрос при открытом breaker: {time.perf_counter() - started:.3f}s")
+        show("Открытый breaker пропущен")
+
+        primary.app["control"]["fail"] = False
+        await asyncio.sleep(1.5)
+        show("Основной восстановлен, проба прошла")
+
+        await generate_text("Тест после восстановления", user_id=1, style="failover")
+        show("Трафик вернулся на основной")
+    finally:
+        await close_clients()
+        await primary.cleanup()
+        await backup.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
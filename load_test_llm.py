@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест LLM клиента против локального stub-сервера
+
+Поднимает OpenAI-совместимый сервер на localhost, который отвечает с задержкой,
+и запускает сотни параллельных generate_text в одном процессе.
+
+Запуск:
+    python load_test_llm.py [количество_запросов] [задержка_сервера_сек] [емкость_сервера]
+
+Если задана емкость, stub-сервер отвечает 429 на запросы сверх нее -
+так видно, как адаптивный лимит подстраивается под провайдера.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from aiohttp import web
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8765
+
+
+async def chat_completions(request: web.Request) -> web.Response:
+    """Эмуляция /v1/chat/completions с задержкой ответа"""
+    body = await request.json()
+    stats = request.app["stats"]
+    stats["requests"] += 1
+    if request.app["control"]["fail"]:
+        stats["failed"] += 1
+        return web.json_response(
+            {"error": {"message": "Upstream unavailable", "type": "server_error"}}, status=503
+        )
+
+    capacity = request.app["capacity"]
+    if capacity and stats["in_flight"] >= capacity:
+        stats["rate_limited"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}, status=429
+        )
+
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(request.app["delay"])
+    finally:
+        stats["in_flight"] -= 1
+
+    content = "Братан, метро встало, я тут ни при чем."
+    if body.get("stream"):
+        return await stream_completion(request, body, content)
+
+    return web.json_response({
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": f"{content} ({index + 1})" if index else content},
+                "finish_reason": "stop"
+            }
+            for index in range(body.get("n") or 1)
+        ],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+    })
+
+
+async def stream_completion(request: web.Request, body: dict, content: str) -> web.StreamResponse:
+    """Эмуляция потокового ответа (SSE) по одному слову"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    for word in content.split(" "):
+        chunk = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+        }
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await asyncio.sleep(0.05)
+
+    if (body.get("stream_options") or {}).get("include_usage"):
+        usage_chunk = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+        }
+        await response.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def start_stub_server(delay: float, capacity: int = 0, port: int = STUB_PORT) -> web.AppRunner:
+    """
+    Запустить stub-сервер
+
+    capacity > 0 - отвечать 429 сверх этой нагрузки;
+    runner.app["control"]["fail"] = True - отвечать 503 на все запросы.
+    """
+    app = web.Application()
+    app["delay"] = delay
+    app["capacity"] = capacity
+    app["control"] = {"fail": False}
+    app["stats"] = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0, "rate_limited": 0}
+    app.router.add_post("/v1/chat/completions", chat_completions)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Большой backlog, чтобы сотни одновременных подключений не ждали повтора SYN
+    await web.TCPSite(runner, STUB_HOST, port, backlog=1024).start()
+    return runner
+
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль по отсортированному списку"""
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * p))
+    return values[index]
+
+
+async def main():
+    """Основная функция нагрузочного теста"""
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    # Направляем клиент на stub-сервер до импорта конфигурации
+    os.environ["LLM_BASE_URL"] = f"http://{STUB_HOST}:{STUB_PORT}/v1"
+    os.environ.setdefault("OPENROUTER_API_KEY", "stub-key")
+    os.environ.setdefault("LLM_MAX_CONCURRENCY", str(total))
+    os.environ.setdefault("LLM_INITIAL_CONCURRENCY", str(capacity or total))
+    os.environ.setdefault("LLM_MAX_QUEUE_WAIT", "30")
+    os.environ.setdefault("LLM_MAX_CONNECTIONS", str(total))
+
+    sys.path.append('.')
+    from app.llm_client import generate_text, close_clients, get_limiter_stats
+
+    print("НАГРУЗОЧНЫЙ ТЕСТ LLM КЛИЕНТА")
+    print("=" * 40)
+    print(f"Запросов: {total}, задержка сервера: {delay}s, емкость: {capacity or 'без ограничений'}")
+
+    runner = await start_stub_server(delay, capacity)
+    latencies = []
+
+    async def one_request(i: int):
+        started = time.perf_counter()
+        result = await generate_text(f"Тестовый промпт #{i}", user_id=i, style="load_test")
+        latencies.append(time.perf_counter() - started)
+        return result
+
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one_request(i) for i in range(total)))
+        wall_time = time.perf_counter() - started
+    finally:
+        limiter_stats = get_limiter_stats()
+        await close_clients()
+        server_stats = runner.app["stats"]
+        await runner.cleanup()
+
+    ok = sum(1 for r in results if r.startswith("Братан"))
+    print(f"\nУспешных ответов: {ok}/{total}")
+    print(f"Общее время: {wall_time:.2f}s")
+    print(f"Макс. параллельных запросов на сервере: {server_stats['max_in_flight']}")
+    print(f"Ответов 429 от сервера: {server_stats['rate_limited']}")
+    print(f"Адаптивный лимит: {limiter_stats}")
+    print(f"Latency p50: {percentile(latencies, 0.5):.2f}s, p99: {percentile(latencies, 0.99):.2f}s")
+    print(f"Пропускная способность: {total / wall_time:.1f} req/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())